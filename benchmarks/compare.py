@@ -0,0 +1,62 @@
+"""Compare two benchmarks.load result files.
+
+    python -m benchmarks.compare before.json after.json --max-regression 10
+
+Prints every metric side by side. Exits non-zero when any latency, or the
+number of queries per operation, got worse by more than --max-regression
+percent, or when throughput dropped by more than that.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when bigger is better
+METRICS = {
+    "throughput_per_s": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "queries_per_op": False,
+}
+
+
+def sections(results):
+    yield from results.get("operations", {}).items()
+    if "delivery" in results:
+        yield "delivery", results["delivery"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--max-regression", type=float, default=None, help="percent")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = dict(sections(json.load(f)))
+    with open(args.after) as f:
+        after = dict(sections(json.load(f)))
+
+    regressions = []
+    print(f"{'operation':<14} {'metric':<18} {'before':>12} {'after':>12} {'change':>9}")
+    for name, old in before.items():
+        new = after.get(name)
+        if new is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if old.get(metric) is None or new.get(metric) is None:
+                continue
+            change = (new[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            print(f"{name:<14} {metric:<18} {old[metric]:>12} {new[metric]:>12} {change:>+8.1f}%")
+            worse = -change if higher_is_better else change
+            if args.max_regression is not None and worse > args.max_regression:
+                regressions.append(f"{name}.{metric} {change:+.1f}%")
+
+    if regressions:
+        print("\nregressions over threshold: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Load and latency benchmark for the HTTP and /ws paths.
+
+Boots ``main:app`` in-process on a free port, seeds an empty local database
+(see benchmarks/seed.py) and then runs, one phase after another:
+
+- ``login``: ``POST /token`` for random users
+- ``open_chat``: ``GET /chats/{id}`` for random chats
+- ``post_message``: ``POST /messages/``, then the sender relays the message
+  over ``/ws`` the way the app does. Every connected client records the
+  end-to-end delivery latency.
+
+Throughput, p50/p95/p99 and SQL statements per operation are counted with
+engine events on ``config.engine``. They are printed and written as JSON to
+``--out``. Compare two runs with ``python -m benchmarks.compare``.
+
+Point the app at a scratch database first (``DATABASE_URL`` or the DB_*
+variables, ``sqlite:///./bench.db`` works without MySQL), then::
+
+    python -m benchmarks.load --users 500 --chats 100 --ws-clients 200 --posts 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+import uvicorn
+import websockets
+from sqlalchemy import event, inspect
+
+from benchmarks.seed import PASSWORD, seed
+from config import engine
+from migrations.bootstrap import bootstrap
+from services import create_access_token
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args):
+        with self.lock:
+            self.count += 1
+
+    def take(self):
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    summary = {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+    for name, fraction in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 2) if value is not None else None
+    if queries is not None:
+        summary["queries_per_op"] = round(queries / max(len(latencies) + errors, 1), 2)
+    return summary
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port):
+    from compression import CompressedWebSocketProtocol
+    from main import app
+
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning", ws=CompressedWebSocketProtocol
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run_phase(count, concurrency, operation):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(n):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(n)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(count)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def ws_client(url, user_id, deliveries, ready, stop):
+    token = create_access_token({"sub": f"user{user_id}@bench.local"}, timedelta(hours=1))
+    async with websockets.connect(f"{url}?token={token}", max_size=None) as ws:
+        ready.release()
+        while not stop.is_set():
+            try:
+                frame = await asyncio.wait_for(ws.recv(), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            received = time.perf_counter()
+            data = json.loads(frame)
+            # Relayed frames are a JSON encoded string, decode again
+            if isinstance(data, str):
+                data = json.loads(data)
+            if isinstance(data, dict) and "bench_sent_at" in data:
+                deliveries.append(received - data["bench_sent_at"])
+
+
+async def benchmark(args):
+    if inspect(engine).get_table_names():
+        raise SystemExit("benchmarks.load needs an empty database, it seeds its own data")
+    bootstrap()
+    user_ids, chat_ids, members = seed(
+        users=args.users,
+        chats=args.chats,
+        members_per_chat=args.members_per_chat,
+        messages_per_chat=args.messages_per_chat,
+    )
+
+    port = free_port()
+    server, thread = start_server(port)
+    base = f"http://127.0.0.1:{port}"
+    ws_url = f"ws://127.0.0.1:{port}/ws"
+    queries = QueryCounter(engine)
+    rng = random.Random(1)
+    results = {
+        "started_at": datetime.now().isoformat(),
+        "dialect": engine.dialect.name,
+        "config": vars(args),
+        "operations": {},
+    }
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+
+        async def login(n):
+            user_id = rng.choice(user_ids)
+            response = await client.post(
+                "/token", data={"username": f"user{user_id}@bench.local", "password": PASSWORD}
+            )
+            response.raise_for_status()
+
+        async def open_chat(n):
+            response = await client.get(f"/chats/{rng.choice(chat_ids)}")
+            response.raise_for_status()
+
+        for name, count, operation in (
+            ("login", args.logins, login),
+            ("open_chat", args.opens, open_chat),
+        ):
+            queries.take()
+            latencies, errors, elapsed = await run_phase(count, args.concurrency, operation)
+            results["operations"][name] = summarize(latencies, errors, elapsed, queries.take())
+
+        deliveries = []
+        ready = asyncio.Semaphore(0)
+        stop = asyncio.Event()
+        listeners = [
+            asyncio.create_task(ws_client(ws_url, user_ids[n % len(user_ids)], deliveries, ready, stop))
+            for n in range(args.ws_clients)
+        ]
+        for _ in listeners:
+            await ready.acquire()
+        senders = await asyncio.gather(
+            *(websockets.connect(ws_url) for _ in range(min(args.concurrency, 20)))
+        )
+
+        async def post_message(n):
+            chat_id = rng.choice(chat_ids)
+            sender_id = rng.choice(members[chat_id])
+            sent_at = time.perf_counter()
+            response = await client.post(
+                "/messages/",
+                json={
+                    "id": uuid.uuid4().hex,
+                    "chat_id": chat_id,
+                    "sender_id": sender_id,
+                    "message": f"bench message {n}",
+                },
+            )
+            response.raise_for_status()
+            await senders[n % len(senders)].send(
+                json.dumps(
+                    {
+                        "type": "message",
+                        "chat_id": chat_id,
+                        "message": response.json(),
+                        "bench_sent_at": sent_at,
+                    }
+                )
+            )
+
+        queries.take()
+        latencies, errors, elapsed = await run_phase(args.posts, args.concurrency, post_message)
+        results["operations"]["post_message"] = summarize(
+            latencies, errors, elapsed, queries.take()
+        )
+
+        # Let the last frames arrive
+        await asyncio.sleep(1)
+        stop.set()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        for sender in senders:
+            await sender.close()
+        results["delivery"] = summarize(deliveries, 0, elapsed)
+        results["delivery"]["expected"] = (args.posts - errors) * args.ws_clients
+
+    server.should_exit = True
+    thread.join(timeout=10)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--members-per-chat", type=int, default=20)
+    parser.add_argument("--messages-per-chat", type=int, default=200)
+    parser.add_argument("--ws-clients", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--opens", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--out", default=os.path.join("benchmarks", "results"))
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"written to {path}")
+
+
+if __name__ == "__main__":
+    main()
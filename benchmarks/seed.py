@@ -0,0 +1,97 @@
+"""Synthetic users, chats and messages for the load benchmark.
+
+Everything is bulk inserted in a few statements, so seeding 100k messages
+takes seconds. All users share one password so bcrypt runs once.
+"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from config import SessionLocal
+from ids import next_id
+from services import get_password_hash
+import models
+
+PASSWORD = "bench-password"
+ROLE = "bench"
+
+
+def seed(users=200, chats=50, members_per_chat=20, messages_per_chat=200, seed=0):
+    """Fill an empty database. Returns ``(user_ids, chat_ids, members)``."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    password = get_password_hash(PASSWORD)
+    db = SessionLocal()
+    try:
+        db.execute(insert(models.Role), [{"role": ROLE, "created_at": now, "last_modified_at": now}])
+        db.execute(
+            insert(models.User),
+            [
+                {
+                    "id": n,
+                    "email": f"user{n}@bench.local",
+                    "password": password,
+                    "name": f"Bench User {n}",
+                    "role_name": ROLE,
+                    "disabled": False,
+                    "created_at": now,
+                    "last_modified_at": now,
+                }
+                for n in range(1, users + 1)
+            ],
+        )
+        user_ids = list(range(1, users + 1))
+
+        db.execute(
+            insert(models.Chat),
+            [
+                {
+                    "id": n,
+                    "chat_name": f"bench-group-{n}",
+                    "is_group": True,
+                    "created_at": now,
+                    "last_modified_at": now,
+                }
+                for n in range(1, chats + 1)
+            ],
+        )
+        chat_ids = list(range(1, chats + 1))
+
+        members = {
+            chat_id: rng.sample(user_ids, min(members_per_chat, len(user_ids)))
+            for chat_id in chat_ids
+        }
+        db.execute(
+            insert(models.ChatMember),
+            [
+                {"chat_id": chat_id, "user_id": user_id, "joined_at": now, "last_modified_at": now}
+                for chat_id, user_ids_in_chat in members.items()
+                for user_id in user_ids_in_chat
+            ],
+        )
+
+        start = now - timedelta(days=30)
+        for chat_id in chat_ids:
+            rows = []
+            for n in range(messages_per_chat):
+                created_at = start + timedelta(seconds=n * 60 + rng.random())
+                rows.append(
+                    {
+                        "id": next_id(),
+                        "chat_sequance": 1,
+                        "chat_id": chat_id,
+                        "sender_id": rng.choice(members[chat_id]),
+                        "timestamp": created_at,
+                        "message": "lorem ipsum " * rng.randint(1, 20),
+                        "seen": False,
+                        "is_file": False,
+                        "created_at": created_at,
+                        "last_modified_at": created_at,
+                    }
+                )
+            db.execute(insert(models.Message), rows)
+        db.commit()
+        return user_ids, chat_ids, members
+    finally:
+        db.close()
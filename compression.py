@@ -0,0 +1,288 @@
+"""Response compression for HTTP and /ws.
+
+HTTP: ``CompressionMiddleware`` gzips (or brotli-compresses, when the
+optional ``brotli`` package is installed and the client accepts ``br``)
+text and JSON responses of at least ``HTTP_COMPRESS_MIN_SIZE`` bytes.
+Streaming responses are compressed chunk by chunk and flushed, so NDJSON
+exports still arrive as they are produced. Responses that can be fetched
+by byte range, like attachments, are left alone.
+
+/ws: ``CompressedWebSocketProtocol`` is uvicorn's websockets protocol
+with a tuned permessage-deflate. The window and memLevel are smaller than
+zlib's defaults (about 256 KiB per connection down to about 20 KiB), and
+messages under ``WS_COMPRESS_MIN_SIZE`` bytes are sent uncompressed, where
+deflate costs more CPU than it saves. A client can turn compression off
+for its connection with ``/ws?compress=0``. Run the server with
+``python main.py`` or pass ``ws=CompressedWebSocketProtocol`` to
+``uvicorn.run``; the ``uvicorn`` command line only takes the built-in
+protocols.
+
+Bytes in/out and CPU seconds are counted per transport and encoding on
+/metrics, the compression ratio is ``compression_bytes_out_total /
+compression_bytes_in_total``.
+"""
+import time
+import zlib
+from typing import Optional
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers, MutableHeaders
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets import frames
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+
+from config import settings
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+
+bytes_in = metrics.Counter(
+    "compression_bytes_in_total", "Bytes before compression", ["transport", "encoding"]
+)
+bytes_out = metrics.Counter(
+    "compression_bytes_out_total", "Bytes after compression", ["transport", "encoding"]
+)
+cpu_seconds = metrics.Counter(
+    "compression_cpu_seconds_total", "CPU time spent compressing", ["transport", "encoding"]
+)
+skipped = metrics.Counter(
+    "compression_skipped_total",
+    "Responses or frames sent uncompressed, by reason",
+    ["transport", "reason"],
+)
+
+
+def record(transport, encoding, size_in, size_out, started):
+    cpu_seconds.inc(time.thread_time() - started, transport=transport, encoding=encoding)
+    bytes_in.inc(size_in, transport=transport, encoding=encoding)
+    bytes_out.inc(size_out, transport=transport, encoding=encoding)
+
+
+# HTTP
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(settings.gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        flush = zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+        return self.compressor.compress(data) + self.compressor.flush(flush)
+
+
+class BrotliEncoder:
+    name = "br"
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=settings.brotli_quality)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        data = self.compressor.process(data)
+        return data + (self.compressor.finish() if final else self.compressor.flush())
+
+
+def accepted_encodings(header: str):
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+def choose_encoder(accept_encoding: str):
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return BrotliEncoder
+    if accepted.get("gzip", 0) > 0:
+        return GzipEncoder
+    return None
+
+
+def is_compressible(headers: Headers) -> bool:
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    return (
+        content_type.startswith("text/")
+        or content_type.endswith("+json")
+        or content_type in COMPRESSIBLE_TYPES
+    )
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: Optional[int] = None):
+        self.app = app
+        self.minimum_size = (
+            settings.http_compress_min_size if minimum_size is None else minimum_size
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoder = choose_encoder(Headers(scope=scope).get("accept-encoding", ""))
+        if encoder is None:
+            await self.app(scope, receive, send)
+            return
+        responder = CompressingResponder(send, encoder, self.minimum_size)
+        await self.app(scope, receive, responder)
+
+
+class CompressingResponder:
+    def __init__(self, send, encoder, minimum_size):
+        self.send = send
+        self.encoder_class = encoder
+        self.encoder = None
+        self.minimum_size = minimum_size
+        self.start = None
+        # None until the first body message decides it
+        self.compressing = None
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.start = message
+            if (
+                "content-encoding" in headers
+                or "content-range" in headers
+                or "accept-ranges" in headers
+                or not is_compressible(headers)
+            ):
+                self.compressing = False
+                await self.send(message)
+            return
+
+        if message["type"] != "http.response.body" or self.compressing is False:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressing is None:
+            if not more_body and len(body) < self.minimum_size:
+                self.compressing = False
+                skipped.inc(transport="http", reason="small")
+                await self.send(self.start)
+                await self.send(message)
+                return
+
+            self.compressing = True
+            self.encoder = self.encoder_class()
+            headers = MutableHeaders(raw=self.start["headers"])
+            headers["Content-Encoding"] = self.encoder.name
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            if not more_body:
+                data = self.compress(body, final=True)
+                headers["Content-Length"] = str(len(data))
+                await self.send(self.start)
+                await self.send({"type": "http.response.body", "body": data})
+                return
+            await self.send(self.start)
+
+        data = self.compress(body, final=not more_body)
+        await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    def compress(self, body: bytes, final: bool) -> bytes:
+        started = time.thread_time()
+        data = self.encoder.compress(body, final)
+        record("http", self.encoder.name, len(body), len(data), started)
+        return data
+
+
+# WebSocket
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that sends messages below ``min_size`` uncompressed.
+
+    RFC 7692 lets every message choose: an unset RSV1 bit means the
+    payload isn't compressed, and the compression context is untouched.
+    """
+
+    def __init__(self, *args, min_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        # Only whole, unfragmented messages can be skipped
+        if frame.fin and frame.opcode is not frames.OP_CONT and len(frame.data) < self.min_size:
+            skipped.inc(transport="ws", reason="small")
+            return frame
+        started = time.thread_time()
+        encoded = super().encode(frame)
+        record("ws", "deflate", len(frame.data), len(encoded.data), started)
+        return encoded
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+def deflate_factory():
+    return ThresholdPerMessageDeflateFactory(
+        min_size=settings.ws_compress_min_size,
+        server_max_window_bits=settings.ws_deflate_window_bits,
+        compress_settings={
+            "level": settings.ws_deflate_level,
+            "memLevel": settings.ws_deflate_mem_level,
+        },
+    )
+
+
+class CompressedWebSocketProtocol(WebSocketProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate and settings.ws_deflate:
+            self.available_extensions = [deflate_factory()]
+        else:
+            self.available_extensions = []
+        self.compression_opt_out = False
+
+    async def process_request(self, path, headers):
+        query = parse_qs(path.partition("?")[2])
+        self.compression_opt_out = query.get("compress", [""])[-1] in ("0", "false", "no")
+        return await super().process_request(path, headers)
+
+    def process_extensions(self, headers, available_extensions):
+        # Called by the handshake right after process_request
+        if self.compression_opt_out:
+            skipped.inc(transport="ws", reason="opt_out")
+            available_extensions = []
+        return super().process_extensions(headers, available_extensions)
@@ -1,17 +1,126 @@
-from sqlalchemy.orm import joinedload
+import logging
+from datetime import datetime
 
+import orjson
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import selectinload
 
-def fetch_data_with_relations(db, model, relations=None):
-    query = db.query(model)
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def row_with_relations(item, relations=None):
+    row = item.as_dict()
+    for relation in relations or ():
+        related = getattr(item, relation.key)
+        if isinstance(related, list):
+            row[relation.key] = [child.as_dict() for child in related]
+        else:
+            row[relation.key] = related.as_dict() if related is not None else None
+    return row
+
+
+def iter_data_with_relations(
+    db, model, relations=None, filters=(), batch_size=EXPORT_BATCH_SIZE
+):
+    """Yield ``as_dict()`` rows, relations included, without loading the table.
+
+    Without relations the rows come from a server-side cursor, ``batch_size``
+    at a time. With relations the table is walked in primary key order, one
+    ``LIMIT batch_size`` query per batch, and each batch loads its relations
+    with one SELECT ... IN. An open streaming cursor would block those
+    queries on MySQL. Either way only one batch is in memory at a time.
+    """
+    query = db.query(model).filter(*filters)
+
+    if not relations:
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        for item in query:
+            yield item.as_dict()
+        return
+
+    (key,) = model.__table__.primary_key.columns
+    key = getattr(model, key.key)
+    query = query.options(*[selectinload(relation) for relation in relations])
+    last = None
+    while True:
+        batch = query
+        if last is not None:
+            batch = batch.filter(key > last)
+        items = batch.order_by(key).limit(batch_size).all()
+        if not items:
+            return
+        for item in items:
+            yield row_with_relations(item, relations)
+        last = getattr(items[-1], key.key)
+        # Nothing from this batch is needed any more
+        db.expunge_all()
 
-    if relations:
-        # Use joinedload to eager load the specified relations
-        query = query.options(*[joinedload(relation) for relation in relations])
 
-    result = query.all()
+def changed_fields(before: dict, after: dict, ignore=()) -> dict:
+    """Columns whose value differs between two ``as_dict()`` snapshots."""
+    return {
+        key: value
+        for key, value in after.items()
+        if key not in ignore and before.get(key) != value
+    }
 
-    # Convert the SQLAlchemy objects to dictionaries
-    data = [item.as_dict() for item in result]
 
-    print("################################################: ", data)
+def local_naive(moment: datetime) -> datetime:
+    # Rows are stamped with naive local time, times sent with "Z" or an
+    # offset are converted to match
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def fetch_data_with_relations(db, model, relations=None):
+    data = list(iter_data_with_relations(db, model, relations))
+    logger.debug("fetched %d %s rows", len(data), model.__name__)
     return data
+
+
+def ndjson_batches(rows, batch_size=EXPORT_BATCH_SIZE):
+    """Encode rows as NDJSON, one bytes chunk per ``batch_size`` rows."""
+    chunk = []
+    for row in rows:
+        chunk.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+        if len(chunk) >= batch_size:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+
+def upsert(db, model, values, index_elements, update_columns, increment_columns=()):
+    # Single-statement INSERT ... ON DUPLICATE KEY / ON CONFLICT UPDATE.
+    # ``values`` is one row or a list of rows, ``increment_columns`` are
+    # added to the existing row instead of replacing it.
+    dialect = db.get_bind().dialect.name
+    table = model.__table__
+
+    if dialect == "mysql":
+        stmt = mysql.insert(model).values(values)
+        proposed = stmt.inserted
+        stmt = stmt.on_duplicate_key_update(
+            {
+                **{column: proposed[column] for column in update_columns},
+                **{column: table.c[column] + proposed[column] for column in increment_columns},
+            }
+        )
+    elif dialect in ("sqlite", "postgresql"):
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = insert(model).values(values)
+        proposed = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={
+                **{column: proposed[column] for column in update_columns},
+                **{column: table.c[column] + proposed[column] for column in increment_columns},
+            },
+        )
+    else:
+        raise NotImplementedError(f"upsert is not supported on {dialect}")
+
+    return db.execute(stmt)
@@ -0,0 +1,246 @@
+"""Write-through cache of the chats people keep opening.
+
+``GET /chats/{chat_ref}`` returns a chat with its newest messages. For a
+busy group chat that is the same answer thousands of times a day. The
+cache keeps the chat and its newest ``HOT_CHAT_MESSAGES`` messages
+already encoded as JSON, and a hit is answered without touching the
+database.
+
+- Entries form an LRU capped at ``HOT_CHAT_CACHE_BYTES`` of encoded JSON.
+- Writes go through. Message and reaction writes patch the cached copy
+  once they commit. Chat updates and member changes drop it.
+- ``HOT_CHAT_TTL`` bounds how long an entry lives, as a backstop for
+  writes that don't go through the routers.
+- Like the /ws connection manager, the cache is per process. A write
+  only patches the worker that served it. Other workers keep answering
+  from their copy until it expires, so with several workers a chat can
+  be up to ``HOT_CHAT_TTL`` seconds (300) stale there.
+- A miss fills the cache from the request's session. A fill is skipped
+  when the chat was written after the load started. On a replica it is
+  also skipped when the chat was written within
+  ``READ_YOUR_WRITES_SECONDS``, since the replica may not have the write
+  yet. Writers read from the primary for that long, so busy chats are
+  still filled.
+- Hits and misses are on /metrics as ``hot_chat_cache_requests_total``.
+"""
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import orjson
+from cachetools import TTLCache
+
+from config import settings
+import metrics
+import models, schemas
+
+# Loaded beyond HOT_CHAT_MESSAGES so deletes don't empty the entry
+SPARE_MESSAGES = 20
+
+lookups = metrics.Counter(
+    "hot_chat_cache_requests_total", "Chat opens by cache result", ["result"]
+)
+
+
+class HotChat:
+    __slots__ = ("chat", "messages", "complete")
+
+    def __init__(self, chat: bytes, messages: List[Tuple[int, bytes]], complete: bool):
+        # The chat without its messages, as a JSON object
+        self.chat = chat
+        # (id, JSON) of the newest messages, newest first
+        self.messages = messages
+        # Whether these are all of the chat's messages
+        self.complete = complete
+
+    def size(self) -> int:
+        return len(self.chat) + sum(len(encoded) for _, encoded in self.messages)
+
+    def render(self, limit: int) -> bytes:
+        messages = b",".join(encoded for _, encoded in self.messages[:limit])
+        return self.chat[:-1] + b',"messages":[' + messages + b"]}"
+
+    def index(self, message_id: int) -> Optional[int]:
+        for position, (cached_id, _) in enumerate(self.messages):
+            if cached_id == message_id:
+                return position
+        return None
+
+
+def encode_message(payload: dict) -> Tuple[int, bytes]:
+    return int(payload["id"]), orjson.dumps(payload)
+
+
+def message_payload(db_message: models.Message, reactions: list) -> dict:
+    # From the columns, so serializing doesn't lazy-load the reactions
+    return schemas.Message.model_validate(
+        {**db_message.as_dict(), "reactions": reactions}
+    ).model_dump(mode="json")
+
+
+class HotChatCache:
+    def __init__(self, max_bytes: int, messages_per_chat: int, ttl: float):
+        self.limit = messages_per_chat
+        self.entries: TTLCache = TTLCache(
+            maxsize=max(max_bytes, 1), ttl=ttl, getsizeof=HotChat.size
+        )
+        self.enabled = max_bytes > 0
+        # chat_ref -> chat id, names and ids as clients sent them
+        self.refs: TTLCache = TTLCache(maxsize=10_000, ttl=ttl)
+        # chat id -> time.monotonic() of its last write
+        self.written: TTLCache = TTLCache(
+            maxsize=100_000, ttl=max(settings.read_your_writes_seconds, 1)
+        )
+        self.lock = threading.Lock()
+
+    @property
+    def load_limit(self) -> int:
+        return self.limit + SPARE_MESSAGES
+
+    def get(self, chat_ref: str) -> Optional[bytes]:
+        with self.lock:
+            chat_id = self.refs.get(chat_ref)
+            entry = self.entries.get(chat_id) if chat_id is not None else None
+            rendered = entry.render(self.limit) if entry is not None else None
+        lookups.inc(result="miss" if rendered is None else "hit")
+        return rendered
+
+    def fill(
+        self,
+        chat_ref: str,
+        chat: models.Chat,
+        messages: List[models.Message],
+        started: float,
+        primary: bool,
+    ) -> bytes:
+        """Encode a chat loaded after ``started`` and keep it if it is still current.
+
+        ``chat.messages`` must already hold the messages to return.
+        """
+        payload = schemas.Chat.model_validate(chat).model_dump(mode="json")
+        del payload["messages"]
+        entry = HotChat(
+            orjson.dumps(payload),
+            [
+                encode_message(schemas.Message.model_validate(message).model_dump(mode="json"))
+                for message in messages
+            ],
+            complete=len(messages) < self.load_limit,
+        )
+        if self.enabled:
+            lag = 0 if primary else settings.read_your_writes_seconds
+            with self.lock:
+                if self.written.get(chat.id, float("-inf")) < started - lag:
+                    self.store(chat.id, entry)
+                    self.refs[chat_ref] = chat.id
+        return entry.render(self.limit)
+
+    def touch(self, chat_id: int) -> Optional[HotChat]:
+        # Called with the lock held
+        self.written[chat_id] = time.monotonic()
+        return self.entries.get(chat_id)
+
+    def store(self, chat_id: int, entry: HotChat):
+        # Called with the lock held, storing again re-measures the entry
+        if not entry.complete and len(entry.messages) < self.limit:
+            # Deletes ate into the messages we'd return, reload instead
+            self.entries.pop(chat_id, None)
+            return
+        try:
+            self.entries[chat_id] = entry
+        except ValueError:
+            # Larger than the whole cache
+            self.entries.pop(chat_id, None)
+
+    def message_created(self, db_message: models.Message):
+        encoded = encode_message(message_payload(db_message, []))
+        with self.lock:
+            entry = self.touch(db_message.chat_id)
+            # A fill that loaded after the commit already has it
+            if entry is None or entry.index(db_message.id) is not None:
+                return
+            entry.messages.insert(0, encoded)
+            if len(entry.messages) > self.load_limit:
+                entry.messages.pop()
+                entry.complete = False
+            self.store(db_message.chat_id, entry)
+
+    def message_updated(self, db_message: models.Message, before_chat_id: int):
+        with self.lock:
+            if before_chat_id != db_message.chat_id:
+                # Moved between chats, reload both rather than work out the order
+                for chat_id in (before_chat_id, db_message.chat_id):
+                    self.touch(chat_id)
+                    self.entries.pop(chat_id, None)
+                return
+            entry = self.touch(db_message.chat_id)
+            position = entry.index(db_message.id) if entry is not None else None
+            if position is None:
+                return
+            reactions = orjson.loads(entry.messages[position][1])["reactions"]
+            entry.messages[position] = encode_message(message_payload(db_message, reactions))
+            self.store(db_message.chat_id, entry)
+
+    def message_deleted(self, chat_id: int, message_id: int):
+        with self.lock:
+            entry = self.touch(chat_id)
+            position = entry.index(message_id) if entry is not None else None
+            if position is None:
+                return
+            del entry.messages[position]
+            self.store(chat_id, entry)
+
+    def reply_count_changed(self, chat_id: int, parent_id: int, delta: int, modified_at):
+        with self.lock:
+            entry = self.touch(chat_id)
+            position = entry.index(parent_id) if entry is not None else None
+            if position is None:
+                return
+            payload = orjson.loads(entry.messages[position][1])
+            payload["reply_count"] = max(payload.get("reply_count", 0) + delta, 0)
+            payload["last_modified_at"] = modified_at.isoformat()
+            entry.messages[position] = encode_message(payload)
+            self.store(chat_id, entry)
+
+    def reactions_changed(self, db, chat_id: int, message_id: int, counts: dict):
+        """Re-read one message's reactions, only if its chat is cached."""
+        with self.lock:
+            entry = self.touch(chat_id)
+            if entry is None or entry.index(message_id) is None:
+                return
+        reactions = [
+            schemas.MessageReaction.model_validate(reaction).model_dump(mode="json")
+            for reaction in db.query(models.MessageReaction).filter(
+                models.MessageReaction.message_id == message_id
+            )
+        ]
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            position = entry.index(message_id) if entry is not None else None
+            if position is None:
+                return
+            payload = orjson.loads(entry.messages[position][1])
+            payload["reactions"] = reactions
+            payload["reaction_counts"] = counts
+            entry.messages[position] = encode_message(payload)
+            self.store(chat_id, entry)
+
+    def invalidate(self, chat_id: int):
+        with self.lock:
+            self.touch(chat_id)
+            self.entries.pop(chat_id, None)
+            for ref in [ref for ref, cached_id in self.refs.items() if cached_id == chat_id]:
+                del self.refs[ref]
+
+
+hot_chats = HotChatCache(
+    settings.hot_chat_cache_bytes, settings.hot_chat_messages, settings.hot_chat_ttl
+)
+cached_bytes = metrics.Gauge(
+    "hot_chat_cache_bytes",
+    "Encoded JSON held by the hot chat cache",
+    function=lambda: hot_chats.entries.currsize,
+)
+cached_chats = metrics.Gauge(
+    "hot_chat_cache_chats", "Chats in the hot chat cache", function=lambda: len(hot_chats.entries)
+)
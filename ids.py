@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+# Snowflake-style 63 bit ids, ordered by creation time:
+#   41 bits milliseconds since EPOCH_MS | 10 bits worker | 12 bits sequence
+# That is ~69 years of ids at up to 4096 per millisecond per worker, stored
+# as BIGINT. JavaScript numbers can't hold them exactly, so the API sends
+# them as strings.
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Workers 1022 and 1023 are reserved for the 0004 migration's backfill and
+# trigger, app processes must use 0-1021.
+RESERVED_WORKERS = (1022, 1023)
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER}")
+        self.worker_id = worker_id
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self.lock:
+            now = int(time.time() * 1000) - EPOCH_MS
+            # Never go backwards, even if the wall clock does
+            if now <= self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    self.last_ms += 1
+            else:
+                self.last_ms = now
+                self.sequence = 0
+            return (
+                (self.last_ms << (WORKER_BITS + SEQUENCE_BITS))
+                | (self.worker_id << SEQUENCE_BITS)
+                | self.sequence
+            )
+
+
+def compose_id(ms: int, worker_id: int, sequence: int) -> int:
+    return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def id_timestamp_ms(message_id: int) -> int:
+    return (message_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS
+
+
+def pid_worker_id() -> int:
+    # Only distinct between processes on the same host, and not always
+    # there. main.py requires MESSAGE_ID_WORKER unless the database is
+    # SQLite, which is one box by definition.
+    return os.getpid() % RESERVED_WORKERS[0]
+
+
+generator = SnowflakeGenerator(pid_worker_id())
+
+
+def set_worker_id(worker_id: int):
+    global generator
+    if worker_id in RESERVED_WORKERS:
+        raise ValueError(f"worker ids {RESERVED_WORKERS} are reserved for migrations")
+    generator = SnowflakeGenerator(worker_id)
+
+
+def next_id() -> int:
+    return generator.next_id()
@@ -0,0 +1,381 @@
+"""Background jobs: chunked deletes and retention.
+
+Deleting a chat or a user in one transaction means cascading through
+every message, reaction and attachment it owns. That holds row locks and
+undo for the whole set while people are chatting. Instead, the delete
+endpoints queue a job, and a thread in each app process works through it:
+
+- The endpoint hides the target first: a deleted chat no longer
+  resolves, a deleted user is disabled and can't write.
+- The job runs as a list of steps, e.g. a chat's members, then its
+  messages with their reactions and attachments, then the chat row.
+  Before the chat or user row goes, every earlier step is checked again
+  and the job starts over if anything was written behind it.
+- Each step deletes ``JOB_BATCH_SIZE`` rows at a time in primary-key
+  order. Every batch is its own short transaction, with
+  ``JOB_BATCH_SLEEP`` seconds between batches so replicas and the app
+  keep up.
+- After every batch the step, the last key and the row count are saved
+  on the ``jobs`` row. A job stopped by a restart or a crash carries on
+  from there, in whichever process claims it next.
+- A running job is leased and renewed per batch, so two processes never
+  work on the same job.
+
+Retention runs as the same kind of job every
+``RETENTION_INTERVAL_HOURS``. It removes messages older than
+``MESSAGE_RETENTION_DAYS`` (off by default), tombstones older than
+``TOMBSTONE_RETENTION_DAYS`` and expired refresh tokens. Messages and
+reactions removed from a chat that stays, by retention or a user purge,
+leave tombstones so /sync clients drop them too. Blobs that no
+attachment refers to any more are removed from disk as their last
+attachment row goes.
+
+Follow a job with ``GET /jobs/{id}``. Rows deleted show up on /metrics as
+``job_rows_deleted_total``.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import or_
+
+from config import SessionLocal, settings
+from hot_chats import hot_chats
+from ids import EPOCH_MS, compose_id
+from models import (
+    Attachment,
+    Chat,
+    ChatMember,
+    Job,
+    Message,
+    MessageReaction,
+    NotificationSummary,
+    RefreshToken,
+    ReplyShortcut,
+    Tombstone,
+    User,
+)
+from services import change_reply_count, refresh_reaction_counts
+from storage import blob_path
+import lifecycle
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(seconds=60)
+# A blob written this recently may belong to an upload that hasn't saved
+# its attachment row yet
+BLOB_GRACE_SECONDS = 300
+
+rows_deleted = metrics.Counter(
+    "job_rows_deleted_total", "Rows removed by background jobs", ["kind", "step"]
+)
+jobs_finished = metrics.Counter("jobs_finished_total", "Background jobs by outcome", ["kind", "state"])
+
+
+def first_id_at(moment: datetime) -> int:
+    # Message ids are time ordered, see ids.py
+    return compose_id(max(int(moment.timestamp() * 1000) - EPOCH_MS, 0), 0, 0)
+
+
+# The row a purge removes last, once nothing references it
+PARENT_STEPS = {"purge_chat": ["chat"], "purge_user": ["user"]}
+
+
+def steps(job: Job):
+    """``(name, model, condition)`` for each step of ``job``, in order."""
+    if job.kind == "purge_chat":
+        return [
+            ("chat_members", ChatMember, ChatMember.chat_id == job.target_id),
+            ("notifications", NotificationSummary, NotificationSummary.chat_id == job.target_id),
+            ("messages", Message, Message.chat_id == job.target_id),
+            ("tombstones", Tombstone, Tombstone.chat_id == job.target_id),
+            ("chat", Chat, Chat.id == job.target_id),
+        ]
+    if job.kind == "purge_user":
+        return [
+            ("reply_shortcuts", ReplyShortcut, ReplyShortcut.user_id == job.target_id),
+            ("reactions", MessageReaction, MessageReaction.user_id == job.target_id),
+            ("chat_members", ChatMember, ChatMember.user_id == job.target_id),
+            ("notifications", NotificationSummary, NotificationSummary.user_id == job.target_id),
+            ("refresh_tokens", RefreshToken, RefreshToken.user_id == job.target_id),
+            ("messages", Message, Message.sender_id == job.target_id),
+            ("user", User, User.id == job.target_id),
+        ]
+    if job.kind == "retention":
+        found = []
+        now = datetime.now()
+        if settings.message_retention_days:
+            cutoff = now - timedelta(days=settings.message_retention_days)
+            found.append(("messages", Message, Message.id < first_id_at(cutoff)))
+        if settings.tombstone_retention_days:
+            cutoff = now - timedelta(days=settings.tombstone_retention_days)
+            found.append(("tombstones", Tombstone, Tombstone.deleted_at < cutoff))
+        found.append(("refresh_tokens", RefreshToken, RefreshToken.expires_at < now))
+        return found
+    raise ValueError(f"Unknown job kind {job.kind}")
+
+
+def leftovers(db, child_steps) -> bool:
+    return any(
+        db.query(model.id).filter(condition).first() is not None
+        for _, model, condition in child_steps
+    )
+
+
+def delete_messages(db, job: Job, ids: List[int]) -> Tuple[set, set]:
+    """Delete messages with their reactions and attachments, uncommitted.
+
+    Returns the chats touched and the blobs that lost an attachment.
+    """
+    rows = db.query(Message.id, Message.chat_id, Message.parent_message_id).filter(
+        Message.id.in_(ids)
+    ).all()
+    chat_ids = {chat_id for _, chat_id, _ in rows}
+    deleting = set(ids)
+
+    # Replies whose parent stays behind
+    replies = {}
+    for _, chat_id, parent_id in rows:
+        if parent_id is not None and parent_id not in deleting:
+            replies[chat_id, parent_id] = replies.get((chat_id, parent_id), 0) + 1
+    for (chat_id, parent_id), count in replies.items():
+        change_reply_count(db, chat_id, parent_id, -count)
+
+    blobs = {
+        sha256
+        for (sha256,) in db.query(Attachment.sha256).filter(Attachment.message_id.in_(ids))
+    }
+    db.query(Attachment).filter(Attachment.message_id.in_(ids)).delete(synchronize_session=False)
+    if job.kind != "purge_chat":
+        # The chats stay, their members sync the messages away
+        tombstone_reactions(db, MessageReaction.message_id.in_(ids))
+        db.add_all(
+            Tombstone(
+                kind="message",
+                object_id=str(message_id),
+                message_id=str(message_id),
+                chat_id=chat_id,
+                deleted_at=datetime.now(),
+            )
+            for message_id, chat_id, _ in rows
+        )
+    db.query(MessageReaction).filter(MessageReaction.message_id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    db.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    return chat_ids, blobs
+
+
+def tombstone_reactions(db, condition):
+    """Add a tombstone for each reaction matching ``condition``, uncommitted."""
+    rows = db.query(MessageReaction.id, MessageReaction.message_id, Message.chat_id).join(
+        Message, Message.id == MessageReaction.message_id
+    ).filter(condition)
+    db.add_all(
+        Tombstone(
+            kind="reaction",
+            object_id=str(reaction_id),
+            message_id=str(message_id),
+            chat_id=chat_id,
+            deleted_at=datetime.now(),
+        )
+        for reaction_id, message_id, chat_id in rows
+    )
+
+
+def delete_reactions(db, ids: List[int]) -> set:
+    rows = db.query(MessageReaction.message_id, Message.chat_id).join(
+        Message, Message.id == MessageReaction.message_id
+    ).filter(MessageReaction.id.in_(ids)).distinct().all()
+    tombstone_reactions(db, MessageReaction.id.in_(ids))
+    db.query(MessageReaction).filter(MessageReaction.id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    for message_id, _ in rows:
+        refresh_reaction_counts(db, message_id)
+    return {chat_id for _, chat_id in rows}
+
+
+def remove_unused_blobs(db, blobs: set):
+    if not blobs:
+        return
+    used = {
+        sha256
+        for (sha256,) in db.query(Attachment.sha256).filter(Attachment.sha256.in_(blobs)).distinct()
+    }
+    for sha256 in blobs - used:
+        path = blob_path(sha256)
+        try:
+            if time.time() - os.path.getmtime(path) > BLOB_GRACE_SECONDS:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def run_batch(db, job: Job) -> bool:
+    """Delete one batch of ``job``'s current step and commit. False once done."""
+    remaining = steps(job)
+    names = [name for name, _, _ in remaining]
+    if job.step not in names:
+        job.step, job.cursor = (names[0], None) if names else (None, None)
+    if job.step is None:
+        return False
+    name, model, condition = remaining[names.index(job.step)]
+
+    query = db.query(model.id).filter(condition)
+    if job.cursor is not None:
+        query = query.filter(model.id > job.cursor)
+    ids = [key for (key,) in query.order_by(model.id).limit(settings.job_batch_size)]
+
+    chat_ids, blobs = set(), set()
+    if not ids:
+        position = names.index(name) + 1
+        if PARENT_STEPS.get(job.kind) == names[position:position + 1] and leftovers(
+            db, remaining[:position]
+        ):
+            # Rows written behind the job, e.g. by a request that resolved
+            # the target just before it was marked deleted. Sweep again, the
+            # parent row can't go while they reference it.
+            position = 0
+        job.step, job.cursor = (names[position], None) if position < len(names) else (None, None)
+    else:
+        if model is Message:
+            chat_ids, blobs = delete_messages(db, job, ids)
+        elif model is MessageReaction:
+            chat_ids = delete_reactions(db, ids)
+        else:
+            db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        job.cursor = ids[-1]
+        job.processed += len(ids)
+        rows_deleted.inc(len(ids), kind=job.kind, step=name)
+
+    job.lease_until = datetime.now() + LEASE
+    db.commit()
+    for chat_id in chat_ids:
+        hot_chats.invalidate(chat_id)
+    remove_unused_blobs(db, blobs)
+    return job.step is not None
+
+
+def enqueue(db, kind: str, target_id: Optional[int] = None) -> Job:
+    """Queue a job, or return the one already queued for the same target."""
+    existing = (
+        db.query(Job)
+        .filter(Job.kind == kind, Job.target_id == target_id, Job.state.in_(("pending", "running")))
+        .first()
+    )
+    if existing:
+        return existing
+    job = Job(kind=kind, target_id=target_id, state="pending", processed=0)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def schedule_retention(db):
+    since = datetime.now() - timedelta(hours=settings.retention_interval_hours)
+    recent = (
+        db.query(Job.id)
+        .filter(Job.kind == "retention", or_(Job.created_at > since, Job.state.in_(("pending", "running"))))
+        .first()
+    )
+    if recent is None:
+        enqueue(db, "retention")
+
+
+def claim(db) -> Optional[int]:
+    """Lease the oldest job nobody is working on, return its id."""
+    now = datetime.now()
+    free = or_(Job.lease_until.is_(None), Job.lease_until < now)
+    candidate = (
+        db.query(Job.id)
+        .filter(Job.state.in_(("pending", "running")), free)
+        .order_by(Job.id)
+        .first()
+    )
+    if candidate is None:
+        return None
+    claimed = (
+        db.query(Job)
+        .filter(Job.id == candidate.id, free)
+        .update({"state": "running", "lease_until": now + LEASE}, synchronize_session=False)
+    )
+    db.commit()
+    return candidate.id if claimed else None
+
+
+class JobRunner:
+    def __init__(self):
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="jobs", daemon=True)
+            self.thread.start()
+
+    def stop(self, deadline: float):
+        """Finish the current batch and stop, the job resumes elsewhere."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(max(deadline - time.monotonic(), 0))
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                db = SessionLocal()
+                try:
+                    schedule_retention(db)
+                    job_id = claim(db)
+                finally:
+                    db.close()
+                if job_id is None:
+                    self.stopping.wait(settings.job_poll_interval)
+                else:
+                    self.work(job_id)
+            except Exception:
+                logger.exception("job runner failed")
+                self.stopping.wait(settings.job_poll_interval)
+
+    def work(self, job_id: int):
+        started = time.monotonic()
+        while not self.stopping.is_set():
+            db = SessionLocal()
+            try:
+                job = db.query(Job).filter(Job.id == job_id).first()
+                try:
+                    more = run_batch(db, job)
+                except Exception as e:
+                    db.rollback()
+                    logger.exception("job failed", extra={"job_id": job_id, "kind": job.kind})
+                    job.state, job.error, job.finished_at = "failed", repr(e)[:2000], datetime.now()
+                    job.lease_until = None
+                    db.commit()
+                    jobs_finished.inc(kind=job.kind, state="failed")
+                    return
+                if not more:
+                    job.state, job.finished_at, job.lease_until = "done", datetime.now(), None
+                    db.commit()
+                    jobs_finished.inc(kind=job.kind, state="done")
+                    logger.info(
+                        "job done",
+                        extra={
+                            "job_id": job_id,
+                            "kind": job.kind,
+                            "processed": job.processed,
+                            "seconds": round(time.monotonic() - started, 3),
+                        },
+                    )
+                    return
+            finally:
+                db.close()
+            self.stopping.wait(settings.job_batch_sleep)
+
+
+runner = JobRunner()
+lifecycle.on_drain(runner.stop)
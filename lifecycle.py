@@ -0,0 +1,96 @@
+"""Graceful drain for rolling restarts.
+
+``drain()`` runs once per process:
+
+1. ``draining`` turns on. ``GET /health`` answers 503 so the load
+   balancer stops routing here, new /ws connections are closed with 1012
+   and HTTP keeps being served.
+2. The ``on_drain`` hooks run in registration order. They flush buffered
+   writes and close sockets. The /ws hook tells every client to reconnect
+   after a random delay, so they come back spread out rather than all at
+   once.
+3. Everything has to finish within ``DRAIN_TIMEOUT`` seconds. Hooks
+   still running then are cancelled and shutdown goes ahead.
+
+``DrainingServer`` drains before uvicorn's own shutdown, which would
+otherwise drop every socket with 1012 straight away. ``python main.py``
+runs it through ``serve()``. Under another process manager, call ``POST /admin/drain`` from
+localhost (e.g. a preStop hook) before sending SIGTERM.
+"""
+import asyncio
+import inspect
+import logging
+import random
+import time
+from typing import Callable, List
+
+import uvicorn
+from starlette.concurrency import run_in_threadpool
+from uvicorn.supervisors import ChangeReload
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+draining = False
+hooks: List[Callable] = []
+_drained = None
+
+
+def reconnect_after_ms() -> int:
+    """A random reconnect delay, so clients don't all come back at once."""
+    return random.randint(settings.drain_reconnect_min_ms, settings.drain_reconnect_max_ms)
+
+
+def on_drain(hook: Callable):
+    """Register ``hook(deadline)`` to run on drain, sync or async.
+
+    ``deadline`` is a ``time.monotonic()`` value the hook should finish by.
+    """
+    hooks.append(hook)
+    return hook
+
+
+async def _run_hooks(deadline: float):
+    for hook in hooks:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning("drain deadline reached, skipping %s", hook.__qualname__)
+            continue
+        try:
+            if inspect.iscoroutinefunction(hook):
+                await asyncio.wait_for(hook(deadline), remaining)
+            else:
+                await asyncio.wait_for(run_in_threadpool(hook, deadline), remaining)
+        except asyncio.TimeoutError:
+            logger.warning("drain hook %s ran past the deadline", hook.__qualname__)
+        except Exception:
+            logger.exception("drain hook %s failed", hook.__qualname__)
+
+
+async def drain(timeout: float = None):
+    """Drain the process, only the first call does the work."""
+    global draining, _drained
+    if _drained is None:
+        draining = True
+        timeout = settings.drain_timeout if timeout is None else timeout
+        logger.info("draining", extra={"timeout": timeout})
+        _drained = asyncio.ensure_future(_run_hooks(time.monotonic() + timeout))
+    await asyncio.shield(_drained)
+
+
+class DrainingServer(uvicorn.Server):
+    async def shutdown(self, sockets=None):
+        await drain()
+        await super().shutdown(sockets=sockets)
+
+
+def serve(app: str, **kwargs):
+    """``uvicorn.run`` for a single process with a ``DrainingServer``."""
+    kwargs.setdefault("timeout_graceful_shutdown", int(settings.drain_timeout))
+    config = uvicorn.Config(app, **kwargs)
+    server = DrainingServer(config)
+    if config.should_reload:
+        ChangeReload(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
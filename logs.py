@@ -0,0 +1,171 @@
+"""Structured logging that stays off the request and event loop paths.
+
+``setup_logging()`` puts a ``QueueHandler`` on the root logger. Records
+are only truncated and queued in the calling thread; a ``QueueListener``
+thread formats them as one JSON object per line and writes them to
+stdout. When the queue is full records are dropped and counted
+(``log_records_dropped_total`` on /metrics) rather than blocking.
+
+Settings, from the environment through ``config.settings``:
+
+- ``LOG_LEVEL``: root level, default ``INFO``.
+- ``LOG_SAMPLE``: keep only a fraction of the records below WARNING from
+  a logger and its children, separated by commas. Defaults to
+  ``routers.websocket.frames=0.01``, one in a hundred received frames.
+- ``LOG_MAX_CHARS``: longest message or field value kept, default 2000.
+- ``LOG_QUEUE_SIZE``: records buffered for the writer, default 10000.
+
+Pass structured fields with ``extra``::
+
+    logger.info("frame received", extra={"frame_type": data.get("type")})
+"""
+import logging
+import logging.handlers
+import queue
+import random
+import reprlib
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import orjson
+
+from config import settings
+import metrics
+
+LOG_LEVEL = settings.log_level.upper()
+LOG_SAMPLE = settings.log_sample
+LOG_MAX_CHARS = settings.log_max_chars
+LOG_QUEUE_SIZE = settings.log_queue_size
+
+dropped = metrics.Counter("log_records_dropped_total", "Log records dropped on a full queue")
+sampled_out = metrics.Counter(
+    "log_records_sampled_out_total", "Log records skipped by sampling", ["logger"]
+)
+
+# Attributes every LogRecord has, anything else came in through ``extra``
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_repr = reprlib.Repr()
+_repr.maxstring = LOG_MAX_CHARS
+_repr.maxother = LOG_MAX_CHARS
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxdict = 20
+_repr.maxlevel = 3
+
+
+def truncate(value, limit: int = LOG_MAX_CHARS):
+    """Cut strings down to ``limit`` and turn anything else into a bounded repr.
+
+    ``reprlib`` stops walking containers early, so logging a large result
+    set doesn't build its full repr first.
+    """
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    if not isinstance(value, str):
+        value = _repr.repr(value)
+    if len(value) > limit:
+        return f"{value[:limit]}... ({len(value)} chars)"
+    return value
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records below WARNING from the given loggers."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def rate_for(self, name: str) -> Optional[float]:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        if rate is None or random.random() < rate:
+            return True
+        sampled_out.inc(logger=record.name)
+        return False
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Bound the arguments before they are formatted into the message
+        if isinstance(record.args, tuple):
+            record.args = tuple(truncate(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = {key: truncate(value) for key, value in record.args.items()}
+        for key, value in list(vars(record).items()):
+            if key not in RECORD_ATTRIBUTES:
+                setattr(record, key, truncate(value))
+        record = super().prepare(record)
+        record.msg = record.message = truncate(record.msg)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped.inc()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return orjson.dumps(entry, default=str).decode()
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging():
+    """Route every logger through the background writer. Safe to call twice."""
+    global _listener
+    if _listener is not None:
+        return
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = TruncatingQueueHandler(records)
+    handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE)))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn's own handlers would write from the event loop, send them here
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Flush what is queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,5 +1,6 @@
+import hmac
 from pathlib import Path
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 from sqlalchemy.orm import Session
@@ -11,13 +12,28 @@ from routers import (
     reactions,
     websocket,
     ip_groups,
+    sync,
+    attachments,
+    exports,
+    jobs as job_routes,
 )
-from config import Base, database, engine, SessionLocal
+from config import Base, SQLALCHEMY_DATABASE_URL, database, engine, is_memory_database, SessionLocal, settings
 from fastapi.middleware.cors import CORSMiddleware
+from compression import CompressedWebSocketProtocol, CompressionMiddleware
+import metrics
+import ids
+import jobs
+import lifecycle
+import logs
+from notifications import notifications
+import profiling
+from ratelimit import AdmissionMiddleware
+from migrations.check import check_schema_version
 from services import ensure_default_reply_shortcuts_for_all_users
 
+logs.setup_logging()
+
 app = FastAPI()
-Base.metadata.create_all(bind=engine)
 
 # Configure CORS
 origins = [
@@ -28,6 +44,12 @@ origins = [
     "http://192.168.1.18:3000",
 ]
 
+# The last one added runs first. CORS stays outermost so that 429s from
+# admission control still carry CORS headers.
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -36,18 +58,76 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["Access-Control-Allow-Origin"],
 )
+metrics.instrument_engine(engine)
+profiling.instrument_engine(engine)
 
 
 @app.on_event("startup")
 async def startup():
-    await database.connect()
+    if settings.message_id_worker is not None:
+        ids.set_worker_id(settings.message_id_worker)
+    elif engine.dialect.name != "sqlite":
+        raise RuntimeError(
+            "Set MESSAGE_ID_WORKER to a number from 0 to 1021 that no other app "
+            "process uses, on any host. Two processes with the same one can "
+            "generate the same message id."
+        )
+    if is_memory_database(SQLALCHEMY_DATABASE_URL):
+        # Nothing to migrate in a throwaway database
+        Base.metadata.create_all(bind=engine)
+    else:
+        # Schema changes go through Alembic, see the README
+        check_schema_version(engine)
+    if database is not None:
+        await database.connect()
     db = SessionLocal()
     ensure_default_reply_shortcuts_for_all_users(db)
+    if settings.jobs_enabled:
+        jobs.runner.start()
+    notifications.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await database.disconnect()
+    # Already done under python main.py, this covers the other runners
+    await lifecycle.drain()
+    if database is not None:
+        await database.disconnect()
+    logs.shutdown_logging()
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/health", include_in_schema=False)
+def health():
+    # 503 while draining takes the instance out of the load balancer
+    if lifecycle.draining:
+        return Response("draining", status_code=503)
+    return Response("ok")
+
+
+@app.post("/admin/drain", include_in_schema=False)
+async def admin_drain(request: Request):
+    """For a preStop hook when something other than ``python main.py`` runs the server.
+
+    Drains only the process that receives the request. With several
+    workers behind one port, each one has to be drained on its own.
+    """
+    # A local proxy or sidecar makes every request look like loopback, so
+    # the token is what actually authorizes this
+    token = request.headers.get("X-Admin-Token", "")
+    # As bytes: compare_digest refuses str with non-ASCII characters
+    if not settings.admin_token or not hmac.compare_digest(
+        token.encode(), settings.admin_token.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Not allowed")
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="Only from localhost")
+    await lifecycle.drain()
+    return {"status": "drained"}
 
 
 @app.get("/docs", include_in_schema=False)
@@ -67,10 +147,18 @@ app.include_router(messages.router)
 app.include_router(reactions.router)
 app.include_router(websocket.router)
 app.include_router(ip_groups.router)
+app.include_router(sync.router)
+app.include_router(attachments.router)
+app.include_router(exports.router)
+app.include_router(job_routes.router)
 
 
 # Run
 if __name__ == "__main__":
-    import uvicorn
-
-    uvicorn.run(f"{Path(__file__).stem}:app", host="0.0.0.0", port=8000, reload=True)
+    lifecycle.serve(
+        f"{Path(__file__).stem}:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        ws=CompressedWebSocketProtocol,
+    )
@@ -0,0 +1,267 @@
+"""In-process metrics in the Prometheus text format, served on /metrics.
+
+Counters, gauges and histograms live in one registry per process. When
+running several uvicorn workers each one reports its own numbers, so
+scrape them per worker or sum them in Prometheus.
+
+``MetricsMiddleware`` times every request, and ``instrument_engine``
+attributes SQL statements and time to the request that ran them. Pass
+``InstrumentedQueuePool`` as the engine's pool class to see how long
+requests wait for a database connection.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def format_labels(self, key: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f"{self.name}{self.format_labels(key)} {value}" for key, value in values.items()
+        ]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from ``function`` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.function is not None:
+            return self.header() + [f"{self.name} {self.function()}"]
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f"{self.name}{self.format_labels(key)} {value}" for key, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # key -> ([count per bucket..., +Inf], sum)
+        self.values: Dict[Tuple[str, ...], Tuple[list, float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = self.header()
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{self.format_labels(key, {'le': le})} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list = []
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# HTTP
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests by route and status code", ["method", "route", "status"]
+)
+http_latency = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route"]
+)
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests being served")
+
+# Database
+
+db_queries = Histogram(
+    "db_queries_per_request", "SQL statements run per request", ["route"], buckets=COUNT_BUCKETS
+)
+db_time = Histogram(
+    "db_time_per_request_seconds", "Time spent in SQL per request", ["route"]
+)
+db_statements = Counter("db_statements_total", "SQL statements run by this process")
+db_pool_wait = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Set by the middleware. Sync endpoints run in the threadpool with a copy of
+# the context, so they see the same RequestStats object and add to it.
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def route_name(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            current_request.reset(token)
+            route = route_name(scope)
+            http_requests.inc(method=scope["method"], route=route, status=status)
+            http_latency.observe(elapsed, method=scope["method"], route=route)
+            db_queries.observe(stats.queries, route=route)
+            db_time.observe(stats.db_seconds, route=route)
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine, pool_metrics: bool = True):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_statements.inc()
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+    pool = engine.pool
+    # The pool gauges describe the primary, replicas only add statements
+    if pool_metrics and isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        Gauge("db_pool_size", "Configured pool size", function=pool.size)
+        Gauge("db_pool_checked_out", "Connections currently in use", function=pool.checkedout)
+        Gauge("db_pool_overflow", "Connections open above pool_size", function=lambda: max(pool.overflow(), 0))
+        Gauge(
+            "db_pool_utilization",
+            "Connections in use as a fraction of pool_size + max_overflow",
+            function=lambda: pool.checkedout() / capacity if capacity else 0,
+        )
@@ -0,0 +1,31 @@
+"""Create an empty database straight from models.py and stamp it at head.
+
+Replaying every revision only makes sense for a database that has history.
+Use this for a brand new database, including the non-MySQL ones that the
+MySQL-only revisions (0003, 0004) can't upgrade::
+
+    python -m migrations.bootstrap
+"""
+import sys
+
+from alembic import command
+from sqlalchemy import inspect
+
+from config import Base, engine
+import models  # noqa: F401  registers every table on Base.metadata
+from migrations.check import alembic_config
+
+
+def bootstrap():
+    existing = inspect(engine).get_table_names()
+    if existing:
+        sys.exit(
+            f"Refusing to bootstrap a database that already has tables ({', '.join(existing)}). "
+            "Use `alembic upgrade head` instead."
+        )
+    Base.metadata.create_all(bind=engine)
+    command.stamp(alembic_config(), "head")
+
+
+if __name__ == "__main__":
+    bootstrap()
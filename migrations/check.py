@@ -0,0 +1,41 @@
+import os
+
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def alembic_config():
+    config = Config(ALEMBIC_INI)
+    config.set_main_option("script_location", os.path.dirname(os.path.abspath(__file__)))
+    return config
+
+
+def head_revisions():
+    return set(ScriptDirectory.from_config(alembic_config()).get_heads())
+
+
+def current_revisions(engine):
+    with engine.connect() as connection:
+        return set(MigrationContext.configure(connection).get_current_heads())
+
+
+def check_schema_version(engine):
+    """Refuse to start against a database that isn't at the migrations head.
+
+    This replaces ``create_all`` at import time: workers only read the
+    version, and schema changes happen once, through ``alembic upgrade``.
+    """
+    current, heads = current_revisions(engine), head_revisions()
+    if current != heads:
+        raise SchemaVersionError(
+            f"Database schema is at {sorted(current) or 'no revision'}, the code "
+            f"expects {sorted(heads)}. Run `alembic upgrade head` (or "
+            "`python -m migrations.bootstrap` for an empty database)."
+        )
@@ -0,0 +1,114 @@
+"""Building blocks for migrations that run while the app is serving traffic.
+
+DDL goes through ``alter_online`` so MySQL builds it in place without
+blocking writes. Data changes go through ``backfill``, which walks a table
+in primary-key order and commits each batch on its own, so no single
+transaction holds row locks or undo for long.
+
+MySQL commits every DDL statement on its own, so a migration that fails
+partway can't be rolled back. The multi-step ones check what is already
+there (``columns``, ``indexes``, ``create_trigger``) and pick up where
+they stopped when run again.
+"""
+import os
+import time
+
+import sqlalchemy as sa
+from alembic import op
+
+BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", 1000))
+# Seconds to sleep between batches so replication and the app can keep up
+BATCH_SLEEP = float(os.environ.get("MIGRATION_BATCH_SLEEP", 0.05))
+
+
+def is_mysql():
+    return op.get_bind().dialect.name == "mysql"
+
+
+def alter_online(table, *clauses):
+    sql = f"ALTER TABLE {table} " + ", ".join(clauses)
+    if is_mysql():
+        sql += ", ALGORITHM=INPLACE, LOCK=NONE"
+    op.execute(sql)
+
+
+def create_index_online(name, table, columns, unique=False):
+    if is_mysql():
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        alter_online(table, f"ADD {kind} {name} ({', '.join(columns)})")
+    else:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def drop_index_online(name, table):
+    if is_mysql():
+        alter_online(table, f"DROP INDEX {name}")
+    else:
+        op.drop_index(name, table_name=table)
+
+
+def columns(table):
+    return {column["name"]: column for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def indexes(table):
+    return {index["name"]: index for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def primary_key(table):
+    return sa.inspect(op.get_bind()).get_pk_constraint(table)["constrained_columns"]
+
+
+def create_trigger(name, definition):
+    """``CREATE TRIGGER name definition``, unless a run that stopped
+    partway already created it."""
+    exists = op.get_bind().execute(
+        sa.text(
+            "SELECT 1 FROM information_schema.TRIGGERS "
+            "WHERE TRIGGER_SCHEMA = DATABASE() AND TRIGGER_NAME = :name"
+        ),
+        {"name": name},
+    ).first()
+    if exists is None:
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+
+
+def count(table, where):
+    return op.get_bind().execute(sa.text(f"SELECT COUNT(*) FROM {table} WHERE {where}")).scalar()
+
+
+def foreign_key_name(table, column):
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys(table):
+        if fk["constrained_columns"] == [column]:
+            return fk["name"]
+    return None
+
+
+def backfill(table, key, apply, where=None, batch_size=None):
+    """Run ``apply`` over ``table`` in batches of ``key`` values.
+
+    ``apply`` is either a SQL string with an expanding ``:keys`` parameter or
+    a callable ``apply(connection, keys)``. Each batch commits on its own.
+    Returns the number of keys processed.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    bind = op.get_bind()
+    select = f"SELECT {key} FROM {table} WHERE {where or '1 = 1'}"
+    if isinstance(apply, str):
+        statement = sa.text(apply).bindparams(sa.bindparam("keys", expanding=True))
+        apply = lambda connection, keys: connection.execute(statement, {"keys": keys})
+
+    total = 0
+    last = None
+    with op.get_context().autocommit_block():
+        while True:
+            query = select + (f" AND {key} > :last" if last is not None else "")
+            query += f" ORDER BY {key} LIMIT {batch_size}"
+            keys = [row[0] for row in bind.execute(sa.text(query), {"last": last})]
+            if not keys:
+                break
+            apply(bind, keys)
+            total += len(keys)
+            last = keys[-1]
+            time.sleep(BATCH_SLEEP)
+    return total
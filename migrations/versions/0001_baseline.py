@@ -0,0 +1,174 @@
+"""Baseline: the schema Base.metadata.create_all used to build
+
+Existing databases already have these tables; mark them with
+``alembic stamp 0001`` instead of running this revision.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "roles",
+        sa.Column("role", sa.String(length=50), primary_key=True),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_roles_role", "roles", ["role"])
+
+    op.create_table(
+        "permissions",
+        sa.Column("permission", sa.String(length=50), primary_key=True),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_permissions_permission", "permissions", ["permission"])
+
+    op.create_table(
+        "ip_groups",
+        sa.Column("ip", sa.String(length=20), primary_key=True),
+        sa.Column("name", sa.String(length=50)),
+    )
+    op.create_index("ix_ip_groups_ip", "ip_groups", ["ip"])
+
+    op.create_table(
+        "role_permissions",
+        sa.Column(
+            "role", sa.String(length=50), sa.ForeignKey("roles.role"), primary_key=True
+        ),
+        sa.Column(
+            "permission",
+            sa.String(length=50),
+            sa.ForeignKey("permissions.permission"),
+            primary_key=True,
+        ),
+    )
+    op.create_index("ix_role_permissions_role", "role_permissions", ["role"])
+    op.create_index("ix_role_permissions_permission", "role_permissions", ["permission"])
+
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email", sa.String(length=100)),
+        sa.Column("password", sa.String(length=100)),
+        sa.Column("name", sa.String(length=100)),
+        sa.Column("image_url", sa.String(length=2000), nullable=True),
+        sa.Column(
+            "role_name", sa.String(length=50), sa.ForeignKey("roles.role"), nullable=False
+        ),
+        sa.Column("disabled", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+        sa.Column("last_login", sa.DateTime()),
+        sa.Column("ip_group_id", sa.String(length=20), sa.ForeignKey("ip_groups.ip")),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    op.create_table(
+        "chats",
+        sa.Column("chat_name", sa.String(length=50), primary_key=True),
+        sa.Column("image_url", sa.String(length=2000), nullable=True),
+        sa.Column("is_group", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_chats_chat_name", "chats", ["chat_name"])
+
+    op.create_table(
+        "chat_members",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "chat_id",
+            sa.String(length=50),
+            sa.ForeignKey("chats.chat_name"),
+            nullable=False,
+        ),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("joined_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_chat_members_id", "chat_members", ["id"])
+    op.create_index("ix_chat_members_chat_id", "chat_members", ["chat_id"])
+    op.create_index("ix_chat_members_user_id", "chat_members", ["user_id"])
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.String(length=64), primary_key=True),
+        sa.Column("chat_sequance", sa.Integer()),
+        sa.Column("parent_message_id", sa.String(length=64), nullable=True),
+        sa.Column(
+            "chat_id",
+            sa.String(length=50),
+            sa.ForeignKey("chats.chat_name"),
+            nullable=False,
+        ),
+        sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("timestamp", sa.DateTime()),
+        sa.Column("message", sa.String(length=5000)),
+        sa.Column("seen", sa.Boolean()),
+        sa.Column("is_file", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_chat_sequance", "messages", ["chat_sequance"])
+    op.create_index("ix_messages_chat_id", "messages", ["chat_id"])
+    op.create_index("ix_messages_sender_id", "messages", ["sender_id"])
+    op.create_index("ix_messages_created_at", "messages", ["created_at"])
+
+    op.create_table(
+        "message_reactions",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "message_id",
+            sa.String(length=64),
+            sa.ForeignKey("messages.id"),
+            nullable=False,
+        ),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("reaction", sa.String(length=50)),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_modified_at", sa.DateTime()),
+    )
+    op.create_index("ix_message_reactions_id", "message_reactions", ["id"])
+    op.create_index("ix_message_reactions_message_id", "message_reactions", ["message_id"])
+    op.create_index("ix_message_reactions_user_id", "message_reactions", ["user_id"])
+
+    op.create_table(
+        "reply_shortcuts",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("shortcut", sa.String(length=255)),
+        sa.Column("reply", sa.String(length=5000), nullable=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+    )
+    op.create_index("ix_reply_shortcuts_id", "reply_shortcuts", ["id"])
+    op.create_index("ix_reply_shortcuts_shortcut", "reply_shortcuts", ["shortcut"])
+    op.create_index("ix_reply_shortcuts_user_id", "reply_shortcuts", ["user_id"])
+
+
+def downgrade():
+    for table in (
+        "reply_shortcuts",
+        "message_reactions",
+        "messages",
+        "chat_members",
+        "chats",
+        "users",
+        "role_permissions",
+        "ip_groups",
+        "permissions",
+        "roles",
+    ):
+        op.drop_table(table)
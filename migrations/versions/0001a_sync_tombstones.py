@@ -0,0 +1,43 @@
+"""Tombstones for POST /sync
+
+A ``tombstones`` row records each message or reaction delete, so /sync
+can hand deletes to clients that were offline. New table, no deploy
+ordering needed.
+
+Numbered between 0001 and 0002 because it was split out of 0002 after
+databases had been stamped there. A database at 0002 already has this
+table.
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-19 09:02:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0001a"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "tombstones",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("kind", sa.String(length=20), nullable=False),
+        sa.Column("object_id", sa.String(length=64), nullable=False),
+        sa.Column("message_id", sa.String(length=64), nullable=True),
+        sa.Column("chat_id", sa.String(length=50), nullable=False),
+        sa.Column("deleted_at", sa.DateTime()),
+    )
+    op.create_index("ix_tombstones_id", "tombstones", ["id"])
+    op.create_index(
+        "ix_tombstones_chat_id_deleted_at", "tombstones", ["chat_id", "deleted_at"]
+    )
+
+
+def downgrade():
+    op.drop_table("tombstones")
@@ -0,0 +1,95 @@
+"""Reaction counts and one reaction per user and message
+
+``messages.reaction_counts`` and the unique ``(message_id, user_id)``
+index on ``message_reactions`` were in models.py a few changes before
+this migration was written. Code from that stretch needs this revision
+applied first: reaction writes upsert on the index and rebuild the
+counts column.
+
+Duplicate reactions left by the old SELECT-then-INSERT are removed
+before the index is built, keeping the newest. Counts are backfilled in
+batches.
+
+Numbered between 0001 and 0002 because it was split out of 0002 after
+databases had been stamped there. A database at 0002 already has these
+changes.
+
+Revision ID: 0001b
+Revises: 0001a
+Create Date: 2026-10-19 09:05:00
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import alter_online, backfill, is_mysql
+
+# revision identifiers, used by Alembic.
+revision = "0001b"
+down_revision = "0001a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if is_mysql():
+        alter_online("messages", "ADD COLUMN reaction_counts JSON NULL")
+    else:
+        op.add_column("messages", sa.Column("reaction_counts", sa.JSON(), nullable=True))
+
+    # The old SELECT-then-INSERT could race into duplicates, keep the newest
+    backfill(
+        """
+        (SELECT DISTINCT older.id FROM message_reactions older
+         JOIN message_reactions newer
+         ON newer.message_id = older.message_id
+         AND newer.user_id = older.user_id
+         AND newer.id > older.id) duplicates
+        """,
+        "id",
+        "DELETE FROM message_reactions WHERE id IN :keys",
+    )
+    if is_mysql():
+        alter_online(
+            "message_reactions",
+            "ADD UNIQUE INDEX uq_message_reactions_message_user (message_id, user_id)",
+        )
+    else:
+        op.create_index(
+            "uq_message_reactions_message_user",
+            "message_reactions",
+            ["message_id", "user_id"],
+            unique=True,
+        )
+
+    def summarize(connection, message_ids):
+        counts = {}
+        rows = connection.execute(
+            sa.text(
+                "SELECT message_id, reaction, COUNT(*) FROM message_reactions "
+                "WHERE message_id IN :keys GROUP BY message_id, reaction"
+            ).bindparams(sa.bindparam("keys", expanding=True)),
+            {"keys": message_ids},
+        )
+        for message_id, reaction, count in rows:
+            counts.setdefault(message_id, {})[reaction] = count
+        connection.execute(
+            sa.text("UPDATE messages SET reaction_counts = :counts WHERE id = :id"),
+            [
+                {"id": message_id, "counts": json.dumps(value)}
+                for message_id, value in counts.items()
+            ],
+        )
+
+    backfill(
+        "(SELECT DISTINCT message_id FROM message_reactions) reacted",
+        "message_id",
+        summarize,
+    )
+
+
+def downgrade():
+    op.drop_index("uq_message_reactions_message_user", table_name="message_reactions")
+    op.drop_column("messages", "reaction_counts")
@@ -0,0 +1,44 @@
+"""Attachments
+
+One ``attachments`` row per uploaded file, pointing at its message and
+at the content-addressed blob on disk by ``sha256``. New table, no
+deploy ordering needed.
+
+Revision ID: 0002
+Revises: 0001b
+Create Date: 2026-10-19 09:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "attachments",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "message_id",
+            sa.String(length=64),
+            sa.ForeignKey("messages.id"),
+            nullable=False,
+        ),
+        sa.Column("sha256", sa.String(length=64), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("content_type", sa.String(length=255)),
+        sa.Column("filename", sa.String(length=255)),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_attachments_id", "attachments", ["id"])
+    op.create_index("ix_attachments_message_id", "attachments", ["message_id"])
+    op.create_index("ix_attachments_sha256", "attachments", ["sha256"])
+
+
+def downgrade():
+    op.drop_table("attachments")
@@ -0,0 +1,172 @@
+"""Integer surrogate keys for chats
+
+``chats.chat_name`` stops being the primary key. Chats get an
+AUTO_INCREMENT ``id``, and ``messages``, ``chat_members`` and ``tombstones``
+point at it through an INT ``chat_id`` instead of repeating the name.
+
+This runs online, in three phases:
+
+1. ``chats`` gets its ``id``. The table is small, so the primary-key swap is
+   a short table copy. After this, chats created by the old code get ids
+   from AUTO_INCREMENT.
+2. Each child table gets a ``chat_pk`` column. A trigger keeps it filled for
+   rows written by the old code, and a batched backfill fills existing rows
+   in primary-key order.
+3. Each child table swaps ``chat_pk`` in for ``chat_id`` with one in-place
+   ALTER. The triggers stay until that ALTER is done, so rows written
+   during it still get a ``chat_pk``. Deploy the new code right after this
+   phase: the old code writes chat names and can't insert into the new
+   column.
+
+Every step checks whether it already ran. If the migration stops partway,
+fix the cause and run it again.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import (
+    alter_online,
+    backfill,
+    columns,
+    count,
+    create_trigger,
+    foreign_key_name,
+    indexes,
+    is_mysql,
+    primary_key,
+)
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+# table -> (primary key, index on chat_id to rebuild, foreign key to chats)
+CHILD_TABLES = {
+    "messages": ("id", ["ix_messages_chat_id (chat_id)"], True),
+    "chat_members": ("id", ["ix_chat_members_chat_id (chat_id)"], True),
+    "tombstones": ("id", ["ix_tombstones_chat_id_deleted_at (chat_id, deleted_at)"], False),
+}
+
+
+def swapped(table):
+    found = columns(table)
+    return "chat_pk" not in found and isinstance(found["chat_id"]["type"], sa.Integer)
+
+
+def fill_chat_pk(table, key):
+    backfill(
+        table,
+        key,
+        f"UPDATE {table} JOIN chats ON chats.chat_name = {table}.chat_id "
+        f"SET {table}.chat_pk = chats.id WHERE {table}.{key} IN :keys",
+        where="chat_pk IS NULL",
+    )
+
+
+def upgrade():
+    if not is_mysql():
+        raise RuntimeError(
+            "0003 rewrites keys with MySQL online DDL. Build other databases from "
+            "models.py and run `alembic stamp head` instead."
+        )
+
+    # Phase 1: ids for chats
+    clauses = []
+    if "id" not in columns("chats"):
+        clauses.append("ADD COLUMN id INT NULL")
+    found = indexes("chats")
+    renamed = found.get("ix_chats_chat_name", {}).get("unique")
+    if "uq_chats_chat_name" not in found and not renamed:
+        clauses.append("ADD UNIQUE INDEX uq_chats_chat_name (chat_name)")
+    if clauses:
+        alter_online("chats", *clauses)
+
+    def number_chats(connection, names):
+        start = connection.execute(sa.text("SELECT COALESCE(MAX(id), 0) FROM chats")).scalar()
+        connection.execute(
+            sa.text("UPDATE chats SET id = :id WHERE chat_name = :name"),
+            [{"id": start + n, "name": name} for n, name in enumerate(names, 1)],
+        )
+
+    backfill("chats", "chat_name", number_chats, where="id IS NULL")
+    if primary_key("chats") != ["id"]:
+        # Changing the primary key copies the table, chats is small enough for that
+        op.execute(
+            "ALTER TABLE chats DROP PRIMARY KEY, "
+            "MODIFY id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+            "ADD INDEX ix_chats_id (id)"
+        )
+
+    # Phase 2: shadow columns, kept current by triggers, then backfilled
+    for table, (key, _, _) in CHILD_TABLES.items():
+        if swapped(table):
+            continue
+        if "chat_pk" not in columns(table):
+            alter_online(table, "ADD COLUMN chat_pk INT NULL")
+        for event in ("INSERT", "UPDATE"):
+            create_trigger(
+                f"{table}_chat_pk_{event.lower()}",
+                f"BEFORE {event} ON {table} FOR EACH ROW "
+                "SET NEW.chat_pk = (SELECT id FROM chats WHERE chat_name = NEW.chat_id)",
+            )
+        fill_chat_pk(table, key)
+
+    # Phase 3: swap the columns
+    op.execute("SET SESSION foreign_key_checks = 0")
+    try:
+        for table, (key, rebuilt, has_foreign_key) in CHILD_TABLES.items():
+            if swapped(table):
+                continue
+            # The triggers are still on, this only finds rows the first
+            # backfill missed
+            fill_chat_pk(table, key)
+            orphans = "chat_pk IS NULL AND chat_id NOT IN (SELECT chat_name FROM chats)"
+            if not has_foreign_key:
+                # Tombstones of chats deleted long ago, nothing syncs them
+                backfill(table, key, f"DELETE FROM {table} WHERE {key} IN :keys", where=orphans)
+            missing = count(table, "chat_pk IS NULL")
+            if missing:
+                raise RuntimeError(
+                    f"{missing} rows in {table} name a chat that doesn't exist. "
+                    "Fix or delete them and run the migration again."
+                )
+
+            clauses = []
+            fk = foreign_key_name(table, "chat_id")
+            if fk:
+                clauses.append(f"DROP FOREIGN KEY {fk}")
+            clauses += [f"DROP INDEX {index.split()[0]}" for index in rebuilt]
+            clauses += [
+                "DROP COLUMN chat_id",
+                "CHANGE COLUMN chat_pk chat_id INT NOT NULL",
+            ]
+            clauses += [f"ADD INDEX {index}" for index in rebuilt]
+            if has_foreign_key:
+                clauses.append(
+                    f"ADD CONSTRAINT fk_{table}_chat_id FOREIGN KEY (chat_id) REFERENCES chats (id)"
+                )
+            alter_online(table, *clauses)
+            # chat_pk is gone, the triggers would fail every write from here
+            for event in ("insert", "update"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_chat_pk_{event}")
+    finally:
+        op.execute("SET SESSION foreign_key_checks = 1")
+
+    # Nothing references chat_name any more, keep a single unique index on it
+    if "uq_chats_chat_name" in indexes("chats"):
+        alter_online(
+            "chats",
+            "DROP INDEX ix_chats_chat_name",
+            "RENAME INDEX uq_chats_chat_name TO ix_chats_chat_name",
+        )
+
+
+def downgrade():
+    raise RuntimeError("0003 is not reversible, restore from a backup taken before it.")
@@ -0,0 +1,281 @@
+"""Server generated, time ordered BIGINT message ids
+
+``messages.id`` becomes a snowflake id from ids.py. The old client supplied
+VARCHAR(64) id is kept as ``messages.client_id``, a unique idempotency
+key. ``message_reactions.message_id``, ``attachments.message_id`` and
+``messages.parent_message_id`` are repointed to the new id.
+
+This runs online, like 0003:
+
+1. ``messages`` gets ``new_id`` and ``parent_pk`` shadow columns. Rows the
+   old code inserts get them from a trigger (worker 1023). Existing rows
+   are backfilled in ``created_at`` order (worker 1022), so ids follow
+   message time.
+2. Child tables get ``message_pk`` shadow columns, kept current by triggers
+   and backfilled in batches.
+3. One in-place ALTER per table swaps the columns. Each table's triggers
+   stay until its ALTER is done, so rows written during it are filled in.
+   Deploy the new code right after this phase.
+
+Every step checks whether it already ran. If the migration stops partway,
+fix the cause and run it again.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 09:40:00
+
+"""
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+from ids import (
+    EPOCH_MS,
+    MAX_SEQUENCE,
+    MAX_WORKER,
+    RESERVED_WORKERS,
+    SEQUENCE_BITS,
+    WORKER_BITS,
+    compose_id,
+)
+from migrations.helpers import (
+    BATCH_SIZE,
+    BATCH_SLEEP,
+    alter_online,
+    backfill,
+    columns,
+    count,
+    create_trigger,
+    foreign_key_name,
+    indexes,
+    is_mysql,
+)
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+BACKFILL_WORKER, TRIGGER_WORKER = RESERVED_WORKERS
+
+# table -> (primary key, column pointing at messages.id, index to rebuild)
+CHILD_TABLES = {
+    "message_reactions": (
+        "id",
+        "message_id",
+        [
+            "ix_message_reactions_message_id (message_id)",
+            "uq_message_reactions_message_user (message_id, user_id)",
+        ],
+    ),
+    "attachments": ("id", "message_id", ["ix_attachments_message_id (message_id)"]),
+}
+
+
+def number_messages():
+    """Give every message without one a ``new_id`` derived from created_at.
+
+    Walks ``(created_at, id)`` in order so ids come out in message time order
+    and the per-millisecond sequence only needs the previous value. A re-run
+    carries on from the highest id an earlier run gave out, so it can't
+    hand out the same id twice within that millisecond.
+    """
+    bind = op.get_bind()
+    last_ms, sequence = -1, 0
+    numbered = bind.execute(
+        sa.text(
+            "SELECT MAX(new_id) FROM messages "
+            f"WHERE (new_id >> {SEQUENCE_BITS}) & {MAX_WORKER} = :worker"
+        ),
+        {"worker": BACKFILL_WORKER},
+    ).scalar()
+    if numbered is not None:
+        last_ms, sequence = numbered >> (WORKER_BITS + SEQUENCE_BITS), numbered & MAX_SEQUENCE
+    after = None
+    with op.get_context().autocommit_block():
+        while True:
+            query = (
+                "SELECT id, created_at, FLOOR(UNIX_TIMESTAMP(created_at) * 1000) "
+                "FROM messages WHERE new_id IS NULL"
+            )
+            if after is not None:
+                query += (
+                    " AND (created_at > :created_at"
+                    " OR (created_at = :created_at AND id > :id))"
+                )
+            query += f" ORDER BY created_at, id LIMIT {BATCH_SIZE}"
+            rows = bind.execute(sa.text(query), after or {}).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for message_id, _, created_ms in rows:
+                ms = max(int(created_ms) - EPOCH_MS, 0)
+                if ms <= last_ms:
+                    sequence += 1
+                    if sequence > MAX_SEQUENCE:
+                        last_ms, sequence = last_ms + 1, 0
+                else:
+                    last_ms, sequence = ms, 0
+                updates.append(
+                    {"id": message_id, "new_id": compose_id(last_ms, BACKFILL_WORKER, sequence)}
+                )
+            bind.execute(
+                sa.text("UPDATE messages SET new_id = :new_id WHERE id = :id"), updates
+            )
+
+            after = {"id": rows[-1][0], "created_at": rows[-1][1]}
+            time.sleep(BATCH_SLEEP)
+
+
+def repoint(table, key, column):
+    backfill(
+        table,
+        key,
+        f"UPDATE {table} JOIN messages ON messages.id = {table}.{column} "
+        f"SET {table}.message_pk = messages.new_id WHERE {table}.{key} IN :keys",
+        where="message_pk IS NULL",
+    )
+
+
+def swapped(table, column):
+    found = columns(table)
+    return "message_pk" not in found and isinstance(found[column]["type"], sa.Integer)
+
+
+def messages_swapped():
+    found = columns("messages")
+    return "new_id" not in found and "client_id" in found
+
+
+def require_filled(table, column):
+    missing = count(table, f"{column} IS NULL")
+    if missing:
+        raise RuntimeError(
+            f"{missing} rows in {table} have no {column}. "
+            "Fix or delete them and run the migration again."
+        )
+
+
+def upgrade():
+    if not is_mysql():
+        raise RuntimeError(
+            "0004 rewrites keys with MySQL online DDL. Build other databases from "
+            "models.py and run `alembic stamp head` instead."
+        )
+
+    # Phase 1: new ids for messages
+    if not messages_swapped():
+        found = columns("messages")
+        clauses = [
+            f"ADD COLUMN {name} BIGINT NULL"
+            for name in ("new_id", "parent_pk")
+            if name not in found
+        ]
+        if "uq_messages_new_id" not in indexes("messages"):
+            clauses.append("ADD UNIQUE INDEX uq_messages_new_id (new_id)")
+        if clauses:
+            alter_online("messages", *clauses)
+        create_trigger(
+            "messages_new_id",
+            "BEFORE INSERT ON messages FOR EACH ROW "
+            "SET NEW.new_id = COALESCE(NEW.new_id, "
+            f"((FLOOR(UNIX_TIMESTAMP(NOW(3)) * 1000) - {EPOCH_MS}) << 22) "
+            f"| ({TRIGGER_WORKER} << 12) | (UUID_SHORT() & {MAX_SEQUENCE})), "
+            "NEW.parent_pk = (SELECT new_id FROM messages WHERE id = NEW.parent_message_id)",
+        )
+        # The keyset walk below needs a created_at on every row
+        backfill(
+            "messages",
+            "id",
+            "UPDATE messages SET created_at = COALESCE(timestamp, last_modified_at, "
+            "'2024-01-01') WHERE id IN :keys",
+            where="created_at IS NULL",
+        )
+        number_messages()
+
+    # Phase 2: shadow columns on the tables pointing at messages
+    for table, (key, column, _) in CHILD_TABLES.items():
+        if swapped(table, column):
+            continue
+        if "message_pk" not in columns(table):
+            alter_online(table, "ADD COLUMN message_pk BIGINT NULL")
+        for event in ("INSERT", "UPDATE"):
+            create_trigger(
+                f"{table}_message_pk_{event.lower()}",
+                f"BEFORE {event} ON {table} FOR EACH ROW "
+                "SET NEW.message_pk = "
+                f"(SELECT new_id FROM messages WHERE id = NEW.{column})",
+            )
+        repoint(table, key, column)
+
+    # Phase 3: swap the columns, children first so their foreign keys are gone
+    # before the primary key of messages changes
+    op.execute("SET SESSION foreign_key_checks = 0")
+    try:
+        for table, (key, column, rebuilt) in CHILD_TABLES.items():
+            if swapped(table, column):
+                continue
+            # The triggers are still on, this only finds rows the first
+            # backfill missed
+            repoint(table, key, column)
+            require_filled(table, "message_pk")
+
+            clauses = []
+            fk = foreign_key_name(table, column)
+            if fk:
+                clauses.append(f"DROP FOREIGN KEY {fk}")
+            clauses += [f"DROP INDEX {index.split()[0]}" for index in rebuilt]
+            clauses += [
+                f"DROP COLUMN {column}",
+                f"CHANGE COLUMN message_pk {column} BIGINT NOT NULL",
+            ]
+            clauses += [
+                f"ADD {'UNIQUE ' if index.startswith('uq_') else ''}INDEX {index}"
+                for index in rebuilt
+            ]
+            alter_online(table, *clauses)
+            # message_pk is gone, the triggers would fail every write from here
+            for event in ("insert", "update"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_message_pk_{event}")
+
+        if not messages_swapped():
+            number_messages()
+            backfill(
+                "messages",
+                "id",
+                "UPDATE messages JOIN messages parent ON parent.id = messages.parent_message_id "
+                "SET messages.parent_pk = parent.new_id WHERE messages.id IN :keys",
+                where="parent_message_id IS NOT NULL AND parent_pk IS NULL",
+            )
+            require_filled("messages", "new_id")
+            alter_online(
+                "messages",
+                "DROP PRIMARY KEY",
+                "DROP INDEX ix_messages_id",
+                "DROP INDEX uq_messages_new_id",
+                "CHANGE COLUMN id client_id VARCHAR(64) NULL",
+                "CHANGE COLUMN new_id id BIGINT NOT NULL",
+                "ADD PRIMARY KEY (id)",
+                "ADD INDEX ix_messages_id (id)",
+                "ADD UNIQUE INDEX ix_messages_client_id (client_id)",
+                "DROP COLUMN parent_message_id",
+                "CHANGE COLUMN parent_pk parent_message_id BIGINT NULL",
+            )
+        op.execute("DROP TRIGGER IF EXISTS messages_new_id")
+
+        for table, (_, column, _) in CHILD_TABLES.items():
+            if foreign_key_name(table, column) is None:
+                alter_online(
+                    table,
+                    f"ADD CONSTRAINT fk_{table}_{column} FOREIGN KEY ({column}) "
+                    "REFERENCES messages (id)",
+                )
+    finally:
+        op.execute("SET SESSION foreign_key_checks = 1")
+
+
+def downgrade():
+    raise RuntimeError("0004 is not reversible, restore from a backup taken before it.")
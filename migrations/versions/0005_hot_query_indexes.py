@@ -0,0 +1,34 @@
+"""Indexes for the hot read paths, built online
+
+- messages (chat_id, created_at): the latest page of a chat in GET /chats/{chat}
+- messages (chat_id, last_modified_at): per-chat cursors in POST /sync
+- chat_members (user_id, chat_id): the chats a user belongs to
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 10:00:00
+
+"""
+from migrations.helpers import create_index_online, drop_index_online
+
+# revision identifiers, used by Alembic.
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_messages_chat_id_created_at", "messages", ["chat_id", "created_at"]),
+    ("ix_messages_chat_id_last_modified_at", "messages", ["chat_id", "last_modified_at"]),
+    ("ix_chat_members_user_id_chat_id", "chat_members", ["user_id", "chat_id"]),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        create_index_online(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        drop_index_online(name, table)
@@ -0,0 +1,68 @@
+"""Reply threads: (chat_id, parent_message_id) index and reply counts
+
+- messages (chat_id, parent_message_id): the replies of a message, for
+  GET /messages/{message}/thread. Ordered by id through the index, ids
+  being time ordered.
+- messages.reply_count: direct replies, kept by create/delete so history
+  pages don't count them per request. Backfilled in batches after the
+  index exists, each batch counting through it.
+
+Runs online. Replies the old code stores after their parent's batch
+was counted are not counted, so deploy right after.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19 11:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import (
+    alter_online,
+    backfill,
+    create_index_online,
+    drop_index_online,
+    is_mysql,
+)
+
+# revision identifiers, used by Alembic.
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_online(
+        "ix_messages_chat_id_parent_message_id", "messages", ["chat_id", "parent_message_id"]
+    )
+    if is_mysql():
+        alter_online("messages", "ADD COLUMN reply_count INT NOT NULL DEFAULT 0")
+    else:
+        op.add_column(
+            "messages",
+            sa.Column("reply_count", sa.Integer(), nullable=False, server_default="0"),
+        )
+
+    # GROUP BY keeps MySQL from merging the derived table into the UPDATE,
+    # which it would refuse since both read messages
+    backfill(
+        "messages",
+        "id",
+        "UPDATE messages JOIN ("
+        " SELECT parent.id, COUNT(*) AS replies FROM messages parent"
+        " JOIN messages reply ON reply.chat_id = parent.chat_id"
+        " AND reply.parent_message_id = parent.id"
+        " WHERE parent.id IN :keys GROUP BY parent.id"
+        ") counts ON counts.id = messages.id "
+        "SET messages.reply_count = counts.replies",
+    )
+
+
+def downgrade():
+    if is_mysql():
+        alter_online("messages", "DROP COLUMN reply_count")
+    else:
+        op.drop_column("messages", "reply_count")
+    drop_index_online("ix_messages_chat_id_parent_message_id", "messages")
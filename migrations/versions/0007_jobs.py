@@ -0,0 +1,42 @@
+"""Background jobs table
+
+``jobs`` tracks chunked deletes and retention runs so they can resume
+after a restart, see jobs.py. A new table, nothing to backfill.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19 11:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "jobs",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("kind", sa.String(length=20), nullable=False),
+        sa.Column("target_id", sa.Integer(), nullable=True),
+        sa.Column("state", sa.String(length=20), nullable=False),
+        sa.Column("step", sa.String(length=50), nullable=True),
+        sa.Column("cursor", sa.BigInteger(), nullable=True),
+        sa.Column("processed", sa.Integer(), nullable=False),
+        sa.Column("error", sa.String(length=2000), nullable=True),
+        sa.Column("lease_until", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("updated_at", sa.DateTime()),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_jobs_id", "jobs", ["id"])
+    op.create_index("ix_jobs_state_lease_until", "jobs", ["state", "lease_until"])
+
+
+def downgrade():
+    op.drop_table("jobs")
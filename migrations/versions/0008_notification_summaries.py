@@ -0,0 +1,40 @@
+"""Offline notification summaries
+
+``notification_summaries`` holds, per user and chat, what arrived while
+the user had no /ws connection, see notifications.py. A new table,
+nothing to backfill.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19 11:40:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "notification_summaries",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("chat_id", sa.Integer(), sa.ForeignKey("chats.id"), nullable=False),
+        sa.Column("unread", sa.Integer(), nullable=False),
+        sa.Column("mentions", sa.Integer(), nullable=False),
+        sa.Column("last_message_id", sa.BigInteger(), nullable=True),
+        sa.Column("last_sender_id", sa.Integer(), nullable=True),
+        sa.Column("preview", sa.String(length=200), nullable=True),
+        sa.Column("last_at", sa.DateTime(), nullable=True),
+        sa.UniqueConstraint("user_id", "chat_id", name="uq_notification_summaries_user_chat"),
+    )
+    op.create_index("ix_notification_summaries_id", "notification_summaries", ["id"])
+
+
+def downgrade():
+    op.drop_table("notification_summaries")
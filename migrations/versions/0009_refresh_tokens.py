@@ -0,0 +1,39 @@
+"""Refresh tokens
+
+``refresh_tokens`` has one row per login. Refresh tokens are signed with
+HMAC and carry the row id and a generation, so the table only stores the
+current generation and whether the login was revoked, see services.py.
+A new table, nothing to backfill.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "refresh_tokens",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("generation", sa.Integer(), nullable=False),
+        sa.Column("revoked", sa.Boolean(), nullable=False),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("last_used_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_refresh_tokens_id", "refresh_tokens", ["id"])
+    op.create_index("ix_refresh_tokens_user_id", "refresh_tokens", ["user_id"])
+
+
+def downgrade():
+    op.drop_table("refresh_tokens")
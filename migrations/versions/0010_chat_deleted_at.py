@@ -0,0 +1,35 @@
+"""chats.deleted_at, set when a chat is deleted
+
+DELETE /chats/{chat_ref} marks the chat and queues its purge job, see
+jobs.py. Marked chats no longer resolve, so nothing new is written to
+them while the job runs. A nullable column, nothing to backfill.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19 13:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import alter_online, is_mysql
+
+# revision identifiers, used by Alembic.
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if is_mysql():
+        alter_online("chats", "ADD COLUMN deleted_at DATETIME NULL")
+    else:
+        op.add_column("chats", sa.Column("deleted_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    if is_mysql():
+        alter_online("chats", "DROP COLUMN deleted_at")
+    else:
+        op.drop_column("chats", "deleted_at")
@@ -1,4 +1,15 @@
-from sqlalchemy import Boolean, Column, String, Integer, ForeignKey, DateTime
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    String,
+    Integer,
+    ForeignKey,
+    DateTime,
+    Index,
+    JSON,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from config import Base
@@ -87,11 +98,14 @@ class RolePermission(Base, ModelActions):
 class Chat(Base, ModelActions):
     __tablename__ = "chats"
 
-    chat_name = Column(String(length=50), primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, index=True)
+    chat_name = Column(String(length=50), nullable=False, unique=True, index=True)
     image_url = Column(String(length=2000), nullable=True)
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=func.now(6))
     last_modified_at = Column(DateTime, default=func.now(6), onupdate=func.now(6))
+    # Set by DELETE /chats/{chat_ref}, the purge job removes the row later
+    deleted_at = Column(DateTime, nullable=True)
 
     messages = relationship("Message", back_populates="chat")
     chat_members = relationship("ChatMember", back_populates="chat", viewonly=True)
@@ -101,9 +115,7 @@ class ChatMember(Base, ModelActions):
     __tablename__ = "chat_members"
 
     id = Column(Integer, primary_key=True, index=True)
-    chat_id = Column(
-        String(length=50), ForeignKey("chats.chat_name"), nullable=False, index=True
-    )
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     joined_at = Column(DateTime, default=func.now(6))
     last_modified_at = Column(DateTime, default=func.now(6), onupdate=func.now(6))
@@ -111,34 +123,50 @@ class ChatMember(Base, ModelActions):
     chat = relationship("Chat", backref="members")
     user = relationship("User", backref="chats")
 
+    __table_args__ = (Index("ix_chat_members_user_id_chat_id", "user_id", "chat_id"),)
+
 
 class Message(Base, ModelActions):
     __tablename__ = "messages"
 
-    id = Column(String(length=64), primary_key=True, index=True)
+    # Server generated and time ordered, see ids.py
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=False)
+    # Whatever id the client sent, kept as an idempotency key for retries
+    client_id = Column(String(length=64), nullable=True, unique=True, index=True)
     chat_sequance = Column(Integer, index=True)
-    parent_message_id = Column(String(length=64), nullable=True, default=0)
-    chat_id = Column(
-        String(length=50), ForeignKey("chats.chat_name"), nullable=False, index=True
-    )
+    parent_message_id = Column(BigInteger, nullable=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     timestamp = Column(DateTime, default=func.now(6))
     message = Column(String(length=5000))
     seen = Column(Boolean, default=False)
     is_file = Column(Boolean, default=False)
+    # {reaction: count}, rebuilt by services.refresh_reaction_counts
+    reaction_counts = Column(JSON, nullable=True)
+    # Direct replies, kept by services.change_reply_count
+    reply_count = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=func.now(6), index=True)
     last_modified_at = Column(DateTime, default=func.now(6), onupdate=func.now(6))
 
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="messages")
     reactions = relationship("MessageReaction", back_populates="message")
+    attachments = relationship("Attachment", back_populates="message")
+
+    __table_args__ = (
+        # Chat history pages and /sync
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+        Index("ix_messages_chat_id_last_modified_at", "chat_id", "last_modified_at"),
+        # Reply threads
+        Index("ix_messages_chat_id_parent_message_id", "chat_id", "parent_message_id"),
+    )
 
 
 class MessageReaction(Base, ModelActions):
     __tablename__ = "message_reactions"
 
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(String(length=64), ForeignKey("messages.id"), nullable=False, index=True)
+    message_id = Column(BigInteger, ForeignKey("messages.id"), nullable=False, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     reaction = Column(String(length=50))
     created_at = Column(DateTime, default=func.now(6))
@@ -147,6 +175,94 @@ class MessageReaction(Base, ModelActions):
     message = relationship("Message", back_populates="reactions")
     user = relationship("User", back_populates="message_reactions")
 
+    __table_args__ = (
+        UniqueConstraint("message_id", "user_id", name="uq_message_reactions_message_user"),
+    )
+
+
+# Uploaded file metadata, the content lives on disk under storage.blob_path
+class Attachment(Base, ModelActions):
+    __tablename__ = "attachments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(BigInteger, ForeignKey("messages.id"), nullable=False, index=True)
+    sha256 = Column(String(length=64), nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String(length=255))
+    filename = Column(String(length=255))
+    created_at = Column(DateTime, default=func.now(6))
+
+    message = relationship("Message", back_populates="attachments")
+
+
+# Left behind by deletes so /sync can tell clients what disappeared
+class Tombstone(Base, ModelActions):
+    __tablename__ = "tombstones"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(length=20), nullable=False)  # "message" or "reaction"
+    object_id = Column(String(length=64), nullable=False)
+    message_id = Column(String(length=64), nullable=True)
+    chat_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=func.now(6))
+
+    __table_args__ = (Index("ix_tombstones_chat_id_deleted_at", "chat_id", "deleted_at"),)
+
+
+# Background deletes and retention, see jobs.py
+class Job(Base, ModelActions):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(length=20), nullable=False)  # "purge_chat", "purge_user", "retention"
+    target_id = Column(Integer, nullable=True)
+    state = Column(String(length=20), nullable=False, default="pending")
+    # Where to resume: the current step and the last key it finished
+    step = Column(String(length=50), nullable=True)
+    cursor = Column(BigInteger, nullable=True)
+    processed = Column(Integer, nullable=False, default=0)
+    error = Column(String(length=2000), nullable=True)
+    # A running job belongs to whoever renews this, a stale one is picked up again
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=func.now(6))
+    updated_at = Column(DateTime, default=func.now(6), onupdate=func.now(6))
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_jobs_state_lease_until", "state", "lease_until"),)
+
+
+# One row per login, rotated on every refresh, see services.rotate_refresh_token
+class RefreshToken(Base, ModelActions):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # Bumped by each refresh, only a token carrying the current value is accepted
+    generation = Column(Integer, nullable=False, default=0)
+    revoked = Column(Boolean, nullable=False, default=False)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=func.now(6))
+    last_used_at = Column(DateTime, nullable=True)
+
+
+# What a user missed in a chat while offline, see notifications.py
+class NotificationSummary(Base, ModelActions):
+    __tablename__ = "notification_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    unread = Column(Integer, nullable=False, default=0)
+    mentions = Column(Integer, nullable=False, default=0)
+    last_message_id = Column(BigInteger, nullable=True)
+    last_sender_id = Column(Integer, nullable=True)
+    preview = Column(String(length=200), nullable=True)
+    last_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "chat_id", name="uq_notification_summaries_user_chat"),
+    )
+
 
 class ReplyShortcut(Base):
     __tablename__ = "reply_shortcuts"
@@ -0,0 +1,272 @@
+"""What users missed while they were offline, as one frame on connect.
+
+/ws events only reach users with an open socket. A user coming back used
+to reload every chat to find out what changed. Instead, each new message
+also updates a small summary per (user, chat) for every member with no
+socket in this process: how many messages arrived, how many mention
+them by ``@name`` and a preview of the latest one.
+
+- Summaries are coalesced in memory and written every
+  ``NOTIFICATION_FLUSH_INTERVAL`` seconds. Each flush is one multi-row
+  upsert that adds to the stored counters. A drain flushes what is left,
+  see lifecycle.py.
+- On connect with ``?user_id=`` the user's summaries are read and
+  deleted, pending ones included, and sent as a single
+  ``notifications.summary`` event. The client reloads only the chats in
+  it.
+- Like routing, this is per process. A user connected to another worker
+  counts as offline here, so a summary may repeat messages the client
+  already saw live. The counts only ever overstate.
+"""
+import asyncio
+import logging
+import re
+import threading
+from datetime import datetime
+from typing import Container, Dict, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from config import SessionLocal, settings
+from helper import upsert
+from sqlalchemy import or_
+
+from models import Chat, ChatMember, NotificationSummary, User
+import lifecycle
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MENTION_RE = re.compile(r"@([\w.]+)")
+
+queued = metrics.Counter(
+    "offline_notifications_total", "Messages summarized for members without a /ws connection"
+)
+
+
+class Pending:
+    __slots__ = ("unread", "mentions", "last_message_id", "last_sender_id", "preview", "last_at")
+
+    def __init__(self):
+        self.unread = 0
+        self.mentions = 0
+        self.last_message_id = None
+        self.last_sender_id = None
+        self.preview = None
+        self.last_at = None
+
+    def add(self, message_id: int, sender_id: int, preview: str, at: datetime, mentioned: bool):
+        self.unread += 1
+        self.mentions += int(mentioned)
+        if self.last_message_id is None or message_id > self.last_message_id:
+            self.last_message_id = message_id
+            self.last_sender_id = sender_id
+            self.preview = preview
+            self.last_at = at
+
+    def row(self, user_id: int, chat_id: int) -> dict:
+        return {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "unread": self.unread,
+            "mentions": self.mentions,
+            "last_message_id": self.last_message_id,
+            "last_sender_id": self.last_sender_id,
+            "preview": self.preview,
+            "last_at": self.last_at,
+        }
+
+
+def preview_of(text: Optional[str]) -> str:
+    text = " ".join((text or "").split())
+    limit = settings.notification_preview_chars
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def direct_chat_users(chat_name: str) -> Set[int]:
+    # Direct chats have no member rows, the users are in the name, the
+    # same way GET /direct-chats/ finds them
+    return {int(part) for part in chat_name.split("-")[1:] if part.isdigit()}
+
+
+def chat_recipients(chat_id: int) -> Set[int]:
+    db = SessionLocal()
+    try:
+        members = {
+            user_id
+            for (user_id,) in db.query(ChatMember.user_id).filter(ChatMember.chat_id == chat_id)
+        }
+        if not members:
+            chat = db.query(Chat.chat_name, Chat.is_group).filter(Chat.id == chat_id).first()
+            if chat is not None and not chat.is_group:
+                members = direct_chat_users(chat.chat_name)
+        return members
+    finally:
+        db.close()
+
+
+def mentioned_users(text: str, user_ids: Set[int]) -> Set[int]:
+    names = {name.lower() for name in MENTION_RE.findall(text or "")}
+    if not names:
+        return set()
+    db = SessionLocal()
+    try:
+        return {
+            user_id
+            for user_id, name in db.query(User.id, User.name).filter(User.id.in_(user_ids))
+            if str(user_id) in names or (name and name.replace(" ", "").lower() in names)
+        }
+    finally:
+        db.close()
+
+
+class NotificationAggregator:
+    def __init__(self):
+        self.pending: Dict[Tuple[int, int], Pending] = {}
+        self.lock = threading.Lock()
+        self.flusher: Optional[asyncio.Task] = None
+
+    async def message_created(
+        self,
+        chat_id: int,
+        message_id: int,
+        sender_id: int,
+        text: Optional[str],
+        created_at: datetime,
+        connected: Container[int],
+    ):
+        """Count a new message for the members that aren't ``connected``."""
+        members = await run_in_threadpool(chat_recipients, chat_id)
+        # Checked back on the event loop, which owns the connection table
+        offline = {user_id for user_id in members - {sender_id} if user_id not in connected}
+        if not offline:
+            return
+        mentioned = await run_in_threadpool(mentioned_users, text, offline)
+        preview = preview_of(text)
+        with self.lock:
+            for user_id in offline:
+                self.pending.setdefault((user_id, chat_id), Pending()).add(
+                    message_id, sender_id, preview, created_at, user_id in mentioned
+                )
+        queued.inc(len(offline))
+
+    def flush(self, deadline: Optional[float] = None):
+        """Add the pending counters to the stored summaries."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        db = SessionLocal()
+        try:
+            # Chats and users deleted since, their purge jobs have moved on
+            chats = {
+                chat_id
+                for (chat_id,) in db.query(Chat.id).filter(
+                    Chat.id.in_({chat_id for _, chat_id in pending}), Chat.deleted_at.is_(None)
+                )
+            }
+            users = {
+                user_id
+                for (user_id,) in db.query(User.id).filter(
+                    User.id.in_({user_id for user_id, _ in pending}),
+                    or_(User.disabled.is_(None), User.disabled == False),
+                )
+            }
+            rows = [
+                entry.row(user_id, chat_id)
+                for (user_id, chat_id), entry in pending.items()
+                if chat_id in chats and user_id in users
+            ]
+            if not rows:
+                return
+            upsert(
+                db,
+                NotificationSummary,
+                rows,
+                index_elements=["user_id", "chat_id"],
+                update_columns=["last_message_id", "last_sender_id", "preview", "last_at"],
+                increment_columns=["unread", "mentions"],
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("dropping notification summaries", extra={"rows": len(pending)})
+        finally:
+            db.close()
+
+    def take(self, user_id: int) -> List[dict]:
+        """Remove and return everything summarized for ``user_id``."""
+        with self.lock:
+            mine = {
+                chat_id: self.pending.pop((owner, chat_id))
+                for owner, chat_id in list(self.pending)
+                if owner == user_id
+            }
+        db = SessionLocal()
+        try:
+            stored = (
+                db.query(NotificationSummary)
+                .filter(NotificationSummary.user_id == user_id)
+                .with_for_update()
+                .all()
+            )
+            summaries = {row.chat_id: row.as_dict() for row in stored}
+            if stored:
+                db.query(NotificationSummary).filter(
+                    NotificationSummary.id.in_([row.id for row in stored])
+                ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+        for chat_id, entry in mine.items():
+            summary = summaries.get(chat_id)
+            if summary is None:
+                summaries[chat_id] = entry.row(user_id, chat_id)
+                continue
+            summary["unread"] += entry.unread
+            summary["mentions"] += entry.mentions
+            if (summary["last_message_id"] or 0) < entry.last_message_id:
+                summary.update(
+                    last_message_id=entry.last_message_id,
+                    last_sender_id=entry.last_sender_id,
+                    preview=entry.preview,
+                    last_at=entry.last_at,
+                )
+        return [
+            {
+                "chat_id": chat_id,
+                "unread": summary["unread"],
+                "mentions": summary["mentions"],
+                # Ids go out as strings, like everywhere else in the API
+                "last_message_id": str(summary["last_message_id"])
+                if summary["last_message_id"] is not None
+                else None,
+                "last_sender_id": summary["last_sender_id"],
+                "preview": summary["preview"],
+                "last_at": summary["last_at"],
+            }
+            for chat_id, summary in sorted(
+                summaries.items(), key=lambda item: item[1]["last_message_id"] or 0, reverse=True
+            )
+        ]
+
+    async def summary_event(self, user_id: int) -> dict:
+        chats = await run_in_threadpool(self.take, user_id)
+        return {"type": "notifications.summary", "chats": chats}
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.notification_flush_interval)
+            try:
+                await run_in_threadpool(self.flush)
+            except Exception:
+                logger.exception("notification flush failed")
+
+
+notifications = NotificationAggregator()
+lifecycle.on_drain(notifications.flush)
@@ -0,0 +1,214 @@
+"""Query profiling: N+1 and slow statement detection per request.
+
+Statements are grouped by their normalized SQL (literals and bind
+parameters replaced by ``?``). A request that runs the same shape
+``QUERY_REPEAT_THRESHOLD`` times or more is probably lazy loading in a
+loop. Statements slower than ``QUERY_SLOW_SECONDS`` are flagged as well.
+
+Turn it on for a dev server with ``QUERY_PROFILE=1``; every request with a
+finding is logged as a warning. In tests, load this module as a pytest
+plugin (``pytest_plugins = ["profiling"]``, as tests/conftest.py does) and
+use the ``query_budget`` fixture::
+
+    def test_open_chat(client, seed, query_budget):
+        with query_budget():
+            client.get(f"/chats/{seed['chat_id']}")
+
+Any request over its limit, over its entry in ``BUDGETS`` or with a
+repeated statement fails the test.
+"""
+import contextvars
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import event
+
+from config import settings
+from metrics import route_name
+
+logger = logging.getLogger(__name__)
+
+ENABLED = settings.query_profile
+SLOW_QUERY_SECONDS = settings.query_slow_seconds
+REPEAT_THRESHOLD = settings.query_repeat_threshold
+
+# Most statements a request may run, by "METHOD /route". Raising one of
+# these should be a deliberate change in review.
+BUDGETS: Dict[str, int] = {
+    "POST /token": 5,
+    "POST /token/refresh": 5,
+    "GET /users/": 2,
+    "GET /roles/": 2,
+    "POST /role_permissions/": 5,
+    "POST /chats/": 8,
+    "GET /chats/{chat_ref}": 4,
+    "POST /update-chat-members": 5,
+    # A reply adds the parent lookup and its reply_count bump
+    "POST /messages/": 7,
+    "GET /chat/messages/{chat_id}": 3,
+    "GET /messages/{message_id}/thread": 4,
+    "POST /message_reactions/": 7,
+    "POST /sync": 4,
+}
+
+_literals = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|:\w+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"__\[POSTCOMPILE_\w+\]"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize(statement: str) -> str:
+    for pattern, replacement in _literals:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class QueryProfile:
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.statements: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, statement: str, seconds: float):
+        self.statements[normalize(statement)].append(seconds)
+
+    @property
+    def count(self) -> int:
+        return sum(len(timings) for timings in self.statements.values())
+
+    @property
+    def seconds(self) -> float:
+        return sum(sum(timings) for timings in self.statements.values())
+
+    def repeated(self, threshold: Optional[int] = None):
+        threshold = threshold or REPEAT_THRESHOLD
+        return {
+            shape: len(timings)
+            for shape, timings in self.statements.items()
+            if len(timings) >= threshold
+        }
+
+    def slow(self, seconds: Optional[float] = None):
+        seconds = SLOW_QUERY_SECONDS if seconds is None else seconds
+        return [
+            (shape, timing)
+            for shape, timings in self.statements.items()
+            for timing in timings
+            if timing >= seconds
+        ]
+
+    def problems(self, max_queries: Optional[int] = None) -> List[str]:
+        found = []
+        if max_queries is not None and self.count > max_queries:
+            found.append(f"{self.count} queries, budget is {max_queries}")
+        for shape, times in self.repeated().items():
+            found.append(f"repeated {times}x (N+1?): {shape}")
+        for shape, seconds in self.slow():
+            found.append(f"slow {seconds * 1000:.0f}ms: {shape}")
+        return found
+
+
+current_profile: contextvars.ContextVar[Optional[QueryProfile]] = contextvars.ContextVar(
+    "current_profile", default=None
+)
+
+# Called with every finished request profile, the pytest fixture hooks in here
+listeners: List[Callable[[QueryProfile], None]] = []
+
+
+@contextmanager
+def profile_queries(name: str = ""):
+    """Collect the statements run inside the block, in this context."""
+    profile = QueryProfile(name)
+    token = current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        current_profile.reset(token)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_profile.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile.get()
+        if profile is not None and conn.info.get("profile_started"):
+            profile.add(statement, time.perf_counter() - conn.info["profile_started"].pop())
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (ENABLED or listeners):
+            await self.app(scope, receive, send)
+            return
+
+        with profile_queries() as profile:
+            await self.app(scope, receive, send)
+        profile.name = f"{scope['method']} {route_name(scope)}"
+
+        problems = profile.problems(BUDGETS.get(profile.name))
+        if problems:
+            logger.warning("%s: %s", profile.name, "; ".join(problems))
+        for listener in listeners:
+            listener(profile)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryBudget:
+    def __init__(self):
+        self.profiles: List[QueryProfile] = []
+        self.failures: List[str] = []
+
+    def record(self, profile: QueryProfile, max_queries: Optional[int] = None):
+        self.profiles.append(profile)
+        if max_queries is None:
+            max_queries = BUDGETS.get(profile.name)
+        self.failures += [f"{profile.name}: {problem}" for problem in profile.problems(max_queries)]
+
+    @contextmanager
+    def __call__(self, max_queries: Optional[int] = None):
+        def listener(profile):
+            self.record(profile, max_queries)
+
+        listeners.append(listener)
+        try:
+            yield self
+        finally:
+            listeners.remove(listener)
+
+    def check(self):
+        if self.failures:
+            raise QueryBudgetExceeded("\n".join(self.failures))
+
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+if pytest is not None:
+
+    @pytest.fixture
+    def query_budget():
+        """Fail the test when a request inside ``with query_budget(...)`` is
+        over budget, repeats a statement or runs a slow one."""
+        budget = QueryBudget()
+        yield budget
+        budget.check()
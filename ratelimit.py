@@ -0,0 +1,311 @@
+"""Rate limiting and admission control.
+
+Token buckets: every key refills at ``rate`` tokens per second up to
+``burst``, and each request or frame takes one. Limits are named, see
+``LIMITS``; override them with the ``RATE_LIMITS`` setting, e.g.
+``messages=2:10,ws.typing=1:3`` (rate:burst).
+
+Keys are the caller, never something the request body claims:
+
+- ``user:<email>`` for a request with a valid bearer token,
+- ``ip:<address>`` otherwise. The address is the peer's, or the
+  ``X-User-IP`` header when the peer is one of ``TRUSTED_PROXIES``.
+- /ws frames go to ``user:<user_id>``, the user the socket's access
+  token belongs to. Every socket of a user shares one budget.
+
+Buckets live in process memory. Set ``RATE_LIMIT_REDIS_URL`` (and install
+``redis``) to share them, /ws frames included, between workers and hosts.
+Redis is called from the threadpool so frames don't block the event loop.
+
+``AdmissionMiddleware`` caps the HTTP requests in flight at what the
+threadpool running the sync endpoints can serve. Requests wait up to
+``ADMISSION_QUEUE_TIMEOUT`` seconds for a slot, then get a 429 instead of
+queueing for a thread.
+``/ws`` connections over ``MAX_WS_CONNECTIONS`` are closed with 1013
+(try again later), and while the process drains with 1012 (service
+restart) and a ``reconnect_after_ms=`` reason.
+"""
+import asyncio
+import ipaddress
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import jwt
+from cachetools import TTLCache
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+
+from config import ALGORITHM, SECRET_KEY, settings
+import lifecycle
+import metrics
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class Limit(NamedTuple):
+    rate: float
+    burst: int
+
+
+LIMITS: Dict[str, Limit] = {
+    # Per caller, see rate_key()
+    "messages": Limit(5, 20),
+    "reactions": Limit(10, 30),
+    # Per client IP, across every write endpoint
+    "writes": Limit(50, 100),
+    # Per /ws user or address, by frame type, "ws" for the other types
+    "ws": Limit(20, 40),
+    "ws.typing": Limit(2, 5),
+    "ws.message": Limit(5, 20),
+}
+
+
+def parse_limits(spec: str) -> Dict[str, Limit]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition(":")
+        limits[name.strip()] = Limit(float(rate), int(burst or rate))
+    return limits
+
+
+LIMITS.update(parse_limits(settings.rate_limits))
+
+limited = metrics.Counter(
+    "rate_limited_total", "Requests and frames over their rate limit", ["limit"]
+)
+rejected = metrics.Counter(
+    "admission_rejected_total",
+    "Requests and connections shed by admission control",
+    ["transport"],
+)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int = 100_000, ttl: float = 600):
+        # Idle buckets are full again long before they expire
+        self.buckets: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def take(self, key: str, limit: Limit, cost: float = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+        return allowed, 0 if allowed else (cost - tokens) / limit.rate
+
+
+class RedisBackend:
+    SCRIPT = """
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local tokens = math.min(burst, (tonumber(state[1]) or burst) + (now - (tonumber(state[2]) or now)) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key: str, limit: Limit, cost: float = 1) -> Tuple[bool, float]:
+        allowed, tokens = self.script(
+            keys=[f"ratelimit:{key}"], args=[limit.rate, limit.burst, time.time(), cost]
+        )
+        if allowed:
+            return True, 0
+        return False, (cost - float(tokens)) / limit.rate
+
+
+def create_backend():
+    if settings.rate_limit_redis_url:
+        if redis is None:
+            raise RuntimeError(
+                "RATE_LIMIT_REDIS_URL is set but the redis package is not installed"
+            )
+        return RedisBackend(settings.rate_limit_redis_url)
+    return MemoryBackend()
+
+
+backend = create_backend()
+
+
+def parse_networks(spec: str):
+    return [
+        ipaddress.ip_network(part.strip(), strict=False)
+        for part in spec.split(",")
+        if part.strip()
+    ]
+
+
+TRUSTED_PROXIES = parse_networks(settings.trusted_proxies)
+
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(connection: HTTPConnection) -> str:
+    """The caller's address, ``X-User-IP`` only when a trusted proxy sent it.
+
+    The login endpoint checks IP groups against the same address.
+    """
+    peer = connection.client.host if connection.client else ""
+    forwarded = connection.headers.get("X-User-IP")
+    if forwarded and is_trusted_proxy(peer):
+        return forwarded.strip()
+    return peer
+
+
+def token_subject(connection: HTTPConnection) -> Optional[str]:
+    # Signature only, no database: rate limiting runs before everything else
+    scheme, _, token = connection.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except jwt.PyJWTError:
+        return None
+
+
+def rate_key(connection: HTTPConnection) -> str:
+    subject = token_subject(connection)
+    return f"user:{subject}" if subject else f"ip:{client_ip(connection)}"
+
+
+def check_rate(name: str, key, backend=backend):
+    """Take a token from ``name``'s bucket for ``key`` or raise a 429."""
+    if not settings.rate_limit_enabled:
+        return
+    allowed, retry_after = backend.take(f"{name}:{key}", LIMITS[name])
+    if not allowed:
+        limited.inc(limit=name)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, round(retry_after)))},
+        )
+
+
+def limit_writes(request: Request):
+    """Dependency for write endpoints: the per-IP ``writes`` limit."""
+    check_rate("writes", client_ip(request))
+
+
+def limit(name: str):
+    """Dependency charging ``name``'s bucket for the caller, see ``rate_key``."""
+
+    def dependency(request: Request):
+        check_rate(name, rate_key(request))
+
+    return dependency
+
+
+class FrameLimiter:
+    """Token buckets for inbound /ws frames, by frame type.
+
+    Keyed by user, so a client opening more sockets doesn't get more frames.
+    """
+
+    def __init__(self, websocket: HTTPConnection, user_id: Optional[int] = None):
+        self.key = f"user:{user_id}" if user_id is not None else f"ip:{client_ip(websocket)}"
+
+    async def allow(self, frame_type: Optional[str]) -> Tuple[bool, float]:
+        if not settings.rate_limit_enabled:
+            return True, 0
+        name = f"ws.{frame_type}" if f"ws.{frame_type}" in LIMITS else "ws"
+        key = f"{name}:{self.key}"
+        if isinstance(backend, MemoryBackend):
+            allowed, retry_after = backend.take(key, LIMITS[name])
+        else:
+            allowed, retry_after = await run_in_threadpool(backend.take, key, LIMITS[name])
+        if not allowed:
+            limited.inc(limit=name)
+        return allowed, retry_after
+
+
+# Admission control
+
+# anyio's default thread limiter, which runs the sync endpoints. Admitting
+# more only queues requests for a thread, holding their memory meanwhile.
+THREADPOOL_SIZE = 40
+
+
+def max_concurrent_requests() -> int:
+    return settings.max_concurrent_requests or THREADPOOL_SIZE
+
+
+class AdmissionMiddleware:
+    # Stay reachable when everything else is being shed
+    EXEMPT_PATHS = ("/metrics", "/health")
+
+    def __init__(self, app):
+        self.app = app
+        self.slots = asyncio.Semaphore(max_concurrent_requests())
+        self.websockets = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            await self.admit_websocket(scope, receive, send)
+            return
+        if scope["type"] != "http" or scope["path"] in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), settings.admission_queue_timeout)
+        except asyncio.TimeoutError:
+            rejected.inc(transport="http")
+            response = JSONResponse(
+                {"detail": "Server busy, try again"},
+                status_code=429,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.slots.release()
+
+    async def admit_websocket(self, scope, receive, send):
+        if lifecycle.draining:
+            await self.reject_websocket(
+                receive, send, 1012, f"reconnect_after_ms={lifecycle.reconnect_after_ms()}"
+            )
+            return
+        if self.websockets >= settings.max_ws_connections:
+            await self.reject_websocket(receive, send, 1013)
+            return
+        self.websockets += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.websockets -= 1
+
+    async def reject_websocket(self, receive, send, code: int, reason: str = ""):
+        rejected.inc(transport="ws")
+        await receive()  # websocket.connect
+        # Accept first, a close before that is only a 403 to the client
+        await send({"type": "websocket.accept"})
+        await send({"type": "websocket.close", "code": code, "reason": reason})
@@ -0,0 +1,152 @@
+"""Read/write session routing.
+
+Endpoints that only read depend on ``get_read_db``, and endpoints that
+write depend on ``get_write_db``:
+
+- Reads go round-robin to the engines in ``DB_REPLICA_URLS``
+  (comma-separated SQLAlchemy URLs). Without replicas they go to the
+  primary.
+- A replica found down is skipped. Each replica is probed with a
+  ``SELECT 1`` at most every ``DB_REPLICA_CHECK_INTERVAL`` seconds, and a
+  replica that drops a connection mid-query is marked down straight away.
+  With every replica down, reads fall back to the primary.
+- After a write commits, the same caller reads from the primary for
+  ``READ_YOUR_WRITES_SECONDS``, so it doesn't miss its own change while
+  the replicas catch up. A failed write that committed nothing doesn't
+  count. The caller is keyed like the rate limits, see
+  ``ratelimit.rate_key``: the bearer token's user, else the client
+  address. The window should be longer than the usual replication lag.
+- Who wrote recently is kept per process. With several workers, a read
+  served by another worker than the write can still hit a lagging
+  replica. Route a client's requests to one worker (sticky sessions on
+  the load balancer) where that matters.
+
+Two local databases are enough to try this out, e.g.
+``DATABASE_URL=sqlite:///./chat.db DB_REPLICA_URLS=sqlite:///./replica.db``.
+Reads show up under ``db_reads_total{target="replica"}`` on /metrics.
+"""
+import itertools
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from cachetools import TTLCache
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import SessionLocal, create_db_engine, settings
+from ratelimit import rate_key
+import metrics
+import profiling
+
+logger = logging.getLogger(__name__)
+
+reads = metrics.Counter("db_reads_total", "Read sessions by where they were routed", ["target"])
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.name = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_db_engine(url)
+        self.healthy = True
+        self.checked = 0.0
+        metrics.instrument_engine(self.engine, pool_metrics=False)
+        profiling.instrument_engine(self.engine)
+        event.listen(self.engine, "handle_error", self.on_error)
+
+    def on_error(self, context):
+        if context.is_disconnect:
+            self.mark_down(context.original_exception)
+
+    def mark_down(self, error):
+        if self.healthy:
+            logger.warning("replica down", extra={"replica": self.name, "error": repr(error)})
+        self.healthy = False
+
+    def check(self):
+        self.checked = time.monotonic()
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except SQLAlchemyError as e:
+            self.mark_down(e)
+            return
+        if not self.healthy:
+            logger.info("replica back up", extra={"replica": self.name})
+        self.healthy = True
+
+
+class ReplicaSet:
+    def __init__(self, urls: List[str], check_interval: float):
+        self.replicas = [Replica(url) for url in urls]
+        self.check_interval = check_interval
+        self.turns = itertools.count()
+        self.lock = threading.Lock()
+
+    def pick(self) -> Optional[Engine]:
+        """The next healthy replica's engine, or None for the primary."""
+        for _ in range(len(self.replicas)):
+            with self.lock:
+                replica = self.replicas[next(self.turns) % len(self.replicas)]
+                due = time.monotonic() - replica.checked >= self.check_interval
+                if due:
+                    replica.checked = time.monotonic()
+            if due:
+                replica.check()
+            if replica.healthy:
+                return replica.engine
+        return None
+
+
+replicas = ReplicaSet(
+    [url.strip() for url in settings.db_replica_urls.split(",") if url.strip()],
+    settings.db_replica_check_interval,
+)
+healthy_replicas = metrics.Gauge(
+    "db_replicas_healthy",
+    "Replicas currently taking reads",
+    function=lambda: sum(replica.healthy for replica in replicas.replicas),
+)
+
+# Clients that wrote within the last READ_YOUR_WRITES_SECONDS
+recent_writers: TTLCache = TTLCache(maxsize=100_000, ttl=settings.read_your_writes_seconds)
+recent_writers_lock = threading.Lock()
+
+
+def wrote_recently(caller: str) -> bool:
+    with recent_writers_lock:
+        return caller in recent_writers
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def remember_writer(session):
+    # At the commit itself, before the response can reach the client
+    writer = session.info.get("writer")
+    if writer is not None:
+        with recent_writers_lock:
+            recent_writers[writer] = True
+
+
+def get_write_db(request: Request):
+    """A primary session, once it commits the caller's reads stick to the
+    primary for a while."""
+    db = SessionLocal()
+    db.info["writer"] = rate_key(request)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    """A session on a replica, or on the primary if none can take it."""
+    engine = None if wrote_recently(rate_key(request)) else replicas.pick()
+    reads.inc(target="primary" if engine is None else "replica")
+    db = SessionLocal() if engine is None else SessionLocal(bind=engine)
+    try:
+        yield db
+    finally:
+        db.close()
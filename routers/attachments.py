@@ -0,0 +1,99 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from datetime import datetime
+
+from ratelimit import limit_writes
+from replicas import get_read_db, get_write_db
+from services import resolve_message_id
+from storage import BlobResponse, safe_content_type, store_stream
+import models, schemas
+
+router = APIRouter()
+
+# Attachment Endpoints
+
+
+def save_attachment(db: Session, message_id, sha256, size, content_type, filename):
+    attachment = models.Attachment(
+        message_id=message_id,
+        sha256=sha256,
+        size=size,
+        content_type=content_type,
+        filename=filename,
+        created_at=datetime.now(),
+    )
+    db.add(attachment)
+    db.query(models.Message).filter(models.Message.id == message_id).update(
+        {"is_file": True}, synchronize_session=False
+    )
+    db.commit()
+    db.refresh(attachment)
+    return attachment
+
+
+# The body is the raw file, streamed to disk as it arrives:
+#   POST /messages/{message_id}/attachments?filename=report.pdf
+#   Content-Type: application/pdf
+# Types that aren't safe to show inline are stored as application/octet-stream,
+# see storage.INLINE_TYPES
+@router.post(
+    "/messages/{message_id}/attachments",
+    response_model=schemas.Attachment,
+    dependencies=[Depends(limit_writes)],
+)
+async def upload_attachment(
+    message_id: str,
+    request: Request,
+    filename: Optional[str] = None,
+    db: Session = Depends(get_write_db),
+):
+    message_id = await run_in_threadpool(resolve_message_id, db, message_id)
+    if message_id is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    sha256, size = await store_stream(request.stream())
+    return await run_in_threadpool(
+        save_attachment,
+        db,
+        message_id,
+        sha256,
+        size,
+        safe_content_type(request.headers.get("content-type")),
+        filename,
+    )
+
+
+@router.get("/messages/{message_id}/attachments", response_model=List[schemas.Attachment])
+def get_message_attachments(message_id: str, db: Session = Depends(get_read_db)):
+    attachments = (
+        db.query(models.Attachment)
+        .filter(models.Attachment.message_id == resolve_message_id(db, message_id))
+        .all()
+    )
+    return attachments
+
+
+@router.get("/attachments/{attachment_id}")
+def download_attachment(
+    attachment_id: int, request: Request, db: Session = Depends(get_read_db)
+):
+    attachment = (
+        db.query(models.Attachment)
+        .filter(models.Attachment.id == attachment_id)
+        .first()
+    )
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    if request.headers.get("if-none-match") == f'"{attachment.sha256}"':
+        return Response(status_code=304, headers={"etag": f'"{attachment.sha256}"'})
+
+    return BlobResponse(
+        attachment.sha256,
+        attachment.size,
+        range_header=request.headers.get("range"),
+        media_type=attachment.content_type,
+        filename=attachment.filename,
+    )
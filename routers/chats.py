@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+import time
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy import or_
 from typing import List
 from datetime import datetime
 
-from config import get_db
+from config import engine
+from helper import changed_fields
+from hot_chats import hot_chats
+from replicas import get_read_db, get_write_db
+from routers.websocket import manager
+from services import get_chat_by_ref, set_chat_members
+import jobs
 import models, schemas
 
 router = APIRouter()
@@ -13,7 +21,11 @@ router = APIRouter()
 
 
 @router.post("/chats/", response_model=schemas.Chat)
-def create_chat(chat: schemas.ChatCreate, db: Session = Depends(get_db)):
+def create_chat(
+    chat: schemas.ChatCreate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
+):
     db_chat = models.Chat(
         chat_name=chat.chat_name,
         image_url=chat.image_url,
@@ -22,34 +34,31 @@ def create_chat(chat: schemas.ChatCreate, db: Session = Depends(get_db)):
         last_modified_at=datetime.now(),
     )
     db.add(db_chat)
+    db.flush()
+    members, added, removed = set(), set(), set()
+    if db_chat.is_group and chat.members:
+        members, added, removed = set_chat_members(db, db_chat.id, chat.members)
     db.commit()
     db.refresh(db_chat)
-    if db_chat.is_group:
-        if len(chat.members) > 0:
-            for each_member in chat.members:
-                new_member = models.ChatMember(
-                    chat_id=chat.chat_name,
-                    user_id=int(each_member),
-                    joined_at=datetime.now(),
-                    last_modified_at=datetime.now(),
-                )
-                db.add(new_member)
-                db.commit()
-                db.refresh(new_member)
+    if added:
+        background_tasks.add_task(
+            manager.chat_members_changed, db_chat.id, members, added, removed
+        )
 
     return db_chat
 
 
 @router.get("/chats/", response_model=List[schemas.Chat])
-def get_chats(db: Session = Depends(get_db)):
-    chats = db.query(models.Chat).all()
+def get_chats(db: Session = Depends(get_read_db)):
+    chats = db.query(models.Chat).filter(models.Chat.deleted_at.is_(None)).all()
     return chats
 
 
 @router.get("/group-chats/", response_model=List[schemas.Chat])
-def get_group_chats(request: Request, db: Session = Depends(get_db)):
+def get_group_chats(request: Request, db: Session = Depends(get_read_db)):
     user_id = request.headers.get("user_id")
     chats = db.query(models.Chat).filter(
+        models.Chat.deleted_at.is_(None),
         models.Chat.is_group == True,
         models.Chat.chat_members.any(models.ChatMember.user_id == user_id)
     ).all()
@@ -57,26 +66,36 @@ def get_group_chats(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/direct-chats/", response_model=List[schemas.Chat])
-def get_direct_chats(request: Request, db: Session = Depends(get_db)):
+def get_direct_chats(request: Request, db: Session = Depends(get_read_db)):
     user_id = request.headers.get("user_id")
     chats = db.query(models.Chat).filter(
+        models.Chat.deleted_at.is_(None),
         models.Chat.is_group == False,
         or_(models.Chat.chat_name.like(f"%-{user_id}-%"), models.Chat.chat_name.like(f"%-{user_id}"))
     ).all()
     return chats
 
 
-@router.get("/chats/{chat_name}", response_model=schemas.Chat)
-def get_chat(chat_name: str, db: Session = Depends(get_db)):
-    chat = db.query(models.Chat).filter(models.Chat.chat_name == chat_name).first()
+@router.get("/chats/{chat_ref}", response_model=schemas.Chat)
+def get_chat(chat_ref: str, db: Session = Depends(get_read_db)):
+    cached = hot_chats.get(chat_ref)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+
+    started = time.monotonic()
+    chat = get_chat_by_ref(db, chat_ref)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    chat.messages = db.query(models.Message).filter_by(chat_id=chat.chat_name).order_by(models.Message.created_at.desc()).limit(100).all()
-    return chat
+    # A few more than are returned, so the cached copy survives deletes
+    messages = db.query(models.Message).options(selectinload(models.Message.reactions)).filter_by(chat_id=chat.id).order_by(models.Message.created_at.desc()).limit(hot_chats.load_limit).all()
+    # Without loading the full collection first, as plain assignment would
+    set_committed_value(chat, "messages", messages[: hot_chats.limit])
+    content = hot_chats.fill(chat_ref, chat, messages, started, primary=db.get_bind() is engine)
+    return Response(content, media_type="application/json")
 
 
 @router.get("/chats/check/{chat_name}")
-def check_group_name(chat_name: str, db: Session = Depends(get_db)):
+def check_group_name(chat_name: str, db: Session = Depends(get_read_db)):
     chat = db.query(models.Chat).filter(models.Chat.chat_name == chat_name).first()
     if not chat:
         return {"is_exist": False}
@@ -84,55 +103,71 @@ def check_group_name(chat_name: str, db: Session = Depends(get_db)):
         return {"is_exist": True}
 
 
-@router.put("/chats/{chat_name}", response_model=schemas.Chat)
+@router.put("/chats/{chat_ref}", response_model=schemas.Chat)
 def update_chat(
-    chat_name: str, chat: schemas.ChatUpdate, db: Session = Depends(get_db)
+    chat_ref: str,
+    chat: schemas.ChatUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
 ):
-    db_chat = db.query(models.Chat).filter(models.Chat.chat_name == chat_name).first()
+    db_chat = get_chat_by_ref(db, chat_ref)
     if not db_chat:
         raise HTTPException(status_code=404, detail="Chat not found")
+    before = db_chat.as_dict()
     db_chat.chat_name = chat.chat_name
     db_chat.image_url = chat.image_url
     db_chat.is_group = chat.is_group
     db_chat.last_modified_at = datetime.now()
     db.commit()
+    hot_chats.invalidate(db_chat.id)
     db.refresh(db_chat)
+    changes = changed_fields(before, db_chat.as_dict(), ignore=("last_modified_at",))
+    if changes:
+        background_tasks.add_task(
+            manager.publish_to_chat,
+            db_chat.id,
+            {
+                "type": "chat.updated",
+                "chat_id": db_chat.id,
+                "changes": changes,
+                "last_modified_at": db_chat.last_modified_at,
+            },
+        )
     return db_chat
 
 
-@router.delete("/chats/{chat_name}")
-def delete_chat(chat_name: str, db: Session = Depends(get_db)):
-    db_chat = db.query(models.Chat).filter(models.Chat.chat_name == chat_name).first()
+@router.delete("/chats/{chat_ref}", status_code=202)
+def delete_chat(chat_ref: str, db: Session = Depends(get_write_db)):
+    db_chat = get_chat_by_ref(db, chat_ref)
     if not db_chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    db.delete(db_chat)
-    db.commit()
-    return {"message": "Chat deleted"}
+    # Gone for the API now, removed in batches by a background job, see jobs.py
+    db_chat.deleted_at = datetime.now()
+    job = jobs.enqueue(db, "purge_chat", db_chat.id)
+    hot_chats.invalidate(db_chat.id)
+    return {"message": "Chat deletion queued", "job_id": job.id}
 
 
 @router.post("/update-chat-members")
-def update_chat_members(request: schemas.ChatMemberUpdate, db: Session = Depends(get_db)):
-    try:
-        chat = db.query(models.Chat).filter_by(chat_name=request.chat_id).first()
-
-        if chat:
-            # Delete members not in the new list
-            db.query(models.ChatMember).filter(models.ChatMember.chat_id == chat.chat_name, ~models.ChatMember.user_id.in_(request.user_ids)).delete(synchronize_session=False)
-
-            # Add new members
-            for user_id in request.user_ids:
-                user = db.query(models.User).filter_by(id=user_id).first()
-
-                if user:
-                    # Check if the user is not already a member
-                    existing_member = db.query(models.ChatMember).filter_by(chat_id=chat.chat_name, user_id=user.id).first()
-                    if not existing_member:
-                        chat_member = models.ChatMember(chat_id=chat.chat_name, user_id=user.id, joined_at=datetime.now())
-                        db.add(chat_member)
-            db.commit()
-            return {"message": "Chat members updated successfully.", "chat_members": chat.chat_members}
-        else:
-            raise HTTPException(status_code=404, detail="Chat not found.")
+def update_chat_members(
+    request: schemas.ChatMemberUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
+):
+    chat = get_chat_by_ref(db, request.chat_id) if request.chat_id is not None else None
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found.")
 
+    try:
+        members, added, removed = set_chat_members(db, chat.id, request.user_ids)
+        db.commit()
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+    if added or removed:
+        hot_chats.invalidate(chat.id)
+        background_tasks.add_task(
+            manager.chat_members_changed, chat.id, members, added, removed
+        )
+    return {"message": "Chat members updated successfully.", "chat_members": chat.chat_members}
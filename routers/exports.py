@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from datetime import datetime
+
+from config import SessionLocal
+from helper import iter_data_with_relations, local_naive, ndjson_batches
+from replicas import get_read_db
+from services import resolve_chat_id
+import models
+
+router = APIRouter()
+
+EXPORT_RELATIONS = {
+    "reactions": models.Message.reactions,
+    "attachments": models.Message.attachments,
+}
+
+# Export Endpoints
+
+
+def stream_messages(filters, relations, bind):
+    # The request's session is closed once the endpoint returns, the
+    # generator runs after that and needs its own, on the same database
+    db = SessionLocal(bind=bind)
+    try:
+        yield from ndjson_batches(
+            iter_data_with_relations(db, models.Message, relations, filters)
+        )
+    finally:
+        db.close()
+
+
+@router.get("/exports/messages")
+def export_messages(
+    chat_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    include: List[str] = Query([]),
+    db: Session = Depends(get_read_db),
+):
+    """Stream messages as NDJSON, one JSON object per line.
+
+    Filter by chat (id or name) and by ``created_at`` in ``[since, until)``.
+    ``include=reactions`` and ``include=attachments`` nest those rows in
+    each message. Rows are read and encoded in batches, so memory stays
+    flat however large the export is.
+    """
+    unknown = set(include) - EXPORT_RELATIONS.keys()
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Cannot include {', '.join(sorted(unknown))}"
+        )
+
+    filters = []
+    if chat_id is not None:
+        resolved = resolve_chat_id(db, chat_id)
+        if resolved is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        filters.append(models.Message.chat_id == resolved)
+    if since is not None:
+        filters.append(models.Message.created_at >= local_naive(since))
+    if until is not None:
+        filters.append(models.Message.created_at < local_naive(until))
+
+    return StreamingResponse(
+        stream_messages(filters, [EXPORT_RELATIONS[name] for name in include], db.get_bind()),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="messages-{datetime.now():%Y%m%d-%H%M%S}.ndjson"'
+        },
+    )
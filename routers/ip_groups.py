@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List
 from datetime import datetime
 
-from config import get_db
+from replicas import get_read_db, get_write_db
+from services import set_ip_group_users
 import models, schemas
 
 router = APIRouter()
@@ -12,33 +14,31 @@ router = APIRouter()
 
 
 @router.post("/ip_groups")
-def create_ip_group(ip_group: schemas.IPGroupBase, db: Session = Depends(get_db)):
+def create_ip_group(ip_group: schemas.IPGroupBase, db: Session = Depends(get_write_db)):
     try:
         new_ip_group = models.IPGroup(ip=ip_group.ip, name=ip_group.name)
         db.add(new_ip_group)
+        db.flush()
+        users = set_ip_group_users(db, ip_group.ip, ip_group.users)
         db.commit()
-        db.refresh(new_ip_group)
-        if len(ip_group.users) > 0:
-            for user_id in ip_group.users:
-                user = db.query(models.User).filter(models.User.id == user_id).first()
-                user.ip_group_id = ip_group.ip
-                db.commit()
-                db.refresh(user)
-        return {"message": "IP Group created successfully"}
-    except:
+    except IntegrityError:
         db.rollback()
-        return {"message": "Failed to create IP Group"}
+        raise HTTPException(status_code=400, detail="Failed to create IP Group")
+    return {
+        "message": "IP Group created successfully",
+        "ip_group": {"ip": ip_group.ip, "name": ip_group.name, "users": sorted(users)},
+    }
 
 
 @router.get("/ip_groups")
-def get_ip_groups(db: Session = Depends(get_db)):
+def get_ip_groups(db: Session = Depends(get_read_db)):
     ip_groups = db.query(models.IPGroup).all()
     return ip_groups
 
 
 @router.put("/ip_groups")
 def update_ip_group(
-    updated_ip_group: schemas.IPGroupBase, db: Session = Depends(get_db)
+    updated_ip_group: schemas.IPGroupBase, db: Session = Depends(get_write_db)
 ):
     ip_group = (
         db.query(models.IPGroup)
@@ -47,15 +47,26 @@ def update_ip_group(
     )
     if ip_group:
         ip_group.name = updated_ip_group.name
+        # Leave the members alone unless the client sent a list
+        if updated_ip_group.users is not None:
+            users = set_ip_group_users(db, ip_group.ip, updated_ip_group.users)
+        else:
+            users = {user.id for user in ip_group.users}
         db.commit()
-        db.refresh(ip_group)
-        return {"message": "IP Group updated successfully"}
+        return {
+            "message": "IP Group updated successfully",
+            "ip_group": {
+                "ip": updated_ip_group.ip,
+                "name": updated_ip_group.name,
+                "users": sorted(users),
+            },
+        }
     else:
         return {"message": "IP Group not found"}
 
 
 @router.delete("/ip_groups/{ip}")
-def delete_ip_group(ip: str, db: Session = Depends(get_db)):
+def delete_ip_group(ip: str, db: Session = Depends(get_write_db)):
     ip_group = db.query(models.IPGroup).filter(models.IPGroup.ip == ip).first()
     if ip_group:
         db.delete(ip_group)
@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import List, Optional
+
+from replicas import get_read_db
+import models, schemas
+
+router = APIRouter()
+
+# Background Job Endpoints
+
+
+@router.get("/jobs/", response_model=List[schemas.Job])
+def get_jobs(
+    state: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_read_db),
+):
+    query = db.query(models.Job)
+    if state is not None:
+        query = query.filter(models.Job.state == state)
+    return query.order_by(models.Job.id.desc()).offset(skip).limit(limit).all()
+
+
+@router.get("/jobs/{job_id}", response_model=schemas.Job)
+def get_job(job_id: int, db: Session = Depends(get_read_db)):
+    job = db.query(models.Job).filter(models.Job.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -1,9 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import List, Optional
 from datetime import datetime
 
-from config import get_db
+from helper import changed_fields
+from hot_chats import hot_chats
+from ids import next_id
+from notifications import notifications
+from ratelimit import limit, limit_writes
+from replicas import get_read_db, get_write_db
+from routers.websocket import manager
+from services import (
+    change_reply_count,
+    get_message_by_ref,
+    is_active_user,
+    resolve_chat_id,
+    resolve_message_id,
+    thread_replies,
+)
+import jobs
 import models, schemas
 
 router = APIRouter()
@@ -11,8 +28,41 @@ router = APIRouter()
 # Message Endpoints
 
 
-@router.post("/messages/", response_model=schemas.Message)
-def create_message(message: schemas.MessageBase, db: Session = Depends(get_db)):
+def message_updated_event(db_message, changes):
+    # Ids go out as strings, like everywhere else in the API
+    for key in ("id", "parent_message_id"):
+        if changes.get(key) is not None:
+            changes[key] = str(changes[key])
+    return {
+        "type": "message.updated",
+        "chat_id": db_message.chat_id,
+        "message_id": str(db_message.id),
+        "changes": changes,
+        "last_modified_at": db_message.last_modified_at,
+    }
+
+
+def publish_message_update(background_tasks, db_message, before):
+    changes = changed_fields(before, db_message.as_dict(), ignore=("last_modified_at",))
+    if not changes:
+        return
+    event = message_updated_event(db_message, changes)
+    background_tasks.add_task(manager.publish_to_chat, db_message.chat_id, event)
+    if before["chat_id"] != db_message.chat_id:
+        # Moved to another chat, the old one has to drop it too
+        background_tasks.add_task(manager.publish_to_chat, before["chat_id"], event)
+
+
+@router.post(
+    "/messages/",
+    response_model=schemas.Message,
+    dependencies=[Depends(limit_writes), Depends(limit("messages"))],
+)
+def create_message(
+    message: schemas.MessageBase,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
+):
     # chat_sequance = 1
 
     # last_message = (
@@ -25,49 +75,145 @@ def create_message(message: schemas.MessageBase, db: Session = Depends(get_db)):
     # # if last_message:
     # #     chat_sequance = last_message.chat_sequance + 1
 
-    db_message = models.Message(
-        id=message.id,
-        chat_sequance=1,
-        chat_id=message.chat_id,
-        sender_id=message.sender_id,
-        parent_message_id=message.parent_message_id,
-        timestamp=datetime.now(),
-        message=message.message,
-        seen=message.seen or False,
-        is_file=message.is_file or False,
-        created_at=datetime.now(),
-        last_modified_at=datetime.now(),
-    )
-    db.add(db_message)
-    db.commit()
+    chat_id = resolve_chat_id(db, message.chat_id)
+    if chat_id is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not is_active_user(db, message.sender_id):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    parent_message_id = resolve_message_id(db, message.parent_message_id)
+    for attempt in range(2):
+        message_id = next_id()
+        db_message = models.Message(
+            id=message_id,
+            client_id=message.id,
+            chat_sequance=1,
+            chat_id=chat_id,
+            sender_id=message.sender_id,
+            parent_message_id=parent_message_id,
+            timestamp=datetime.now(),
+            message=message.message,
+            seen=message.seen or False,
+            is_file=message.is_file or False,
+            created_at=datetime.now(),
+            last_modified_at=datetime.now(),
+        )
+        db.add(db_message)
+        if parent_message_id is not None:
+            replied_at = change_reply_count(db, chat_id, parent_message_id, 1)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            if message.id is not None:
+                # A retry of a message we already stored, hand back the original
+                existing = (
+                    db.query(models.Message)
+                    .filter(models.Message.client_id == message.id)
+                    .first()
+                )
+                if existing is not None:
+                    return existing
+            # Two processes sharing a worker id can make the same id in the
+            # same millisecond, one fresh id is enough
+            taken = db.query(models.Message.id).filter(models.Message.id == message_id).first()
+            if attempt or taken is None:
+                raise
     db.refresh(db_message)
+    # Brand new, there are no reactions to load
+    set_committed_value(db_message, "reactions", [])
+    hot_chats.message_created(db_message)
+    background_tasks.add_task(
+        notifications.message_created,
+        chat_id,
+        db_message.id,
+        db_message.sender_id,
+        db_message.message,
+        db_message.created_at,
+        manager.user_connections,
+    )
+    if db_message.parent_message_id is not None:
+        hot_chats.reply_count_changed(chat_id, db_message.parent_message_id, 1, replied_at)
     return db_message
 
 
 @router.get("/messages/", response_model=List[schemas.Message])
-def get_messages(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    messages = db.query(models.Message).offset(skip).limit(limit).all()
+def get_messages(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
+    messages = (
+        db.query(models.Message)
+        .options(selectinload(models.Message.reactions))
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
     return messages
 
 
 @router.get("/chat/messages/{chat_id}", response_model=List[schemas.Message])
-def get_message(chat_id: str, db: Session = Depends(get_db)):
-    messages = db.query(models.Message).filter(models.Message.chat_id == chat_id).all()
+def get_message(chat_id: str, db: Session = Depends(get_read_db)):
+    chat_id = resolve_chat_id(db, chat_id)
+    messages = (
+        db.query(models.Message)
+        .options(selectinload(models.Message.reactions))
+        .filter(models.Message.chat_id == chat_id)
+        .all()
+    )
     if not messages or len(messages) == 0:
         raise HTTPException(status_code=404, detail="Message not found")
     return messages
 
 
-@router.put("/messages/{message_id}", response_model=schemas.Message)
+@router.get("/messages/{message_id}/thread", response_model=schemas.Thread)
+def get_thread(
+    message_id: str,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    nested: bool = False,
+    db: Session = Depends(get_read_db),
+):
+    """A message and a page of its replies, oldest first.
+
+    Direct replies only, or with ``nested=true`` the replies to replies as
+    well, each with its ``depth`` below the root. Pass ``next_cursor`` as
+    ``after`` for the next page.
+    """
+    root = get_message_by_ref(db, message_id)
+    if not root:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if after is not None and not after.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    rows = thread_replies(db, root, nested, int(after) if after else None, limit + 1)
+    page = rows[:limit]
+    replies = [
+        schemas.ThreadReply(**schemas.Message.model_validate(message).model_dump(), depth=depth)
+        for message, depth in page
+    ]
+    return {
+        "root": root,
+        "replies": replies,
+        "next_cursor": str(page[-1][0].id) if len(rows) > limit else None,
+    }
+
+
+@router.put(
+    "/messages/{message_id}", response_model=schemas.Message, dependencies=[Depends(limit_writes)]
+)
 def update_message(
-    message_id: str, message: schemas.MessageUpdate, db: Session = Depends(get_db)
+    message_id: str,
+    message: schemas.MessageUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
 ):
-    db_message = (
-        db.query(models.Message).filter(models.Message.id == message_id).first()
-    )
+    db_message = get_message_by_ref(db, message_id)
     if not db_message:
         raise HTTPException(status_code=404, detail="Message not found")
-    db_message.chat_id = message.chat_id
+    before = db_message.as_dict()
+    chat_id = resolve_chat_id(db, message.chat_id)
+    if chat_id is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    db_message.chat_id = chat_id
     db_message.sender_id = message.sender_id
     db_message.timestamp = datetime.now()
     db_message.message = message.message
@@ -76,29 +222,73 @@ def update_message(
     db_message.last_modified_at = datetime.now()
     db.commit()
     db.refresh(db_message)
+    hot_chats.message_updated(db_message, before["chat_id"])
+    publish_message_update(background_tasks, db_message, before)
     return db_message
 
 
-@router.delete("/messages/{message_id}")
-def delete_message(message_id: str, db: Session = Depends(get_db)):
-    db_message = (
-        db.query(models.Message).filter(models.Message.id == message_id).first()
-    )
+@router.delete("/messages/{message_id}", dependencies=[Depends(limit_writes)])
+def delete_message(
+    message_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_write_db)
+):
+    db_message = get_message_by_ref(db, message_id)
     if not db_message:
         raise HTTPException(status_code=404, detail="Message not found")
+    tombstone = models.Tombstone(
+        kind="message",
+        object_id=str(db_message.id),
+        message_id=str(db_message.id),
+        chat_id=db_message.chat_id,
+        deleted_at=datetime.now(),
+    )
+    event = {
+        "type": "message.deleted",
+        "chat_id": tombstone.chat_id,
+        "message_id": tombstone.message_id,
+        "deleted_at": tombstone.deleted_at,
+    }
+    parent_id = db_message.parent_message_id
+    if parent_id is not None:
+        replied_at = change_reply_count(db, db_message.chat_id, parent_id, -1)
+    db.add(tombstone)
+    # Its reactions and attachments go in the same transaction. Each
+    # reaction leaves a tombstone, like a single reaction delete does.
+    reactions = models.MessageReaction.message_id == db_message.id
+    db.add_all(
+        models.Tombstone(
+            kind="reaction",
+            object_id=str(reaction_id),
+            message_id=str(db_message.id),
+            chat_id=db_message.chat_id,
+            deleted_at=tombstone.deleted_at,
+        )
+        for (reaction_id,) in db.query(models.MessageReaction.id).filter(reactions)
+    )
+    db.query(models.MessageReaction).filter(reactions).delete(synchronize_session=False)
+    attachments = models.Attachment.message_id == db_message.id
+    blobs = {sha256 for (sha256,) in db.query(models.Attachment.sha256).filter(attachments)}
+    db.query(models.Attachment).filter(attachments).delete(synchronize_session=False)
     db.delete(db_message)
     db.commit()
+    jobs.remove_unused_blobs(db, blobs)
+    hot_chats.message_deleted(event["chat_id"], int(event["message_id"]))
+    if parent_id is not None:
+        hot_chats.reply_count_changed(event["chat_id"], parent_id, -1, replied_at)
+    background_tasks.add_task(manager.publish_to_chat, event["chat_id"], event)
     return {"message": "Message deleted"}
 
 
 @router.get("/messages/{message_id}")
-def seen_message(message_id: str, db: Session = Depends(get_db)):
-    db_message = (
-        db.query(models.Message).filter(models.Message.id == message_id).first()
-    )
+def seen_message(
+    message_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_write_db)
+):
+    db_message = get_message_by_ref(db, message_id)
     if not db_message:
         raise HTTPException(status_code=404, detail="Message not found")
+    before = db_message.as_dict()
     db_message.seen = True
     db.commit()
     db.refresh(db_message)
+    hot_chats.message_updated(db_message, before["chat_id"])
+    publish_message_update(background_tasks, db_message, before)
     return {"message": "Message Seen"}
@@ -1,9 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List
 from datetime import datetime
 
-from config import get_db
+from helper import upsert
+from hot_chats import hot_chats
+from ratelimit import limit, limit_writes
+from replicas import get_read_db, get_write_db
+from routers.websocket import manager
+from services import (
+    is_active_user,
+    lock_message,
+    lock_messages,
+    refresh_reaction_counts,
+    resolve_message_id,
+)
 import models, schemas
 
 router = APIRouter()
@@ -11,40 +23,63 @@ router = APIRouter()
 # Message Reaction Endpoints
 
 
-@router.post("/message_reactions/")
+def reaction_event(chat_id, message_id, user_id, reaction, counts):
+    return {
+        "type": "reaction.changed",
+        "chat_id": chat_id,
+        "message_id": str(message_id),
+        "user_id": user_id,
+        "reaction": reaction,
+        "counts": counts,
+    }
+
+
+@router.post(
+    "/message_reactions/", dependencies=[Depends(limit_writes), Depends(limit("reactions"))]
+)
 def create_message_reaction(
-    reaction: schemas.MessageReactionCreate, db: Session = Depends(get_db)
+    reaction: schemas.MessageReactionCreate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
 ):
-    user_reaction = (
-        db.query(models.MessageReaction)
-        .filter(
-            models.MessageReaction.message_id == reaction.message_id,
-            models.MessageReaction.user_id == reaction.user_id,
-        )
-        .first()
+    if not is_active_user(db, reaction.user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    message = lock_message(db, reaction.message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    upsert(
+        db,
+        models.MessageReaction,
+        {
+            "message_id": message.id,
+            "user_id": reaction.user_id,
+            "reaction": reaction.reaction,
+            "created_at": datetime.now(),
+            "last_modified_at": datetime.now(),
+        },
+        index_elements=["message_id", "user_id"],
+        update_columns=["reaction", "last_modified_at"],
+    )
+    counts = refresh_reaction_counts(db, message.id)
+    db.commit()
+    hot_chats.reactions_changed(db, message.chat_id, message.id, counts)
+    background_tasks.add_task(
+        manager.publish_to_chat,
+        message.chat_id,
+        reaction_event(
+            message.chat_id,
+            message.id,
+            reaction.user_id,
+            reaction.reaction,
+            counts,
+        ),
     )
-    if user_reaction:
-        user_reaction.reaction = reaction.reaction
-        user_reaction.last_modified_at = datetime.now()
-        db.commit()
-        db.refresh(user_reaction)
-    else:
-        db_reaction = models.MessageReaction(
-            message_id=reaction.message_id,
-            user_id=reaction.user_id,
-            reaction=reaction.reaction,
-            created_at=datetime.now(),
-            last_modified_at=datetime.now(),
-        )
-        db.add(db_reaction)
-        db.commit()
-        db.refresh(db_reaction)
     return "Reaction Added"
 
 
 @router.get("/message_reactions/", response_model=List[schemas.MessageReaction])
 def get_message_reactions(
-    skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+    skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)
 ):
     reactions = db.query(models.MessageReaction).offset(skip).limit(limit).all()
     return reactions
@@ -53,10 +88,10 @@ def get_message_reactions(
 @router.get(
     "/message_reactions/{message_id}", response_model=List[schemas.MessageReaction]
 )
-def get_message_reaction(message_id: str, db: Session = Depends(get_db)):
+def get_message_reaction(message_id: str, db: Session = Depends(get_read_db)):
     reaction = (
         db.query(models.MessageReaction)
-        .filter(models.MessageReaction.id == message_id)
+        .filter(models.MessageReaction.message_id == resolve_message_id(db, message_id))
         .all()
     )
 
@@ -65,30 +100,82 @@ def get_message_reaction(message_id: str, db: Session = Depends(get_db)):
     return reaction
 
 
-@router.put("/message_reactions/{reaction_id}", response_model=schemas.MessageReaction)
+@router.put(
+    "/message_reactions/{reaction_id}",
+    response_model=schemas.MessageReaction,
+    dependencies=[Depends(limit_writes)],
+)
 def update_message_reaction(
     reaction_id: int,
     reaction: schemas.MessageReactionUpdate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
 ):
     db_reaction = (
         db.query(models.MessageReaction)
         .filter(models.MessageReaction.id == reaction_id)
         .first()
     )
-    if not db_reaction:
+    message_id = resolve_message_id(db, reaction.message_id)
+    if not db_reaction or message_id is None:
         raise HTTPException(status_code=404, detail="Message Reaction not found")
-    db_reaction.message_id = reaction.message_id
+    old_message_id = db_reaction.message_id
+    # Both messages' counts are rebuilt, so both are locked, in id order
+    locked = lock_messages(db, {old_message_id, message_id})
+    message = locked.get(message_id)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message Reaction not found")
+    moved = (
+        db.query(models.MessageReaction)
+        .filter(models.MessageReaction.id == reaction_id)
+        .populate_existing()
+        .first()
+    )
+    if moved is None or moved.message_id != old_message_id:
+        # Deleted or moved by another request while this one waited
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Message Reaction changed, try again")
+    db_reaction.message_id = message.id
     db_reaction.user_id = reaction.user_id
     db_reaction.reaction = reaction.reaction
     db_reaction.last_modified_at = datetime.now()
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=409, detail="The user already reacted to that message"
+        )
+    if old_message_id != message.id:
+        old_counts = refresh_reaction_counts(db, old_message_id)
+    counts = refresh_reaction_counts(db, message.id)
     db.commit()
+    if old_message_id != message.id:
+        # Reactions move between messages of one chat, a cached copy
+        # anywhere else only catches up when it expires
+        hot_chats.reactions_changed(db, message.chat_id, old_message_id, old_counts)
+    hot_chats.reactions_changed(db, message.chat_id, message.id, counts)
     db.refresh(db_reaction)
+    background_tasks.add_task(
+        manager.publish_to_chat,
+        message.chat_id,
+        reaction_event(
+            message.chat_id,
+            message.id,
+            reaction.user_id,
+            reaction.reaction,
+            counts,
+        ),
+    )
     return db_reaction
 
 
-@router.delete("/message_reactions/{reaction_id}")
-def delete_message_reaction(reaction_id: int, db: Session = Depends(get_db)):
+@router.delete("/message_reactions/{reaction_id}", dependencies=[Depends(limit_writes)])
+def delete_message_reaction(
+    reaction_id: int,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
+):
     db_reaction = (
         db.query(models.MessageReaction)
         .filter(models.MessageReaction.id == reaction_id)
@@ -96,6 +183,29 @@ def delete_message_reaction(reaction_id: int, db: Session = Depends(get_db)):
     )
     if not db_reaction:
         raise HTTPException(status_code=404, detail="Message Reaction not found")
+    # By id: lock_message takes references and would prefer a message
+    # whose client_id happens to look like this id
+    message = lock_messages(db, [db_reaction.message_id]).get(db_reaction.message_id)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    db.add(
+        models.Tombstone(
+            kind="reaction",
+            object_id=str(db_reaction.id),
+            message_id=str(db_reaction.message_id),
+            chat_id=message.chat_id,
+            deleted_at=datetime.now(),
+        )
+    )
+    message_id, user_id = db_reaction.message_id, db_reaction.user_id
     db.delete(db_reaction)
+    db.flush()
+    counts = refresh_reaction_counts(db, message_id)
     db.commit()
+    hot_chats.reactions_changed(db, message.chat_id, message_id, counts)
+    background_tasks.add_task(
+        manager.publish_to_chat,
+        message.chat_id,
+        reaction_event(message.chat_id, message_id, user_id, None, counts),
+    )
     return {"message": "Message Reaction deleted"}
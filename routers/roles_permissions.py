@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
 from typing import List
 from datetime import datetime
 
-from config import get_db
+from replicas import get_read_db, get_write_db
+from services import set_role_permissions
 import models, schemas
 
 router = APIRouter()
@@ -12,43 +14,21 @@ router = APIRouter()
 # API endpoint to create a role permission
 @router.post("/role_permissions/", response_model=List[schemas.Role])
 def create_role_permission(
-    role_permission: schemas.RolePermission, db: Session = Depends(get_db)
+    role_permission: schemas.RolePermission, db: Session = Depends(get_write_db)
 ):
-    print("#################### role_permission: ", role_permission)
-    # Delete existing permissions not in the array
-    db.query(models.RolePermission) \
-        .filter(models.RolePermission.role == role_permission.role) \
-        .filter(models.RolePermission.permission.notin_(role_permission.permissions)) \
-        .delete(synchronize_session=False)
-    db.commit()
-    # Loop over permissions array
-    for permission in role_permission.permissions:
-        # Check if permission exists for the role
-        existing_permission = db.query(models.RolePermission) \
-            .filter(models.RolePermission.role == role_permission.role) \
-            .filter(models.RolePermission.permission == permission) \
-            .first()
-
-        if existing_permission:
-            continue  # Skip if permission already exists for the role
-
-        # Create new role permission
-        new_role_permission = models.RolePermission(
-            role=role_permission.role,
-            permission=permission
-        )
-        db.add(new_role_permission)
-
+    try:
+        set_role_permissions(db, role_permission.role, role_permission.permissions)
         db.commit()
-        db.refresh(new_role_permission)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Unknown role or permission")
 
-    roles = db.query(models.Role).all()
+    roles = db.query(models.Role).options(selectinload(models.Role.permissions)).all()
     return roles
 
 
-
 @router.get("/role_permissions/", response_model=schemas.RolePermissionResponse)
-def get_role_permissions(db: Session = Depends(get_db)):
+def get_role_permissions(db: Session = Depends(get_read_db)):
     # Query the database for all RolePermission objects
     role_permissions = db.query(models.RolePermission).all()
 
@@ -63,7 +43,7 @@ def get_role_permissions(db: Session = Depends(get_db)):
 
 
 @router.post("/roles/", response_model=schemas.Role)
-def create_role(role: schemas.RoleCreate, db: Session = Depends(get_db)):
+def create_role(role: schemas.RoleCreate, db: Session = Depends(get_write_db)):
     db_role = models.Role(
         role=role.role, created_at=datetime.now(), last_modified_at=datetime.now()
     )
@@ -74,13 +54,19 @@ def create_role(role: schemas.RoleCreate, db: Session = Depends(get_db)):
 
 
 @router.get("/roles/", response_model=List[schemas.Role])
-def get_roles(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    roles = db.query(models.Role).offset(skip).limit(limit).all()
+def get_roles(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
+    roles = (
+        db.query(models.Role)
+        .options(selectinload(models.Role.permissions))
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
     return roles
 
 
 @router.get("/roles/{role_name}", response_model=schemas.Role)
-def get_role(role_name: str, db: Session = Depends(get_db)):
+def get_role(role_name: str, db: Session = Depends(get_read_db)):
     role = db.query(models.Role).filter(models.Role.role == role_name).first()
     if not role:
         raise HTTPException(status_code=404, detail="Role not found")
@@ -89,7 +75,7 @@ def get_role(role_name: str, db: Session = Depends(get_db)):
 
 @router.put("/roles/{role_name}", response_model=schemas.Role)
 def update_role(
-    role_name: str, role: schemas.RoleUpdate, db: Session = Depends(get_db)
+    role_name: str, role: schemas.RoleUpdate, db: Session = Depends(get_write_db)
 ):
     db_role = db.query(models.Role).filter(models.Role.role == role_name).first()
     if not db_role:
@@ -102,7 +88,7 @@ def update_role(
 
 
 @router.delete("/roles/{role_name}")
-def delete_role(role_name: str, db: Session = Depends(get_db)):
+def delete_role(role_name: str, db: Session = Depends(get_write_db)):
     db_role = db.query(models.Role).filter(models.Role.role == role_name).first()
     if not db_role:
         raise HTTPException(status_code=404, detail="Role not found")
@@ -116,7 +102,7 @@ def delete_role(role_name: str, db: Session = Depends(get_db)):
 
 @router.post("/permissions/", response_model=schemas.Permission)
 def create_permission(
-    permission: schemas.PermissionCreate, db: Session = Depends(get_db)
+    permission: schemas.PermissionCreate, db: Session = Depends(get_write_db)
 ):
     db_permission = models.Permission(
         permission=permission.permission,
@@ -130,13 +116,13 @@ def create_permission(
 
 
 @router.get("/permissions/", response_model=List[schemas.Permission])
-def get_permissions(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def get_permissions(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
     permissions = db.query(models.Permission).offset(skip).limit(limit).all()
     return permissions
 
 
 @router.get("/permissions/{permission_name}", response_model=schemas.Permission)
-def get_permission(permission_name: str, db: Session = Depends(get_db)):
+def get_permission(permission_name: str, db: Session = Depends(get_read_db)):
     permission = (
         db.query(models.Permission)
         .filter(models.Permission.permission == permission_name)
@@ -151,7 +137,7 @@ def get_permission(permission_name: str, db: Session = Depends(get_db)):
 def update_permission(
     permission_name: str,
     permission: schemas.PermissionUpdate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_write_db),
 ):
     db_permission = (
         db.query(models.Permission)
@@ -168,7 +154,7 @@ def update_permission(
 
 
 @router.delete("/permissions/{permission_name}")
-def delete_permission(permission_name: str, db: Session = Depends(get_db)):
+def delete_permission(permission_name: str, db: Session = Depends(get_write_db)):
     db_permission = (
         db.query(models.Permission)
         .filter(models.Permission.permission == permission_name)
@@ -0,0 +1,112 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_
+from typing import Dict
+from datetime import datetime, timedelta
+
+from config import get_db, settings
+from helper import local_naive
+from services import resolve_chat_ids
+import models, schemas
+
+router = APIRouter()
+
+# Sync Endpoints
+
+
+@router.post("/sync", response_model=schemas.SyncResponse)
+def sync_chats(cursors: Dict[str, datetime], db: Session = Depends(get_db)):
+    """Return everything that changed in the given chats since each cursor.
+
+    The body maps chat ids (or names) to the last ``server_time`` the client
+    saw for that chat. Each table is queried once for all chats; the returned
+    ``server_time`` is the next cursor for every chat in the request.
+
+    Reads the primary, not a replica: a change still replicating would be
+    older than ``server_time`` and never be synced.
+
+    ``server_time`` is ``SYNC_OVERLAP_SECONDS`` before the queries ran. A
+    row is stamped when its request writes it, not when it commits, and
+    MySQL DATETIME rounds to the second, so rows stamped just before the
+    queries can still be missing from them. The next sync returns them,
+    along with some rows the client already has. Apply deltas by id, they
+    are idempotent.
+
+    Tombstones are kept ``TOMBSTONE_RETENTION_DAYS``. A chat whose cursor
+    is older comes back with ``reset`` set and no changes, the client
+    reloads it. A chat that is deleted or unknown comes back with
+    ``deleted`` set, the client drops it.
+    """
+    now = datetime.now()
+    server_time = now - timedelta(seconds=settings.sync_overlap_seconds)
+    # Whatever doesn't resolve below stays marked deleted
+    chats = {chat_ref: schemas.ChatDelta(deleted=True) for chat_ref in cursors}
+    # Deltas are keyed the way the client keyed its cursors
+    refs = {
+        chat_id: chat_ref
+        for chat_ref, chat_id in resolve_chat_ids(db, cursors.keys()).items()
+    }
+    cursors = {chat_id: local_naive(cursors[chat_ref]) for chat_id, chat_ref in refs.items()}
+    for chat_ref in refs.values():
+        chats[chat_ref].deleted = False
+    if settings.tombstone_retention_days:
+        # Deletes before this are gone, a delta would miss them
+        horizon = now - timedelta(days=settings.tombstone_retention_days)
+        for chat_id, since in list(cursors.items()):
+            if since < horizon:
+                chats[refs[chat_id]].reset = True
+                del cursors[chat_id]
+    if not cursors:
+        return {"server_time": server_time, "chats": chats}
+
+    messages = db.query(models.Message).filter(
+        or_(
+            *[
+                and_(
+                    models.Message.chat_id == chat_id,
+                    models.Message.last_modified_at > since,
+                )
+                for chat_id, since in cursors.items()
+            ]
+        )
+    )
+    for message in messages:
+        chats[refs[message.chat_id]].messages.append(
+            schemas.SyncMessage.model_validate(message)
+        )
+
+    reactions = (
+        db.query(models.MessageReaction, models.Message.chat_id)
+        .join(models.Message, models.Message.id == models.MessageReaction.message_id)
+        .filter(
+            or_(
+                *[
+                    and_(
+                        models.Message.chat_id == chat_id,
+                        models.MessageReaction.last_modified_at > since,
+                    )
+                    for chat_id, since in cursors.items()
+                ]
+            )
+        )
+    )
+    for reaction, chat_id in reactions:
+        chats[refs[chat_id]].reactions.append(schemas.MessageReaction.model_validate(reaction))
+
+    tombstones = db.query(models.Tombstone).filter(
+        or_(
+            *[
+                and_(
+                    models.Tombstone.chat_id == chat_id,
+                    models.Tombstone.deleted_at > since,
+                )
+                for chat_id, since in cursors.items()
+            ]
+        )
+    )
+    for tombstone in tombstones:
+        chats[refs[tombstone.chat_id]].tombstones.append(
+            schemas.Tombstone.model_validate(tombstone)
+        )
+
+    return {"server_time": server_time, "chats": chats}
@@ -1,18 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload, selectinload
 from typing import List
 from datetime import datetime, timedelta
 import requests
 
+import jobs
 import models, schemas
 from config import ACCESS_TOKEN_EXPIRE_MINUTES, get_db
+from helper import changed_fields
+from ratelimit import client_ip
+from replicas import get_read_db, get_write_db
+from routers.websocket import manager
 from services import (
     authenticate_user,
     create_access_token,
     get_current_active_user,
     get_password_hash,
     create_default_reply_shortcuts,
+    issue_refresh_token,
+    revoke_refresh_token,
+    revoke_user_refresh_tokens,
+    rotate_refresh_token,
 )
 
 router = APIRouter()
@@ -21,17 +30,35 @@ router = APIRouter()
 # User Endpoints
 
 
+def token_response(db: Session, user: models.User, refresh_token: str = None):
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": user.email}, expires_delta=access_token_expires
+    )
+
+    role = (
+        db.query(models.Role)
+        .options(joinedload(models.Role.permissions))
+        .filter(models.Role.role == user.role_name)
+        .first()
+    )
+    resp = {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "data": user,
+        "role": role,
+        "refresh_token": refresh_token,
+    }
+    return resp
+
+
 @router.post("/token", response_model=schemas.Token)
 async def login_for_access_token(
     request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db),
 ):
-    forwarded_for = request.headers.get("X-User-IP")
-    if forwarded_for:
-        user_ip = forwarded_for
-    else:
-        user_ip = request.client.host
+    user_ip = client_ip(request)
 
     user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
@@ -48,43 +75,63 @@ async def login_for_access_token(
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    if user.disabled:
+        raise HTTPException(status_code=400, detail="Inactive user")
 
-    role = db.query(models.Role).filter(models.Role.role == user.role_name).first()
-    resp = {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "data": user,
-        "role": role,
-    }
-    return resp
+    refresh_token = issue_refresh_token(db, user.id)
+    db.commit()
+    return token_response(db, user, refresh_token)
 
 
-@router.get("/users/me/{id}", response_model=schemas.Token)
-async def read_users_me(id: str, db: Session = Depends(get_db)):
-    current_user = db.quiry(models.User).filter(models.User.id == id).first()
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": current_user.email}, expires_delta=access_token_expires
-    )
+@router.post("/token/refresh", response_model=schemas.Token)
+def refresh_access_token(
+    request: Request,
+    body: schemas.RefreshTokenRequest,
+    db: Session = Depends(get_db),
+):
+    def check_ip_group(user: models.User):
+        # Same IP group rule as a password login, checked before the token
+        # is used up
+        if user.ip_group_id and user.ip_group_id != client_ip(request):
+            raise HTTPException(
+                status_code=401,
+                detail="You are logging in from unallowed IP.",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
 
-    role = (
-        db.query(models.Role).filter(models.Role.role == current_user.role_name).first()
-    )
-    resp = {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "data": current_user,
-        "role": role,
-    }
-    return resp
+    # HMAC and a primary key lookup, no bcrypt
+    rotated = rotate_refresh_token(db, body.refresh_token, check=check_ip_group)
+    if rotated is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    user, refresh_token = rotated
+    return token_response(db, user, refresh_token)
+
+
+@router.post("/token/revoke")
+def revoke_token(request: schemas.RefreshTokenRequest, db: Session = Depends(get_db)):
+    if not revoke_refresh_token(db, request.refresh_token):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    return {"message": "Refresh token revoked"}
+
+
+@router.get("/users/me/{id}", response_model=schemas.Token)
+async def read_users_me(
+    id: str,
+    current_user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(get_db),
+):
+    # A fresh access token for the bearer's own account only
+    if str(current_user.id) != id:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    return token_response(db, current_user)
 
 
 @router.post("/users", response_model=schemas.User)
-async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_write_db)):
     db_user = models.User(**user.dict())
     db_user.password = get_password_hash(db_user.password)
     default_reply_shortcuts = create_default_reply_shortcuts(db_user)
@@ -96,7 +143,7 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 
 @router.get("/users/{id}", response_model=schemas.User)
-async def read_user(id: str, db: Session = Depends(get_db)):
+async def read_user(id: str, db: Session = Depends(get_read_db)):
     db_user = db.query(models.User).filter(models.User.id == id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -104,16 +151,27 @@ async def read_user(id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/users/", response_model=List[schemas.User])
-def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = db.query(models.User).offset(skip).all()
+def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
+    users = (
+        db.query(models.User)
+        .options(selectinload(models.User.reply_shortcuts))
+        .offset(skip)
+        .all()
+    )
     return users
 
 
 @router.put("/users/{user_id}", response_model=schemas.User)
-def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db)):
+def update_user(
+    user_id: int,
+    user: schemas.UserUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_write_db),
+):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
+    before = db_user.as_dict()
     db_user.email = user.email if len(user.email) > 0 else db_user.email
     db_user.password = (
         get_password_hash(user.password) if len(user.password) > 0 else db_user.password
@@ -122,23 +180,43 @@ def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(ge
     db_user.image_url = user.image_url if len(user.image_url) > 0 else db_user.image_url
     db_user.role_name = user.role_name if len(user.role_name) > 0 else db_user.role_name
     db_user.last_modified_at = datetime.now()
+    if len(user.password) > 0:
+        # A new password logs out every session
+        revoke_user_refresh_tokens(db, db_user.id)
     db.commit()
     db.refresh(db_user)
+    changes = changed_fields(
+        before, db_user.as_dict(), ignore=("password", "last_modified_at")
+    )
+    if changes:
+        # Users show up in every chat list, so everyone gets it
+        background_tasks.add_task(
+            manager.publish_to_all,
+            {
+                "type": "user.updated",
+                "user_id": db_user.id,
+                "changes": changes,
+                "last_modified_at": db_user.last_modified_at,
+            },
+        )
     return db_user
 
 
-@router.delete("/users/{user_id}")
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+@router.delete("/users/{user_id}", status_code=202)
+def delete_user(user_id: int, db: Session = Depends(get_write_db)):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    db.delete(db_user)
+    # Locked out now, removed with their messages in batches, see jobs.py
+    db_user.disabled = True
+    revoke_user_refresh_tokens(db, db_user.id)
     db.commit()
-    return {"message": "User deleted"}
+    job = jobs.enqueue(db, "purge_user", db_user.id)
+    return {"message": "User deletion queued", "job_id": job.id}
 
 
 @router.put("/reply_shortcuts/{id}")
-def update_reply_shortcuts(id: int, reply_shortcut: schemas.ReplyShortcut, db: Session = Depends(get_db)):
+def update_reply_shortcuts(id: int, reply_shortcut: schemas.ReplyShortcut, db: Session = Depends(get_write_db)):
     shortcut = db.query(models.ReplyShortcut).get(id)
     shortcut.reply = reply_shortcut.reply
     db.commit()
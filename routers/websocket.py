@@ -1,13 +1,36 @@
+import asyncio
 import json
+import logging
+from collections import defaultdict
 from fastapi import APIRouter, WebSocket, Depends, HTTPException, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Union
 from datetime import datetime
 
-from config import get_db, SessionLocal
+import msgpack
+from cachetools import TTLCache
+
+from config import get_db, settings, SessionLocal
+from notifications import chat_recipients, notifications
+from ratelimit import FrameLimiter
+from services import user_for_token
+import lifecycle
+import metrics
 import models, schemas
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+# Every received frame, sampled, see LOG_SAMPLE in logs.py
+frame_logger = logging.getLogger(f"{__name__}.frames")
+
+# Member changes handled by another worker only reach this process's
+# routing table once its entry expires
+MEMBERS_TTL = 60
+
+slow_consumers = metrics.Counter(
+    "ws_slow_consumers_total", "/ws connections closed for not reading their frames"
+)
 
 
 class CustomJSONEncoder(json.JSONEncoder):
@@ -20,52 +43,369 @@ class CustomJSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+def msgpack_default(obj):
+    # Same values the JSON encoder produces, so both protocols carry one schema
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+
+class JSONProtocol:
+    name = "json"
+    binary = False
+
+    def encode(self, data) -> str:
+        return json.dumps(data, cls=CustomJSONEncoder)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackProtocol:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data) -> bytes:
+        return msgpack.packb(data, default=msgpack_default, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+# Offered as WebSocket subprotocols, in order of preference
+PROTOCOLS = {protocol.name: protocol for protocol in (MsgpackProtocol(), JSONProtocol())}
+DEFAULT_PROTOCOL = PROTOCOLS["json"]
+
+
+def relay_encode(protocol, data):
+    # JSON clients have always received relayed frames as a JSON string
+    # inside the frame, MessagePack clients get the map itself
+    if protocol.binary:
+        return protocol.encode(data)
+    return json.dumps(protocol.encode(data))
+
+
+class Close(NamedTuple):
+    code: int
+    reason: str = ""
+
+
+Frame = Union[str, bytes, Close]
+
+
+class BadFrame(ValueError):
+    """A frame that doesn't decode to an event object."""
+
+
+def check_json_like(data):
+    # MessagePack can carry binary values and non-string keys, which JSON
+    # can't. Frames are relayed to JSON clients too, so both are refused.
+    pending = [data]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            for key in value:
+                if not isinstance(key, str):
+                    raise BadFrame(f"map keys must be strings, got {type(key).__name__}")
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+        elif isinstance(value, (bytes, bytearray)):
+            raise BadFrame("binary values are not allowed")
+
+
 class ConnectionManager:
+    """Routing for /ws plus one outbound queue and writer task per socket.
+
+    Publishing only puts encoded frames on the queues, so a client on a
+    slow network never holds up the others. A client more than
+    ``WS_OUTBOX_SIZE`` frames behind is closed with 1013.
+    """
+
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        # Every socket belongs to the user its access token was issued to
+        self.user_connections: Dict[int, Set[WebSocket]] = defaultdict(set)
+        self.connection_users: Dict[WebSocket, int] = {}
+        # Sockets that negotiated something other than JSON
+        self.connection_protocols: Dict[WebSocket, MsgpackProtocol] = {}
+        # Routing table, loaded from the database on a miss and kept up to
+        # date by member.changed events
+        self.chat_members: TTLCache = TTLCache(maxsize=10_000, ttl=MEMBERS_TTL)
+        self.outboxes: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, user_id: int):
+        offered = websocket.scope.get("subprotocols", [])
+        protocol = next((PROTOCOLS[name] for name in PROTOCOLS if name in offered), None)
+        await websocket.accept(subprotocol=protocol.name if protocol else None)
+        self.set_protocol(websocket, protocol or DEFAULT_PROTOCOL)
+        outbox = self.outboxes[websocket] = asyncio.Queue()
+        self.writers[websocket] = asyncio.create_task(self.write(websocket, outbox))
         self.active_connections.append(websocket)
+        self.user_connections[user_id].add(websocket)
+        self.connection_users[websocket] = user_id
+
+    def forget(self, websocket: WebSocket) -> Optional[asyncio.Queue]:
+        """Stop routing frames to ``websocket``, its writer keeps running."""
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        self.connection_protocols.pop(websocket, None)
+        user_id = self.connection_users.pop(websocket, None)
+        if user_id is not None:
+            self.user_connections[user_id].discard(websocket)
+            if not self.user_connections[user_id]:
+                del self.user_connections[user_id]
+        return self.outboxes.pop(websocket, None)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.forget(websocket)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
+    def close(self, websocket: WebSocket, code: int, reason: str = "", discard_pending=False):
+        """Close ``websocket`` after the frames already queued for it."""
+        outbox = self.forget(websocket)
+        if outbox is None:
+            return
+        if discard_pending:
+            while not outbox.empty():
+                outbox.get_nowait()
+                outbox.task_done()
+        outbox.put_nowait(Close(code, reason))
+
+    def enqueue(self, websocket: WebSocket, frame: Frame):
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            return
+        if outbox.qsize() >= settings.ws_outbox_size:
+            slow_consumers.inc()
+            logger.warning(
+                "closing slow connection",
+                extra={"user_id": self.connection_users.get(websocket)},
+            )
+            self.close(websocket, 1013, discard_pending=True)
+            return
+        outbox.put_nowait(frame)
+
+    async def write(self, websocket: WebSocket, outbox: asyncio.Queue):
+        try:
+            while True:
+                frame = await outbox.get()
+                try:
+                    if isinstance(frame, Close):
+                        await websocket.close(code=frame.code, reason=frame.reason)
+                        return
+                    if isinstance(frame, bytes):
+                        await websocket.send_bytes(frame)
+                    else:
+                        await websocket.send_text(frame)
+                finally:
+                    outbox.task_done()
+        except (WebSocketDisconnect, OSError, RuntimeError) as e:
+            logger.info("dropping closed connection", extra={"error": repr(e)})
+            self.forget(websocket)
+        finally:
+            # Nothing more will be sent, don't leave flush() waiting
+            while not outbox.empty():
+                outbox.get_nowait()
+                outbox.task_done()
+            if self.writers.get(websocket) is asyncio.current_task():
+                del self.writers[websocket]
+
+    async def flush(self):
+        """Wait until every frame queued so far has been written."""
+        await asyncio.gather(*(outbox.join() for outbox in list(self.outboxes.values())))
+
+    async def drain(self, deadline: float):
+        """Tell every client to reconnect later, then close once its queue is sent.
+
+        The delay is jittered per client and repeated in the close reason
+        for clients that only look at the close frame.
+        """
+        outboxes = list(self.outboxes.items())
+        for websocket, outbox in outboxes:
+            delay = lifecycle.reconnect_after_ms()
+            event = {"type": "server.draining", "reconnect_after_ms": delay}
+            self.enqueue(websocket, self.protocol_for(websocket).encode(event))
+            self.close(websocket, 1012, f"reconnect_after_ms={delay}")
+        logger.info("draining connections", extra={"connections": len(outboxes)})
+        await asyncio.gather(*(outbox.join() for _, outbox in outboxes))
+
+    def set_protocol(self, websocket: WebSocket, protocol):
+        if protocol is DEFAULT_PROTOCOL:
+            self.connection_protocols.pop(websocket, None)
+        else:
+            self.connection_protocols[websocket] = protocol
+
+    def protocol_for(self, websocket: WebSocket):
+        return self.connection_protocols.get(websocket, DEFAULT_PROTOCOL)
+
+    async def receive(self, websocket: WebSocket) -> dict:
+        # Text frames are JSON and binary frames MessagePack, whatever was negotiated
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        try:
+            if message.get("bytes") is not None:
+                data = PROTOCOLS["msgpack"].decode(message["bytes"])
+            else:
+                data = PROTOCOLS["json"].decode(message["text"])
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise BadFrame(f"undecodable frame: {e}") from e
+        if not isinstance(data, dict):
+            raise BadFrame(f"expected an object, got {type(data).__name__}")
+        check_json_like(data)
+        if data.get("type") == "hello" and not isinstance(data.get("protocol", ""), str):
+            raise BadFrame("hello protocol must be a string")
+        return data
+
+    async def send_encoded(self, targets: Iterable[WebSocket], data, encode=None):
+        # Encode once per protocol, not once per socket
+        frames = {}
+        for connection in targets:
+            protocol = self.protocol_for(connection)
+            if protocol.name not in frames:
+                frames[protocol.name] = encode(protocol, data) if encode else protocol.encode(data)
+            self.enqueue(connection, frames[protocol.name])
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        self.enqueue(websocket, message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        for connection in list(self.active_connections):
+            self.enqueue(connection, message)
 
     async def send_dict(self, data: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(data)
-            except WebSocketDisconnect as e:
-                print("############################## E: ", e)
-                self.active_connections.remove(connection)
+        await self.send_encoded(list(self.active_connections), data, encode=relay_encode)
+
+    async def send_to_users(self, data: dict, user_ids: Iterable[int]):
+        targets = []
+        for user_id in set(user_ids):
+            targets.extend(self.user_connections.get(user_id, ()))
+
+        await self.send_encoded(targets, data)
+
+    async def publish_to_chat(self, chat_id: int, data: dict):
+        members = self.chat_members.get(chat_id)
+        if members is None:
+            members = self.chat_members[chat_id] = await run_in_threadpool(
+                chat_recipients, chat_id
+            )
+        await self.send_to_users(data, members)
+
+    async def publish_to_all(self, data: dict):
+        await self.send_encoded(list(self.active_connections), data)
+
+    async def chat_members_changed(
+        self,
+        chat_id: int,
+        members: Iterable[int],
+        added: Iterable[int],
+        removed: Iterable[int],
+    ):
+        members = set(members)
+        removed = set(removed)
+        self.chat_members[chat_id] = members
+        event = {
+            "type": "member.changed",
+            "chat_id": chat_id,
+            "members": sorted(members),
+            "added": sorted(added),
+            "removed": sorted(removed),
+        }
+        await self.send_to_users(event, members | removed)
 
 
 manager = ConnectionManager()
+lifecycle.on_drain(manager.drain)
+
+
+def authenticate(websocket: WebSocket) -> Optional[int]:
+    """The user id behind the socket's access token, None without a valid one.
+
+    Browsers can't set headers on a WebSocket, so the token can also come
+    as ``?token=``.
+    """
+    token = websocket.query_params.get("token")
+    if not token:
+        scheme, _, token = websocket.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            return None
+    if not token:
+        return None
+    db = SessionLocal()
+    try:
+        user = user_for_token(db, token)
+        return user.id if user else None
+    finally:
+        db.close()
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    # Events are routed by user, so the user comes from the token alone
+    user_id = await run_in_threadpool(authenticate, websocket)
+    if user_id is None:
+        await websocket.close(code=1008)
+        return
+    await manager.connect(websocket, user_id)
+    limiter = FrameLimiter(websocket, user_id)
+    dropped = 0
 
     try:
+        try:
+            # What arrived while the user was away, in place of a full reload
+            await manager.send_encoded([websocket], await notifications.summary_event(user_id))
+        except Exception:
+            # Still stored, it goes out on the next connect
+            logger.exception("offline summary failed", extra={"user_id": user_id})
+
         while True:
-            data = await websocket.receive_json()
-            print("################################ WebSocket Data: ", data)
+            try:
+                data = await manager.receive(websocket)
+            except BadFrame as e:
+                data, error = None, {"type": "error", "code": "bad_frame", "detail": str(e)}
+            else:
+                frame_logger.info(
+                    "frame received",
+                    extra={"user_id": user_id, "frame_type": data.get("type"), "frame": data},
+                )
+                allowed, retry_after = await limiter.allow(data.get("type"))
+                error = None
+                if not allowed:
+                    error = {
+                        "type": "error",
+                        "code": "rate_limited",
+                        "frame_type": data.get("type"),
+                        "retry_after": round(retry_after, 3),
+                    }
+
+            if error is not None:
+                # Garbage counts towards the flood limit like frames over the rate
+                dropped += 1
+                if dropped > settings.ws_max_dropped_frames:
+                    logger.warning("closing flooding connection", extra={"user_id": user_id})
+                    manager.close(websocket, 1008)
+                    continue
+                await manager.send_encoded([websocket], error)
+                continue
+            dropped = 0
+
+            if data.get("type") == "hello":
+                # Negotiation for clients that can't set a subprotocol
+                protocol = PROTOCOLS.get(data.get("protocol"), DEFAULT_PROTOCOL)
+                manager.set_protocol(websocket, protocol)
+                await manager.send_encoded([websocket], {"type": "hello", "protocol": protocol.name})
 
-            if "type" in data:
-                await manager.send_dict(json.dumps(data, cls=CustomJSONEncoder))
+            elif "type" in data:
+                await manager.send_dict(data)
 
             else:
-                print("################################ NO TYPE")
+                logger.warning("frame without a type", extra={"user_id": user_id})
 
     except WebSocketDisconnect:
-        print("################### WEBSOCKET DISCONNECT #####################")
+        logger.info("disconnected", extra={"user_id": user_id})
+    finally:
         manager.disconnect(websocket)
-        # await manager.broadcast(json.dumps(message))
@@ -1,5 +1,5 @@
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import Annotated, Dict, List, Optional, Union
+from pydantic import BaseModel, BeforeValidator
 from datetime import datetime
 
 
@@ -80,6 +80,12 @@ class Token(BaseModel):
     token_type: str
     data: User
     role: Role
+    # Trade it at POST /token/refresh for new tokens, each one works once
+    refresh_token: Optional[str] = None
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 
 class RolePermission(BaseModel):
@@ -91,6 +97,11 @@ class RolePermissionResponse(BaseModel):
     roles_permissions: List[RolePermission]
 
 
+# Chats are keyed by an integer id. Anywhere a chat is referenced by a client
+# either that id or the chat name is accepted, see services.resolve_chat_ids.
+ChatRef = Union[int, str]
+
+
 class ChatBase(BaseModel):
     chat_name: str
     image_url: Optional[str] = None
@@ -102,7 +113,7 @@ class ChatCreate(ChatBase):
 
 
 class ChatMemberBase(BaseModel):
-    chat_id: str
+    chat_id: int
     user_id: int
 
 
@@ -111,13 +122,13 @@ class ChatMemberCreate(ChatMemberBase):
 
 
 class ChatMemberUpdate(BaseModel):
-    chat_id: Optional[str]
+    chat_id: Optional[ChatRef]
     user_ids: Optional[List[int]]
 
 
 class ChatMemberResponse(BaseModel):
     id: int
-    chat_id: str
+    chat_id: int
     user_id: int
     joined_at: Optional[datetime]
     last_modified_at: Optional[datetime]
@@ -131,12 +142,20 @@ class ChatMembersResponse(BaseModel):
     chat_members: List[ChatMemberResponse]
 
 
+# Message ids are 63 bit integers (see ids.py), too big for JavaScript
+# numbers, so they travel as strings. Clients may still reference a message
+# by the id they generated, see services.resolve_message_ids.
+MessageRef = Annotated[
+    str, BeforeValidator(lambda value: str(value) if isinstance(value, int) else value)
+]
+
+
 class MessageBase(BaseModel):
-    id: Optional[str] = None
-    chat_id: str
+    id: Optional[MessageRef] = None
+    chat_id: ChatRef
     sender_id: int
     chat_sequance: Optional[int] = None
-    parent_message_id: Optional[str] = None
+    parent_message_id: Optional[MessageRef] = None
     type: Optional[str] = None
     timestamp: Optional[datetime] = None
     message: str
@@ -146,7 +165,7 @@ class MessageBase(BaseModel):
 
 
 class MessageReactionBase(BaseModel):
-    message_id: str
+    message_id: MessageRef
     user_id: int
     reaction: str
 
@@ -165,15 +184,31 @@ class MessageReaction(MessageReactionBase):
 
 
 class Message(MessageBase):
+    client_id: Optional[str] = None
     created_at: datetime
     last_modified_at: datetime
     reactions: Optional[List[MessageReaction]]
+    reaction_counts: Optional[Dict[str, int]] = None
+    reply_count: int = 0
 
     class Config:
         from_attributes = True
 
 
+class ThreadReply(Message):
+    # 1 for direct replies to the root, 2 for their replies and so on
+    depth: int
+
+
+class Thread(BaseModel):
+    root: Message
+    replies: List[ThreadReply]
+    # Pass as ``after`` for the next page, None on the last one
+    next_cursor: Optional[str] = None
+
+
 class Chat(ChatBase):
+    id: int
     chat_name: str
     messages: Optional[List[Message]] = None
     chat_members: Optional[List[ChatMemberResponse]] = None
@@ -208,3 +243,68 @@ class MessageUpdate(MessageBase):
 
 class MessageReactionUpdate(MessageReactionBase):
     id: int
+
+
+class SyncMessage(MessageBase):
+    client_id: Optional[str] = None
+    last_modified_at: datetime
+    reaction_counts: Optional[Dict[str, int]] = None
+    reply_count: int = 0
+
+    class Config:
+        from_attributes = True
+
+
+class Tombstone(BaseModel):
+    kind: str
+    object_id: str
+    message_id: Optional[str] = None
+    chat_id: int
+    deleted_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ChatDelta(BaseModel):
+    messages: List[SyncMessage] = []
+    reactions: List[MessageReaction] = []
+    tombstones: List[Tombstone] = []
+    # The cursor is older than the tombstones kept, reload the chat instead
+    reset: bool = False
+    # The chat was deleted or never existed, drop it
+    deleted: bool = False
+
+
+class SyncResponse(BaseModel):
+    server_time: datetime
+    chats: Dict[str, ChatDelta]
+
+
+class Attachment(BaseModel):
+    id: int
+    message_id: MessageRef
+    sha256: str
+    size: int
+    content_type: Optional[str] = None
+    filename: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class Job(BaseModel):
+    id: int
+    kind: str
+    target_id: Optional[int] = None
+    state: str
+    step: Optional[str] = None
+    processed: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
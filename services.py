@@ -1,8 +1,28 @@
-from typing import Optional
+import base64
+import hashlib
+import hmac
+from typing import Callable, Optional, Tuple
 from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
-from models import User, ReplyShortcut
-from config import ALGORITHM, SECRET_KEY, get_db, pwd_context, oauth2_scheme
+from sqlalchemy import func, insert, literal, or_, select, update
+from sqlalchemy.orm import Session, aliased, selectinload
+from models import (
+    Chat,
+    ChatMember,
+    Message,
+    MessageReaction,
+    RefreshToken,
+    RolePermission,
+    User,
+    ReplyShortcut,
+)
+from config import (
+    ALGORITHM,
+    REFRESH_TOKEN_EXPIRE_DAYS,
+    SECRET_KEY,
+    get_db,
+    oauth2_scheme,
+    pwd_context,
+)
 from datetime import datetime, timedelta
 import jwt
 
@@ -39,7 +59,130 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def refresh_signature(payload: str) -> str:
+    digest = hmac.new(SECRET_KEY.encode(), f"refresh.{payload}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def encode_refresh_token(row: RefreshToken, generation: Optional[int] = None) -> str:
+    if generation is None:
+        generation = row.generation
+    payload = f"{row.id}.{generation}.{int(row.expires_at.timestamp())}"
+    return f"{payload}.{refresh_signature(payload)}"
+
+
+def decode_refresh_token(token: str) -> Optional[Tuple[int, int]]:
+    """``(id, generation)`` of a well signed, unexpired token, else None.
+
+    Checked with HMAC alone, so forged and expired tokens never reach the
+    database.
+    """
+    payload, _, signature = token.rpartition(".")
+    # As bytes: compare_digest refuses str with non-ASCII characters
+    if not hmac.compare_digest(signature.encode(), refresh_signature(payload).encode()):
+        return None
+    try:
+        token_id, generation, expires = (int(part) for part in payload.split("."))
+    except ValueError:
+        return None
+    if expires < datetime.now().timestamp():
+        return None
+    return token_id, generation
+
+
+def issue_refresh_token(db: Session, user_id: int) -> str:
+    """Start a refresh token chain for a login. Not committed."""
+    now = datetime.now()
+    row = RefreshToken(
+        user_id=user_id,
+        generation=0,
+        revoked=False,
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+    db.add(row)
+    db.flush()
+    return encode_refresh_token(row)
+
+
+def rotate_refresh_token(
+    db: Session, token: str, check: Optional[Callable[[User], None]] = None
+) -> Optional[Tuple[User, str]]:
+    """Swap a refresh token for the next one in its chain and commit.
+
+    Returns the user and the new token, or None if the token is no good.
+    Each token works once. Presenting an already rotated token means it
+    leaked, so the whole chain is revoked, as it is for a disabled user.
+
+    ``check(user)`` runs before anything is written and refuses the
+    request by raising. The token is left as it was, so a caller turned
+    away, e.g. from outside the user's IP group, doesn't use it up.
+    """
+    decoded = decode_refresh_token(token)
+    if decoded is None:
+        return None
+    token_id, generation = decoded
+    found = (
+        db.query(RefreshToken, User)
+        .join(User, User.id == RefreshToken.user_id)
+        .filter(RefreshToken.id == token_id)
+        .first()
+    )
+    if found is None or found[0].revoked:
+        return None
+    row, user = found
+    if row.generation != generation or user.disabled:
+        row.revoked = True
+        db.commit()
+        return None
+    if check is not None:
+        check(user)
+
+    rotated = (
+        db.query(RefreshToken)
+        .filter(
+            RefreshToken.id == token_id,
+            RefreshToken.generation == generation,
+            RefreshToken.revoked == False,
+        )
+        .update(
+            {"generation": RefreshToken.generation + 1, "last_used_at": datetime.now()},
+            synchronize_session=False,
+        )
+    )
+    if not rotated:
+        # Another request rotated it first, the same token was used twice
+        row.revoked = True
+        db.commit()
+        return None
+    refresh_token = encode_refresh_token(row, generation + 1)
+    db.commit()
+    return user, refresh_token
+
+
+def revoke_refresh_token(db: Session, token: str) -> bool:
+    decoded = decode_refresh_token(token)
+    if decoded is None:
+        return False
+    revoked = (
+        db.query(RefreshToken)
+        .filter(RefreshToken.id == decoded[0])
+        .update({"revoked": True}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(revoked)
+
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    """Log out every session of ``user_id``. Not committed."""
+    db.query(RefreshToken).filter(
+        RefreshToken.user_id == user_id, RefreshToken.revoked == False
+    ).update({"revoked": True}, synchronize_session=False)
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -52,12 +195,24 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
-    user = get_user(email)
+    user = get_user(email, db)
     if user is None:
         raise credentials_exception
     return user
 
 
+def user_for_token(db: Session, token: str) -> Optional[User]:
+    """The active user an access token belongs to, None if it doesn't check out."""
+    try:
+        email = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except jwt.PyJWTError:
+        return None
+    user = get_user(email, db) if email is not None else None
+    if user is None or user.disabled:
+        return None
+    return user
+
+
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -93,3 +248,321 @@ def ensure_default_reply_shortcuts_for_all_users(db):
             user.reply_shortcuts = default_reply_shortcuts
 
     db.commit()
+
+
+def resolve_chat_ids(db: Session, chat_refs):
+    """Map chat references to chat ids in one query.
+
+    Integers are chat ids. Strings are chat names, falling back to an id when
+    the string is numeric and no chat has that name, so older clients that
+    only know names keep working. Unknown references are left out.
+    """
+    chat_refs = set(chat_refs)
+    names = {ref for ref in chat_refs if isinstance(ref, str)}
+    ids = {int(ref) for ref in chat_refs if isinstance(ref, int) or ref.isdigit()}
+
+    by_name, by_id = {}, set()
+    rows = db.query(Chat.id, Chat.chat_name).filter(
+        or_(Chat.chat_name.in_(names), Chat.id.in_(ids)), Chat.deleted_at.is_(None)
+    )
+    for chat_id, chat_name in rows:
+        by_name[chat_name] = chat_id
+        by_id.add(chat_id)
+
+    resolved = {}
+    for ref in chat_refs:
+        if isinstance(ref, str) and ref in by_name:
+            resolved[ref] = by_name[ref]
+        elif (isinstance(ref, int) or ref.isdigit()) and int(ref) in by_id:
+            resolved[ref] = int(ref)
+    return resolved
+
+
+def resolve_chat_id(db: Session, chat_ref) -> Optional[int]:
+    return resolve_chat_ids(db, [chat_ref]).get(chat_ref)
+
+
+def get_chat_by_ref(db: Session, chat_ref) -> Optional[Chat]:
+    # Same rules as resolve_chat_ids, but loads the chat itself
+    live = db.query(Chat).filter(Chat.deleted_at.is_(None))
+    if isinstance(chat_ref, int):
+        return live.filter(Chat.id == chat_ref).first()
+    if not chat_ref.isdigit():
+        return live.filter(Chat.chat_name == chat_ref).first()
+    chats = live.filter(or_(Chat.chat_name == chat_ref, Chat.id == int(chat_ref))).all()
+    for chat in chats:
+        if chat.chat_name == chat_ref:
+            return chat
+    return chats[0] if chats else None
+
+
+def is_active_user(db: Session, user_id) -> bool:
+    # Deleted users are disabled until the purge job removes them
+    disabled = db.query(User.disabled).filter(User.id == user_id).first()
+    return disabled is not None and not disabled[0]
+
+
+def resolve_message_ids(db: Session, message_refs):
+    """Map message references to server message ids in one query.
+
+    A reference is either a server id or the id the client sent when it
+    created the message. Client ids win, so older clients keep finding their
+    own messages even if they happen to generate numeric ids. Unknown
+    references are left out.
+    """
+    message_refs = {str(ref) for ref in message_refs if ref is not None}
+    ids = {int(ref) for ref in message_refs if ref.isdigit()}
+
+    by_client_id, by_id = {}, set()
+    rows = db.query(Message.id, Message.client_id).filter(
+        or_(Message.client_id.in_(message_refs), Message.id.in_(ids))
+    )
+    for message_id, client_id in rows:
+        by_client_id[client_id] = message_id
+        by_id.add(message_id)
+
+    resolved = {}
+    for ref in message_refs:
+        if ref in by_client_id:
+            resolved[ref] = by_client_id[ref]
+        elif ref.isdigit() and int(ref) in by_id:
+            resolved[ref] = int(ref)
+    return resolved
+
+
+def resolve_message_id(db: Session, message_ref) -> Optional[int]:
+    if message_ref is None:
+        return None
+    return resolve_message_ids(db, [message_ref]).get(str(message_ref))
+
+
+def set_chat_members(db: Session, chat_id: int, user_ids):
+    """Make the members of ``chat_id`` exactly ``user_ids``.
+
+    One SELECT for the current members, one INSERT ... SELECT for the new ones
+    (unknown and disabled user ids are skipped) and one DELETE for the removed
+    ones. Nothing is committed, so the caller decides the transaction boundary.
+
+    Returns ``(members, added, removed)`` as sets of user ids.
+    """
+    wanted = {int(user_id) for user_id in user_ids or []}
+    current = {
+        user_id
+        for (user_id,) in db.query(ChatMember.user_id).filter(
+            ChatMember.chat_id == chat_id
+        )
+    }
+
+    added = wanted - current
+    removed = current - wanted
+
+    if added:
+        now = datetime.now()
+        result = db.execute(
+            insert(ChatMember).from_select(
+                ["chat_id", "user_id", "joined_at", "last_modified_at"],
+                select(
+                    literal(chat_id), User.id, literal(now), literal(now)
+                ).where(User.id.in_(added), or_(User.disabled.is_(None), User.disabled == False)),
+            )
+        )
+        if result.rowcount != len(added):
+            added = {
+                user_id
+                for (user_id,) in db.query(ChatMember.user_id).filter(
+                    ChatMember.chat_id == chat_id, ChatMember.user_id.in_(added)
+                )
+            }
+
+    if removed:
+        db.query(ChatMember).filter(
+            ChatMember.chat_id == chat_id, ChatMember.user_id.in_(removed)
+        ).delete(synchronize_session=False)
+
+    return (current - removed) | added, added, removed
+
+
+def set_role_permissions(db: Session, role: str, permissions):
+    """Make the permissions of ``role`` exactly ``permissions``.
+
+    One SELECT for the stored set, then a bulk INSERT and a single DELETE for
+    the difference. Nothing is committed.
+
+    Returns the resulting set of permission names.
+    """
+    wanted = set(permissions or [])
+    current = {
+        permission
+        for (permission,) in db.query(RolePermission.permission).filter(
+            RolePermission.role == role
+        )
+    }
+
+    added = wanted - current
+    removed = current - wanted
+
+    if added:
+        db.execute(
+            insert(RolePermission),
+            [{"role": role, "permission": permission} for permission in added],
+        )
+    if removed:
+        db.query(RolePermission).filter(
+            RolePermission.role == role, RolePermission.permission.in_(removed)
+        ).delete(synchronize_session=False)
+
+    return wanted
+
+
+def set_ip_group_users(db: Session, ip: str, user_ids):
+    """Make the users bound to the IP group ``ip`` exactly ``user_ids``.
+
+    Two set-based UPDATEs: one releasing users no longer in the group and one
+    binding the new set. Nothing is committed.
+
+    Returns the resulting set of user ids.
+    """
+    wanted = {int(user_id) for user_id in user_ids or []}
+
+    release = update(User).where(User.ip_group_id == ip)
+    if wanted:
+        release = release.where(User.id.notin_(wanted))
+    db.execute(release.values(ip_group_id=None).execution_options(synchronize_session=False))
+
+    if wanted:
+        db.execute(
+            update(User)
+            .where(User.id.in_(wanted))
+            .values(ip_group_id=ip)
+            .execution_options(synchronize_session=False)
+        )
+
+    return {
+        user_id
+        for (user_id,) in db.query(User.id).filter(User.ip_group_id == ip)
+    }
+
+
+def message_ref_filter(message_ref):
+    message_ref = str(message_ref)
+    condition = Message.client_id == message_ref
+    if message_ref.isdigit():
+        condition = or_(condition, Message.id == int(message_ref))
+    return condition
+
+
+def pick_message(rows, message_ref):
+    # Same precedence as resolve_message_ids: client ids first
+    for row in rows:
+        if row.client_id == str(message_ref):
+            return row
+    return rows[0] if rows else None
+
+
+def get_message_by_ref(db: Session, message_ref) -> Optional[Message]:
+    return pick_message(
+        db.query(Message).filter(message_ref_filter(message_ref)).all(), message_ref
+    )
+
+
+def lock_message(db: Session, message_ref):
+    """Find a message by reference and lock its row for the transaction.
+
+    Reaction writes take this lock first so concurrent reactions on the same
+    message can't rebuild ``reaction_counts`` from a stale snapshot. Returns
+    a ``(id, chat_id, client_id)`` row or None.
+    """
+    rows = (
+        db.query(Message.id, Message.chat_id, Message.client_id)
+        .filter(message_ref_filter(message_ref))
+        .with_for_update()
+        .all()
+    )
+    return pick_message(rows, message_ref)
+
+
+def lock_messages(db: Session, message_ids) -> dict:
+    """Lock messages by id, lowest first, so two writers locking the same
+    ones can't deadlock. Returns ``{id: (id, chat_id, client_id) row}``."""
+    rows = (
+        db.query(Message.id, Message.chat_id, Message.client_id)
+        .filter(Message.id.in_(set(message_ids)))
+        .order_by(Message.id)
+        .with_for_update()
+        .all()
+    )
+    return {row.id: row for row in rows}
+
+
+def refresh_reaction_counts(db: Session, message_id: int):
+    """Rebuild the ``{reaction: count}`` summary stored on a message."""
+    counts = dict(
+        db.query(MessageReaction.reaction, func.count(MessageReaction.id))
+        .filter(MessageReaction.message_id == message_id)
+        .group_by(MessageReaction.reaction)
+        .all()
+    )
+    db.query(Message).filter(Message.id == message_id).update(
+        {"reaction_counts": counts}, synchronize_session=False
+    )
+    return counts
+
+
+# Deeper replies are left out of nested threads, and a parent cycle can't
+# recurse forever
+MAX_THREAD_DEPTH = 50
+
+
+def change_reply_count(db: Session, chat_id: int, parent_id: int, delta: int) -> datetime:
+    """Add ``delta`` to the ``reply_count`` of ``parent_id``, uncommitted.
+
+    Only a parent in ``chat_id`` counts, threads don't cross chats. The
+    parent counts as modified, so ``/sync`` picks up the new count.
+    Returns the ``last_modified_at`` it was given.
+    """
+    now = datetime.now()
+    query = db.query(Message).filter(Message.id == parent_id, Message.chat_id == chat_id)
+    if delta < 0:
+        query = query.filter(Message.reply_count >= -delta)
+    query.update(
+        {"reply_count": Message.reply_count + delta, "last_modified_at": now},
+        synchronize_session=False,
+    )
+    return now
+
+
+def thread_replies(db: Session, root: Message, nested=False, after=None, limit=50):
+    """One page of the replies to ``root``, as ``(message, depth)`` in id order.
+
+    Direct replies only, or with ``nested`` every reply below ``root``,
+    walked by a recursive CTE. Each step is a lookup on the
+    ``(chat_id, parent_message_id)`` index. Ids are time ordered, so ``after``
+    (the last id of the previous page) pages through the thread in time.
+    """
+    if nested:
+        thread = (
+            select(Message.id.label("id"), literal(1).label("depth"))
+            .where(Message.chat_id == root.chat_id, Message.parent_message_id == root.id)
+            .cte("thread", recursive=True)
+        )
+        replies = aliased(Message)
+        thread = thread.union_all(
+            select(replies.id, thread.c.depth + 1).where(
+                replies.chat_id == root.chat_id,
+                replies.parent_message_id == thread.c.id,
+                thread.c.depth < MAX_THREAD_DEPTH,
+            )
+        )
+        query = db.query(Message, thread.c.depth).join(thread, Message.id == thread.c.id)
+    else:
+        query = db.query(Message, literal(1).label("depth")).filter(
+            Message.chat_id == root.chat_id, Message.parent_message_id == root.id
+        )
+    if after is not None:
+        query = query.filter(Message.id > after)
+    return (
+        query.options(selectinload(Message.reactions))
+        .order_by(Message.id)
+        .limit(limit)
+        .all()
+    )
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import re
+import uuid
+from typing import AsyncIterator, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from config import ATTACHMENTS_DIR, ATTACHMENT_MAX_BYTES
+
+# Writes are batched up to this size before hitting the disk
+WRITE_CHUNK_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# Not safe inside a quoted filename= on every browser
+UNSAFE_FILENAME_RE = re.compile(r'[^\x20-\x7e]|["\\;]')
+
+# Types a browser may render in place. Anything else, HTML and SVG
+# included, would run as a page on the API's origin, so it is stored and
+# served as application/octet-stream and downloaded instead.
+INLINE_TYPES = {
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/webp",
+    "application/pdf",
+}
+INLINE_PREFIXES = ("audio/", "video/")
+DEFAULT_TYPE = "application/octet-stream"
+
+
+def blob_path(sha256: str) -> str:
+    # Content addressed, fanned out so no directory gets too big
+    return os.path.join(ATTACHMENTS_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+async def store_stream(stream: AsyncIterator[bytes]) -> Tuple[str, int]:
+    """Write an upload to disk as it arrives and return ``(sha256, size)``.
+
+    The body goes to a temporary file while it is hashed, then is moved to
+    its content address. If that blob already exists the copy is dropped.
+    """
+    tmp_dir = os.path.join(ATTACHMENTS_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    digest = hashlib.sha256()
+    size = 0
+    buffer = bytearray()
+    try:
+        async with await anyio.open_file(tmp_path, "wb") as f:
+            async for chunk in stream:
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                buffer += chunk
+                if len(buffer) >= WRITE_CHUNK_SIZE:
+                    await f.write(bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await f.write(bytes(buffer))
+
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # Fresh again, so jobs.py doesn't collect it before the
+            # attachment row is saved
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return sha256, size
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Return the inclusive ``(start, end)`` of a single byte range, or None.
+
+    Multi-range and malformed headers are ignored, so the whole file is sent.
+    An unsatisfiable range raises a 416.
+    """
+    if not range_header:
+        return None
+    match = RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last N bytes
+        if end == "" or int(end) == 0:
+            raise HTTPException(
+                status_code=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        return max(size - int(end), 0), size - 1
+
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=416, headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size - 1)
+
+
+def safe_content_type(content_type: Optional[str]) -> str:
+    """``content_type`` without parameters if it may be shown inline, else
+    ``application/octet-stream``."""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in INLINE_TYPES or media_type.startswith(INLINE_PREFIXES):
+        return media_type
+    return DEFAULT_TYPE
+
+
+def content_disposition(filename: Optional[str], inline: bool) -> str:
+    """``inline`` or ``attachment``, with an ASCII ``filename`` plus the
+    real name per RFC 5987."""
+    disposition = "inline" if inline else "attachment"
+    if not filename:
+        return disposition
+    fallback = UNSAFE_FILENAME_RE.sub("_", filename).strip() or "download"
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+class BlobResponse(Response):
+    """Serve a stored blob, honouring ``Range``.
+
+    Only types on the inline allowlist keep their type and render in the
+    browser. Everything else goes out as an ``application/octet-stream``
+    download, always with ``nosniff``.
+
+    Uses the ASGI ``http.response.zerocopy`` extension (sendfile) when the
+    server offers it and falls back to chunked reads otherwise.
+    """
+
+    def __init__(
+        self,
+        sha256: str,
+        size: int,
+        range_header: Optional[str] = None,
+        media_type: Optional[str] = None,
+        filename: Optional[str] = None,
+    ):
+        self.path = blob_path(sha256)
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            status_code = 200
+            self.offset, self.count = 0, size
+        else:
+            status_code = 206
+            self.offset, self.count = byte_range[0], byte_range[1] - byte_range[0] + 1
+
+        media_type = safe_content_type(media_type)
+        headers = {
+            "accept-ranges": "bytes",
+            "x-content-type-options": "nosniff",
+            "content-disposition": content_disposition(filename, media_type != DEFAULT_TYPE),
+            "content-length": str(self.count),
+            "etag": f'"{sha256}"',
+            # Blobs are content addressed, they never change
+            "cache-control": "private, max-age=31536000, immutable",
+        }
+        if status_code == 206:
+            headers["content-range"] = (
+                f"bytes {self.offset}-{self.offset + self.count - 1}/{size}"
+            )
+
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if self.count and "http.response.zerocopy" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send(
+                    {
+                        "type": "http.response.zerocopy",
+                        "file": f.fileno(),
+                        "offset": self.offset,
+                        "count": self.count,
+                        "more_body": False,
+                    }
+                )
+            return
+
+        finished = False
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.offset)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await f.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                finished = remaining == 0
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": not finished,
+                    }
+                )
+        if not finished:
+            # Empty blobs and files cut short still have to end the response
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
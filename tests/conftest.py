@@ -0,0 +1,67 @@
+"""App under test: a throwaway in-memory SQLite database, no job runner
+and no rate limits. Settings are read on import, so the environment is set
+before anything from the app is imported."""
+import os
+import sys
+import tempfile
+
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ["JOBS_ENABLED"] = "false"
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+os.environ["ATTACHMENTS_DIR"] = tempfile.mkdtemp(prefix="attachments-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+pytest_plugins = ["profiling"]
+
+PASSWORD = "secret"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from main import app
+
+    # As a context manager so startup creates the schema
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def seed(client):
+    """Two users sharing a group chat with one message in it."""
+    from config import SessionLocal
+    from ids import next_id
+    from services import get_password_hash
+    import models
+
+    db = SessionLocal()
+    try:
+        db.add(models.Role(role="member"))
+        users = [
+            models.User(
+                email=f"{name}@example.com",
+                name=name,
+                password=get_password_hash(PASSWORD),
+                role_name="member",
+            )
+            for name in ("alice", "bob")
+        ]
+        chat = models.Chat(chat_name="general", is_group=True)
+        db.add_all(users + [chat])
+        db.flush()
+        db.add_all(models.ChatMember(chat_id=chat.id, user_id=user.id) for user in users)
+        message = models.Message(
+            id=next_id(), chat_id=chat.id, sender_id=users[0].id, message="hello"
+        )
+        db.add(message)
+        db.commit()
+        return {
+            "users": [user.id for user in users],
+            "emails": [user.email for user in users],
+            "chat_id": chat.id,
+            "message_id": message.id,
+        }
+    finally:
+        db.close()
@@ -0,0 +1,22 @@
+from config import settings
+
+
+def drain(client, token=None):
+    headers = {"X-Admin-Token": token} if token is not None else {}
+    return client.post("/admin/drain", headers=headers)
+
+
+def test_drain_needs_a_configured_token(client, monkeypatch):
+    monkeypatch.setattr(settings, "admin_token", None)
+    assert drain(client).status_code == 403
+    assert drain(client, "").status_code == 403
+
+
+def test_drain_rejects_a_wrong_token(client, monkeypatch):
+    monkeypatch.setattr(settings, "admin_token", "s3cret")
+    assert drain(client, "guess").status_code == 403
+    assert drain(client, "sécret".encode()).status_code == 403
+    # Right token, but the test client isn't on loopback
+    response = drain(client, "s3cret")
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Only from localhost"
@@ -0,0 +1,28 @@
+def upload(client, message_id, content_type, filename):
+    response = client.post(
+        f"/messages/{message_id}/attachments",
+        params={"filename": filename},
+        content=b"<script>alert(1)</script>",
+        headers={"Content-Type": content_type},
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_html_is_stored_and_served_as_a_download(client, seed):
+    attachment = upload(client, seed["message_id"], "text/html; charset=utf-8", "page.html")
+    assert attachment["content_type"] == "application/octet-stream"
+
+    response = client.get(f"/attachments/{attachment['id']}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["content-disposition"].startswith("attachment;")
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+
+def test_images_stay_inline(client, seed):
+    attachment = upload(client, seed["message_id"], "image/png", "pic.png")
+    response = client.get(f"/attachments/{attachment['id']}")
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["content-disposition"].startswith("inline;")
+    assert response.headers["x-content-type-options"] == "nosniff"
@@ -0,0 +1,22 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+
+def export(client, **params):
+    response = client.get("/exports/messages", params=params)
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_since_and_until_with_an_offset(client, seed):
+    row = next(
+        row for row in export(client, chat_id=seed["chat_id"]) if str(row["id"]) == str(seed["message_id"])
+    )
+    created_at = datetime.fromisoformat(row["created_at"]).astimezone()
+    # Same instants, written with an offset far from the server's
+    elsewhere = timezone(timedelta(hours=-11))
+    since = (created_at - timedelta(minutes=1)).astimezone(elsewhere).isoformat()
+    until = (created_at + timedelta(minutes=1)).astimezone(elsewhere).isoformat()
+
+    rows = export(client, chat_id=seed["chat_id"], since=since, until=until)
+    assert str(seed["message_id"]) in {str(row["id"]) for row in rows}
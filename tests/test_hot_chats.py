@@ -0,0 +1,26 @@
+from hot_chats import hot_chats
+
+
+def cached_ids(chat_ref):
+    entry = hot_chats.entries.get(hot_chats.refs.get(chat_ref))
+    return [message_id for message_id, _ in entry.messages]
+
+
+def test_created_message_already_filled_is_not_added_twice(client, seed):
+    from config import SessionLocal
+    import models
+
+    chat_ref = str(seed["chat_id"])
+    hot_chats.invalidate(seed["chat_id"])
+    assert client.get(f"/chats/{chat_ref}").status_code == 200
+    before = cached_ids(chat_ref)
+    assert seed["message_id"] in before
+
+    # The write's own update arriving after a fill that already loaded it
+    db = SessionLocal()
+    try:
+        message = db.query(models.Message).filter(models.Message.id == seed["message_id"]).one()
+        hot_chats.message_created(message)
+    finally:
+        db.close()
+    assert cached_ids(chat_ref) == before
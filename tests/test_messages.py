@@ -0,0 +1,45 @@
+import ids
+
+
+def test_id_collision_retries_with_a_fresh_id(client, seed, monkeypatch):
+    import routers.messages
+
+    fresh = iter([seed["message_id"], ids.next_id()])
+    monkeypatch.setattr(routers.messages, "next_id", lambda: next(fresh))
+    response = client.post(
+        "/messages/",
+        json={"chat_id": seed["chat_id"], "sender_id": seed["users"][0], "message": "again"},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["id"] != str(seed["message_id"])
+
+
+def test_client_id_retry_returns_the_original(client, seed):
+    body = {
+        "id": "client-1",
+        "chat_id": seed["chat_id"],
+        "sender_id": seed["users"][0],
+        "message": "once",
+    }
+    first = client.post("/messages/", json=body)
+    second = client.post("/messages/", json=body)
+    assert first.status_code == second.status_code == 200
+    assert first.json()["id"] == second.json()["id"]
+
+
+def test_deleting_a_message_tombstones_its_reactions(client, seed):
+    chat_id, user_id = seed["chat_id"], seed["users"][0]
+    since = client.post("/sync", json={str(chat_id): "2000-01-01T00:00:00"}).json()["server_time"]
+    message_id = client.post(
+        "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": "doomed"}
+    ).json()["id"]
+    body = {"message_id": message_id, "user_id": user_id, "reaction": "👀"}
+    assert client.post("/message_reactions/", json=body).status_code == 200
+    reaction_id = client.get(f"/message_reactions/{message_id}").json()[0]["id"]
+
+    response = client.delete(f"/messages/{message_id}")
+    assert response.status_code == 200, response.text
+    tombstones = client.post("/sync", json={str(chat_id): since}).json()["chats"][str(chat_id)]["tombstones"]
+    found = {(tombstone["kind"], tombstone["object_id"]) for tombstone in tombstones}
+    assert ("message", message_id) in found
+    assert ("reaction", str(reaction_id)) in found
@@ -0,0 +1,12 @@
+from alembic.script import ScriptDirectory
+
+from migrations.check import alembic_config
+
+
+def test_revisions_form_one_chain():
+    script = ScriptDirectory.from_config(alembic_config())
+    assert len(script.get_heads()) == 1
+    revisions = list(script.walk_revisions())
+    assert revisions[-1].down_revision is None
+    for newer, older in zip(revisions, revisions[1:]):
+        assert newer.down_revision == older.revision
@@ -0,0 +1,108 @@
+"""Every hot endpoint stays within its entry in ``profiling.BUDGETS``."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import PASSWORD
+from profiling import BUDGETS, QueryBudget, QueryBudgetExceeded
+
+
+def login(client, email):
+    response = client.post("/token", data={"username": email, "password": PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_login(client, seed, query_budget):
+    with query_budget():
+        login(client, seed["emails"][0])
+
+
+def test_refresh(client, seed, query_budget):
+    refresh_token = login(client, seed["emails"][0])["refresh_token"]
+    with query_budget():
+        response = client.post("/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 200, response.text
+
+
+def test_list_users(client, seed, query_budget):
+    with query_budget():
+        response = client.get("/users/")
+    assert response.status_code == 200, response.text
+
+
+def test_open_chat(client, seed, query_budget):
+    with query_budget():
+        response = client.get(f"/chats/{seed['chat_id']}")
+    assert response.status_code == 200, response.text
+    assert response.json()["messages"]
+
+
+def test_chat_messages(client, seed, query_budget):
+    with query_budget():
+        response = client.get(f"/chat/messages/{seed['chat_id']}")
+    assert response.status_code == 200, response.text
+
+
+def test_send_message(client, seed, query_budget):
+    with query_budget():
+        response = client.post(
+            "/messages/",
+            json={"chat_id": seed["chat_id"], "sender_id": seed["users"][1], "message": "hi"},
+        )
+    assert response.status_code == 200, response.text
+
+
+def test_reply_and_thread(client, seed, query_budget):
+    parent = str(seed["message_id"])
+    with query_budget():
+        response = client.post(
+            "/messages/",
+            json={
+                "chat_id": seed["chat_id"],
+                "sender_id": seed["users"][1],
+                "parent_message_id": parent,
+                "message": "a reply",
+            },
+        )
+        assert response.status_code == 200, response.text
+        response = client.get(f"/messages/{parent}/thread")
+    assert response.status_code == 200, response.text
+
+
+def test_react(client, seed, query_budget):
+    with query_budget():
+        response = client.post(
+            "/message_reactions/",
+            json={
+                "message_id": str(seed["message_id"]),
+                "user_id": seed["users"][1],
+                "reaction": "👍",
+            },
+        )
+    assert response.status_code == 200, response.text
+
+
+def test_sync(client, seed, query_budget):
+    since = (datetime.now() - timedelta(hours=1)).isoformat()
+    with query_budget():
+        response = client.post("/sync", json={str(seed["chat_id"]): since})
+    assert response.status_code == 200, response.text
+    assert response.json()["chats"][str(seed["chat_id"])]["messages"]
+
+
+def test_budget_catches_overrun(client, seed):
+    budget = QueryBudget()
+    with budget(max_queries=0):
+        client.get("/users/")
+    with pytest.raises(QueryBudgetExceeded):
+        budget.check()
+
+
+def test_every_budget_names_a_route(client):
+    routes = {
+        f"{method} {route.path}"
+        for route in client.app.routes
+        for method in getattr(route, "methods", None) or ()
+    }
+    assert set(BUDGETS) <= routes
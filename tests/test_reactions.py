@@ -0,0 +1,76 @@
+def counts(client, chat_id):
+    response = client.get(f"/chat/messages/{chat_id}")
+    return {message["id"]: message["reaction_counts"] or {} for message in response.json()}
+
+
+def test_moving_a_reaction_updates_both_messages(client, seed):
+    chat_id, user_id = seed["chat_id"], seed["users"][0]
+    first = client.post(
+        "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": "one"}
+    ).json()["id"]
+    second = client.post(
+        "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": "two"}
+    ).json()["id"]
+    body = {"message_id": first, "user_id": user_id, "reaction": "🎉"}
+    assert client.post("/message_reactions/", json=body).status_code == 200
+    reaction_id = client.get(f"/message_reactions/{first}").json()[0]["id"]
+
+    response = client.put(
+        f"/message_reactions/{reaction_id}", json={**body, "id": reaction_id, "message_id": second}
+    )
+    assert response.status_code == 200, response.text
+    found = counts(client, chat_id)
+    assert found[first] == {}
+    assert found[second] == {"🎉": 1}
+
+
+def test_moving_onto_an_existing_reaction_conflicts(client, seed):
+    chat_id, user_id = seed["chat_id"], seed["users"][1]
+    ids = [
+        client.post(
+            "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": text}
+        ).json()["id"]
+        for text in ("a", "b")
+    ]
+    for message_id in ids:
+        body = {"message_id": message_id, "user_id": user_id, "reaction": "👀"}
+        assert client.post("/message_reactions/", json=body).status_code == 200
+    reaction_id = client.get(f"/message_reactions/{ids[0]}").json()[0]["id"]
+
+    response = client.put(
+        f"/message_reactions/{reaction_id}",
+        json={"id": reaction_id, "message_id": ids[1], "user_id": user_id, "reaction": "👀"},
+    )
+    assert response.status_code == 409
+
+
+def test_deleting_a_reaction_finds_its_message_by_id(client, seed):
+    from config import SessionLocal
+    import models
+
+    chat_id, user_id = seed["chat_id"], seed["users"][0]
+    db = SessionLocal()
+    try:
+        other = models.Chat(chat_name="elsewhere", is_group=True)
+        db.add(other)
+        db.commit()
+        other_id = other.id
+    finally:
+        db.close()
+    since = client.post("/sync", json={str(chat_id): "2000-01-01T00:00:00"}).json()["server_time"]
+    target = client.post(
+        "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": "target"}
+    ).json()["id"]
+    body = {"message_id": target, "user_id": user_id, "reaction": "👋"}
+    assert client.post("/message_reactions/", json=body).status_code == 200
+    reaction_id = client.get(f"/message_reactions/{target}").json()[0]["id"]
+    # A message in another chat whose client id reads like the target's id
+    decoy = client.post(
+        "/messages/", json={"id": target, "chat_id": other_id, "sender_id": user_id, "message": "decoy"}
+    )
+    assert decoy.status_code == 200, decoy.text
+
+    response = client.delete(f"/message_reactions/{reaction_id}")
+    assert response.status_code == 200, response.text
+    tombstones = client.post("/sync", json={str(chat_id): since}).json()["chats"][str(chat_id)]["tombstones"]
+    assert ("reaction", str(reaction_id)) in {(t["kind"], t["object_id"]) for t in tombstones}
@@ -0,0 +1,55 @@
+from conftest import PASSWORD
+
+
+def set_ip_group(user_id, ip):
+    from config import SessionLocal
+    import models
+
+    db = SessionLocal()
+    try:
+        if ip and db.query(models.IPGroup).filter(models.IPGroup.ip == ip).first() is None:
+            db.add(models.IPGroup(ip=ip, name="office"))
+        db.query(models.User).filter(models.User.id == user_id).update({"ip_group_id": ip})
+        db.commit()
+    finally:
+        db.close()
+
+
+def login(client, email):
+    response = client.post("/token", data={"username": email, "password": PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()["refresh_token"]
+
+
+def refresh(client, refresh_token):
+    return client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+
+def test_refresh_rotates(client, seed):
+    first = login(client, seed["emails"][1])
+    response = refresh(client, first)
+    assert response.status_code == 200, response.text
+    second = response.json()["refresh_token"]
+    assert second != first
+
+    # Using the old one again revokes the chain
+    assert refresh(client, first).status_code == 401
+    assert refresh(client, second).status_code == 401
+
+
+def test_wrong_ip_does_not_use_up_the_token(client, seed):
+    user_id, email = seed["users"][1], seed["emails"][1]
+    refresh_token = login(client, email)
+    set_ip_group(user_id, "10.0.0.1")
+    try:
+        response = refresh(client, refresh_token)
+        assert response.status_code == 401
+        assert "IP" in response.json()["detail"]
+    finally:
+        set_ip_group(user_id, None)
+    assert refresh(client, refresh_token).status_code == 200
+
+
+def test_non_ascii_token_is_rejected(client, seed):
+    response = refresh(client, "1.1.9999999999.sïgnature")
+    assert response.status_code == 401, response.text
@@ -0,0 +1,31 @@
+from conftest import PASSWORD
+from replicas import recent_writers, wrote_recently
+
+
+def bearer(client, email):
+    response = client.post("/token", data={"username": email, "password": PASSWORD})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def post_message(client, headers, chat_id, sender_id):
+    return client.post(
+        "/messages/",
+        json={"chat_id": chat_id, "sender_id": sender_id, "message": "hi"},
+        headers=headers,
+    )
+
+
+def test_reads_stick_to_the_primary_after_a_commit(client, seed):
+    recent_writers.clear()
+    email = seed["emails"][0]
+    headers = bearer(client, email)
+
+    response = post_message(client, headers, "no-such-chat", seed["users"][0])
+    assert response.status_code == 404
+    assert not wrote_recently(f"user:{email}")
+
+    response = post_message(client, headers, seed["chat_id"], seed["users"][0])
+    assert response.status_code == 200, response.text
+    assert wrote_recently(f"user:{email}")
+    # Keyed on the user, not on the address they share with others
+    assert not wrote_recently("ip:testclient")
@@ -0,0 +1,37 @@
+from config import SessionLocal
+import jobs
+import models
+
+SINCE = "2000-01-01T00:00:00"
+
+
+def test_unknown_chat_comes_back_deleted(client, seed):
+    response = client.post("/sync", json={str(seed["chat_id"]): SINCE, "no-such-chat": SINCE})
+    assert response.status_code == 200, response.text
+    chats = response.json()["chats"]
+    assert chats[str(seed["chat_id"])]["deleted"] is False
+    assert chats["no-such-chat"] == {
+        "messages": [], "reactions": [], "tombstones": [], "reset": False, "deleted": True
+    }
+
+
+def test_retention_leaves_tombstones(client, seed):
+    chat_id, user_id = seed["chat_id"], seed["users"][1]
+    since = client.post("/sync", json={str(chat_id): SINCE}).json()["server_time"]
+    message_id = client.post(
+        "/messages/", json={"chat_id": chat_id, "sender_id": user_id, "message": "old"}
+    ).json()["id"]
+    body = {"message_id": message_id, "user_id": user_id, "reaction": "👍"}
+    assert client.post("/message_reactions/", json=body).status_code == 200
+    reaction_id = client.get(f"/message_reactions/{message_id}").json()[0]["id"]
+
+    db = SessionLocal()
+    try:
+        jobs.delete_messages(db, models.Job(kind="retention"), [int(message_id)])
+        db.commit()
+    finally:
+        db.close()
+    tombstones = client.post("/sync", json={str(chat_id): since}).json()["chats"][str(chat_id)]["tombstones"]
+    found = {(tombstone["kind"], tombstone["object_id"]) for tombstone in tombstones}
+    assert ("message", message_id) in found
+    assert ("reaction", str(reaction_id)) in found
@@ -0,0 +1,71 @@
+import msgpack
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from services import create_access_token
+
+
+def token_for(email):
+    return create_access_token({"sub": email})
+
+
+@pytest.mark.parametrize("query", ["", "?user_id=1", "?token=not-a-token"])
+def test_connecting_needs_a_valid_token(client, seed, query):
+    with pytest.raises(WebSocketDisconnect) as raised:
+        with client.websocket_connect(f"/ws{query}") as websocket:
+            websocket.receive_json()
+    assert raised.value.code == 1008
+
+
+def test_summary_goes_to_the_token_user(client, seed):
+    with client.websocket_connect(f"/ws?token={token_for(seed['emails'][1])}") as websocket:
+        assert websocket.receive_json()["type"] == "notifications.summary"
+
+
+def test_chat_events_only_reach_members(client, seed):
+    from config import SessionLocal
+    from routers.websocket import manager
+    import models
+
+    db = SessionLocal()
+    try:
+        outsider = models.User(email="carol@example.com", name="carol", password="", role_name="member")
+        db.add(outsider)
+        db.commit()
+        outsider_id = outsider.id
+    finally:
+        db.close()
+    # Not routed to this chat yet in this process
+    manager.chat_members.pop(seed["chat_id"], None)
+
+    with client.websocket_connect(f"/ws?token={token_for('carol@example.com')}") as outsider_socket:
+        with client.websocket_connect(f"/ws?token={token_for(seed['emails'][1])}") as member_socket:
+            outsider_socket.receive_json()
+            member_socket.receive_json()
+            response = client.put(
+                f"/messages/{seed['message_id']}",
+                json={"chat_id": seed["chat_id"], "sender_id": seed["users"][0], "message": "edited"},
+            )
+            assert response.status_code == 200, response.text
+            assert member_socket.receive_json()["type"] == "message.updated"
+
+            # Sent to everyone, so the first thing the outsider gets
+            update = {"email": "", "password": "", "name": "carol2", "image_url": "", "role_name": ""}
+            assert client.put(f"/users/{outsider_id}", json=update).status_code == 200
+            assert outsider_socket.receive_json()["type"] == "user.updated"
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        {"text": '{"type": "hello", "protocol": ["json"]}'},
+        {"bytes": msgpack.packb({"type": "typing", "blob": b"\x00"}, use_bin_type=True)},
+        {"bytes": msgpack.packb({"type": "typing", "chat": {1: "x"}})},
+    ],
+)
+def test_bad_frames_are_answered(client, seed, frame):
+    with client.websocket_connect(f"/ws?token={token_for(seed['emails'][0])}") as websocket:
+        websocket.receive_json()
+        websocket.send({"type": "websocket.receive", **frame})
+        error = websocket.receive_json()
+        assert (error["type"], error["code"]) == ("error", "bad_frame")